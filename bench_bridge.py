@@ -0,0 +1,213 @@
+'''
+    Bridge Benchmark
+
+    Runs mod_bridge between two in-process fake brokers, see ps_fake_mqtt,
+    "lan" and "hive", bridged as in the mod_bridge example:
+        a_to_b : "#" to "lan/"
+        b_to_a : "lan/#" from "lan/" to ""
+    so every message forwarded to hive comes back and must be dropped as a loop.
+
+    Checks, each failing the benchmark, exit code 1, if it does not hold:
+      - forward : each message published to lan reaches hive once, under "lan/",
+                  and each "lan/" message published to hive reaches lan once
+      - loops   : no message is forwarded back to the broker it came from
+      - pending : no fingerprints are left once every message has come back
+      - dropped : a message dropped from a full queue while hive is down does
+                  not stop a later copy of it, forwarded once hive is back,
+                  being recognised when it comes back
+      - repeat  : the same reading published again on lan before loop_ms has
+                  passed is forwarded each time, with a one way bridge and the
+                  two way bridge, and is not forwarded back to lan
+
+    Reports the messages forwarded a second and the ms from publishing to lan
+    until the message reaches hive, p50 and p99.
+
+    Each result is appended as a json line to the --out file.
+
+    To run:  python bench_bridge.py --count 20000
+'''
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import ps_fake_mqtt
+from ps_parms import PsosParms, PsosDefaults
+import mod_bridge
+
+def pcts(ms):
+    if len(ms) == 0:
+        return {"cnt":0, "p50":0, "p99":0}
+    ms = sorted(ms)
+    return {"cnt":len(ms), "p50":round(ms[len(ms)//2],3), "p99":round(ms[min(len(ms)-1,len(ms)*99//100)],3)}
+
+def make_bridge(**parms):
+    p = {"name":"bridge", "module":"mod_bridge", "client_module":"ps_fake_mqtt",
+         "host_a":"lan", "host_b":"hive", "reconnect_secs":0.05,
+         "a_to_b":[{"filter":"#", "to":"lan/"}],
+         "b_to_a":[{"filter":"lan/#", "from":"lan/", "to":""}]}
+    p.update(parms)
+    return mod_bridge.ModuleService(PsosParms(p,PsosDefaults({"services":{}}),{}))
+
+# collect messages received by a client of broker host in got
+async def watch(host,got,ready):
+    async with ps_fake_mqtt.Client(host) as c:
+        async with c.messages() as messages:
+            await c.subscribe("#")
+            ready.set()
+            async for msg in messages:
+                got.append((time.perf_counter(),msg.topic,msg.payload))
+
+async def run_bridge(bridge,fn):
+    task = asyncio.create_task(bridge.run())
+    got = {"lan":[], "hive":[]}
+    watchers = []
+    for host in got:
+        ready = asyncio.Event()
+        watchers.append(asyncio.create_task(watch(host,got[host],ready)))
+        await ready.wait()
+    while not all(e.is_set() for e in bridge._connected.values()):
+        await asyncio.sleep(0.01)
+
+    try:
+        return await fn(got)
+    finally:
+        for t in watchers + [task]:
+            t.cancel()
+        await asyncio.gather(*watchers,task,return_exceptions=True)
+        ps_fake_mqtt.reset()
+
+async def bench_forward(args,failed):
+    bridge = make_bridge(loop_ms=args.loop_ms,queue=args.count * 2)
+
+    async def fn(got):
+        sent = {}
+        async with ps_fake_mqtt.Client("lan") as a, ps_fake_mqtt.Client("hive") as b:
+            t0 = time.perf_counter()
+            for i in range(args.count):
+                payload = "v{}".format(i).encode("utf-8")
+                sent[payload] = time.perf_counter()
+                await a.publish("home/t{}".format(i % 10),payload)
+                if i % 100 == 0:
+                    await b.publish("lan/cmd/{}".format(i),b"on")
+                    await asyncio.sleep(0)
+
+            # wait for everything to reach hive
+            while len(got["hive"]) < args.count + args.count // 100 and time.perf_counter() - t0 < args.timeout:
+                await asyncio.sleep(0.01)
+            secs = time.perf_counter() - t0
+            await asyncio.sleep(0.1)
+
+        fwd = [m for m in got["hive"] if m[1].startswith("lan/home/")]
+        lat = [(t - sent[p]) * 1000 for (t,topic,p) in fwd if p in sent]
+        back = [m for m in got["lan"] if m[1].startswith("cmd/")]
+        loops = [m for m in got["lan"] if m[1].startswith("home/")]
+        stats = bridge.get_stats()
+
+        if len(fwd) != args.count or len(set(m[2] for m in fwd)) != args.count:
+            failed.append("forward: {} of {} messages reached hive".format(len(fwd),args.count))
+        if len(back) != args.count // 100:
+            failed.append("forward: {} of {} messages reached lan".format(len(back),args.count // 100))
+        if len(loops) != args.count:
+            failed.append("loops: {} messages forwarded back to lan".format(len(loops) - args.count))
+        if stats["pending"] != 0:
+            failed.append("pending: {} fingerprints left".format(stats["pending"]))
+
+        return {"msgs_s":round(len(fwd) / secs,1), "lat_ms":pcts(lat), "stats":stats}
+
+    return await run_bridge(bridge,fn)
+
+async def bench_dropped(args,failed):
+    bridge = make_bridge(queue=1,loop_ms=500,batch_ms=0)
+
+    async def fn(got):
+        hive = ps_fake_mqtt.get_broker("hive")
+        async with ps_fake_mqtt.Client("lan") as a:
+            hive.set_down(True)
+            await asyncio.sleep(0.05)
+            await a.publish("home/x",b"A")      # queued, expires at 550ms
+            await a.publish("home/y",b"B")      # drops A
+            await asyncio.sleep(0.3)
+            await a.publish("home/x",b"A")      # drops B, A queued again, expires at 850ms
+            # the first A expires before the second one comes back
+            await asyncio.sleep(0.25)
+            hive.set_down(False)
+        watcher = asyncio.Event()
+        w = asyncio.create_task(watch("hive",got["hive"],watcher))
+        await watcher.wait()
+        await asyncio.sleep(0.3)
+        w.cancel()
+
+        stats = bridge.get_stats()
+        back = [m for m in got["lan"] if m[1] == "home/x"]
+        if len(back) != 2:
+            failed.append("dropped: A forwarded back to lan {} times".format(len(back) - 2))
+        if stats["pending"] != 0:
+            failed.append("dropped: {} fingerprints left".format(stats["pending"]))
+        return {"stats":stats}
+
+    return await run_bridge(bridge,fn)
+
+async def bench_repeat(args,failed,two_way):
+    parms = {"loop_ms":1000}
+    if not two_way:
+        parms["b_to_a"] = []
+    bridge = make_bridge(**parms)
+    name = "two way" if two_way else "one way"
+
+    async def fn(got):
+        async with ps_fake_mqtt.Client("lan") as a:
+            for i in range(3):
+                await a.publish("e01/dht/upd",b"upd")
+                await asyncio.sleep(0.3)
+
+        stats = bridge.get_stats()
+        fwd = [m for m in got["hive"] if m[1] == "lan/e01/dht/upd"]
+        back = [m for m in got["lan"] if m[1] == "e01/dht/upd"]
+        if len(fwd) != 3:
+            failed.append("repeat: {} {} of 3 readings reached hive".format(name,len(fwd)))
+        if len(back) != 3:
+            failed.append("repeat: {} reading forwarded back to lan {} times".format(name,len(back) - 3))
+        if two_way and stats["pending"] != 0:
+            failed.append("repeat: {} {} fingerprints left".format(name,stats["pending"]))
+        return {"stats":stats}
+
+    return await run_bridge(bridge,fn)
+
+def main():
+    ap = argparse.ArgumentParser(description="mod_bridge benchmark")
+    ap.add_argument("--count",   type=int,   default=20000, help="messages to publish")
+    ap.add_argument("--loop_ms", type=int,   default=1000, help="bridge loop_ms")
+    ap.add_argument("--timeout", type=float, default=60, help="seconds to wait for messages")
+    ap.add_argument("--out",     default="bench_bridge.jsonl", help="file to append results to")
+    args = ap.parse_args()
+
+    failed = []
+    fwd = asyncio.run(bench_forward(args,failed))
+    drop = asyncio.run(bench_dropped(args,failed))
+    asyncio.run(bench_repeat(args,failed,False))
+    asyncio.run(bench_repeat(args,failed,True))
+
+    print("bench: {} messages forwarded at {} msgs/s".format(args.count,fwd["msgs_s"]))
+    print("  latency ms p50 {} p99 {}".format(fwd["lat_ms"]["p50"],fwd["lat_ms"]["p99"]))
+    print("  a_to_b {}".format(fwd["stats"]["a_to_b"]))
+    print("  b_to_a {}".format(fwd["stats"]["b_to_a"]))
+    print("  dropped queue {}".format(drop["stats"]["a_to_b"]))
+
+    r = {"dt":time.strftime("%Y-%m-%d %H:%M:%S"), "python":sys.version.split()[0],
+         "count":args.count, "loop_ms":args.loop_ms, "msgs_s":fwd["msgs_s"],
+         "lat_ms":fwd["lat_ms"], "failed":failed}
+    with open(args.out,"a") as f:
+        f.write(json.dumps(r))
+        f.write("\n")
+
+    if len(failed) > 0:
+        for f in failed:
+            print("bench: FAILED", f)
+        sys.exit(1)
+    print("bench: passed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+    Benchmark payload codecs on datastore rows
+
+    Rows of a mod_ds data file, mqtt_dat.txt by default, are split into pages
+    of --rows rows and each page is encoded and decoded with every codec
+    available, see ps_codec, as:
+      - rows : a mod_ds_get response, {"prev_idx":..., "data":[row,...], "next_idx":...}
+               with each row the data file line
+      - docs : a list of {"dt":..., "topic":..., "payload":...} with json
+               payloads parsed, as a client would use them
+
+    Reports for each codec the best time of several runs to encode and
+    decode a page in us, and the average size of a page in bytes.
+    Codecs which are not installed are listed as such.
+
+    To run:  python bench_codec.py
+             python bench_codec.py --fn /data/mqtt_dat.txt --rows 1000
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import ps_codec
+
+_all_codecs = ["json","orjson","msgpack","cbor"]
+
+# return list of pages of rows and list of pages of docs
+def load_pages(fn,rows):
+    lines = []
+    with open(fn,encoding="utf-8") as f:
+        for ln in f:
+            lines.append(ln.rstrip())
+
+    row_pages = []
+    doc_pages = []
+    for i in range(0,len(lines),rows):
+        page = lines[i:i+rows]
+        row_pages.append({"prev_idx":i-1, "data":page, "next_idx":i+len(page)})
+
+        docs = []
+        for ln in page:
+            r = ln.split('\t',2)
+            while len(r) < 3:
+                r.append("")
+            payload = r[2]
+            if payload.startswith('{'):
+                try:
+                    payload = json.loads(payload)
+                except ValueError:
+                    pass
+            docs.append({"dt":r[0], "topic":r[1], "payload":payload})
+        doc_pages.append(docs)
+
+    return (row_pages,doc_pages)
+
+# return best time of repeat runs of fn over pages, in us per page
+def measure(fn,pages,repeat):
+    for p in pages:
+        fn(p)
+
+    best = None
+    for r in range(repeat):
+        t = time.perf_counter()
+        for p in pages:
+            fn(p)
+        t = time.perf_counter() - t
+        if best == None or t < best:
+            best = t
+    return best / len(pages) * 1e6
+
+def bench(name,pages,repeat):
+    c = ps_codec.get(name)
+    enc = [c.encode(p) for p in pages]
+    if c.decode(enc[0]) != pages[0]:
+        raise ValueError("codec {} does not round trip".format(name))
+    return (measure(c.encode,pages,repeat),measure(c.decode,enc,repeat),
+            sum(len(e) for e in enc) / len(enc))
+
+def main():
+    ap = argparse.ArgumentParser(description="benchmark payload codecs")
+    ap.add_argument("--fn",default=os.path.join(os.path.dirname(os.path.abspath(__file__)),"mqtt_dat.txt"),
+                    help="mod_ds data file")
+    ap.add_argument("--rows",type=int,default=100,help="rows in a page")
+    ap.add_argument("--repeat",type=int,default=20,help="runs, the best is reported")
+    args = ap.parse_args()
+
+    (row_pages,doc_pages) = load_pages(args.fn,args.rows)
+    print("bench: python {}, {} pages of {} rows from {}".
+          format(sys.version.split()[0],len(row_pages),args.rows,args.fn))
+
+    for (shape,pages) in (("rows",row_pages),("docs",doc_pages)):
+        print("{:6} {:8} {:>10} {:>10} {:>10}".format(shape,"codec","encode us","decode us","bytes"))
+        for name in _all_codecs:
+            if not ps_codec.has(name):
+                print("{:6} {:8} not installed".format("",name))
+                continue
+            (enc,dec,sz) = bench(name,pages,args.repeat)
+            print("{:6} {:8} {:10.1f} {:10.1f} {:10.0f}".format("",name,enc,dec,sz))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
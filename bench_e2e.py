@@ -0,0 +1,286 @@
+'''
+    End to End Benchmark
+
+    Boots psrpi_main with mod_mqtt connected to an in-process fake broker,
+    see ps_fake_mqtt, and publishes messages to the broker as another MQTT
+    client would. Messages flow broker -> mod_mqtt -> mod_ds, and every
+    get_every messages a request is sent to mod_ds_get and its response
+    read back from the broker.
+
+    Messages are either generated from a mix of topics, each with a weight:
+        --topics sensor/temp:4,sensor/hum:2,cam/status:1
+    or replayed from a datastore file:
+        --replay mqtt_dat.txt
+
+    Reports:
+      - msgs/s : messages published per second, until all were received
+                 and all service queues were empty
+      - ingest : ms from publishing to the broker until a subscribing
+                 service gets the message, p50 and p99
+      - get    : ms from sending a ds_get request until the response is
+                 received from the broker, p50 and p99
+      - mem    : resident set size and peak resident set size in KB
+
+    Messages dropped by mod_mqtt as duplicates are counted but not timed.
+
+    Each result is appended as a json line to the --out file and compared
+    with the last result with the same --label, by default the same
+    --topics or --replay and --rate.
+
+    By default the services are mqtt, ds and d_get with the datastore in a
+    temporary directory. --parms is a psrpi parms json file to use instead.
+    The mqtt service in it is set to use the fake broker and not print messages.
+
+    To run:  python bench_e2e.py --count 20000
+             python bench_e2e.py --replay mqtt_dat.txt --rate 500
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from ps_mod import PsrpiModule
+import ps_fake_mqtt
+
+_host  = "bench"
+_probe = None
+
+'''
+    Probe service, run by psrpi_main in the benchmark,
+    records when it receives each message.
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+        self.sub  = self.get_parm("sub","#")
+        self.sent = {}      # (topic,payload): [time published, ...]
+        self.ingest_ms = []
+
+    async def run(self):
+        global _probe
+        q = asyncio.Queue()
+        await self.get_mqtt().subscribe(self.sub,q)
+        _probe = self
+
+        while True:
+            data = await q.get()
+            t = self.sent.get((data[1],data[2]))
+            if t != None and len(t) > 0:
+                self.ingest_ms.append((time.perf_counter() - t.pop(0)) * 1000)
+
+# return generator of (topic,payload) for a topic mix "topic:weight,..."
+def gen_mix(topics):
+    names   = []
+    weights = []
+    for tw in topics.split(','):
+        tw = tw.split(':')
+        names.append(tw[0])
+        weights.append(float(tw[1]) if len(tw) > 1 else 1)
+
+    i = 0
+    while True:
+        for t in random.choices(names,weights,k=1000):
+            i += 1
+            yield (t,json.dumps({"seq":i, "v":round(random.uniform(0,100),2)}))
+
+# return generator of (topic,payload) replaying a datastore file, repeating it as needed
+def gen_replay(fn):
+    rows = []
+    with open(fn,encoding="utf-8",errors="replace") as f:
+        for ln in f:
+            r = ln.rstrip("\r\n").split('\t',2)
+            if len(r) == 3:
+                rows.append((r[1],r[2]))
+    if len(rows) == 0:
+        raise ValueError("no rows in {}".format(fn))
+
+    while True:
+        for r in rows:
+            yield r
+
+# return p50 and p99 of a list of ms
+def pcts(ms):
+    if len(ms) == 0:
+        return {"cnt":0, "p50":0, "p99":0, "max":0}
+    ms = sorted(ms)
+    return {"cnt":len(ms), "p50":round(ms[len(ms)//2],3),
+            "p99":round(ms[min(len(ms)-1,len(ms)*99//100)],3), "max":round(ms[-1],3)}
+
+def make_parms(args,tmp):
+    if args.parms != None:
+        with open(args.parms) as f:
+            parms = json.load(f)
+        svc = parms["services"]
+    else:
+        parms = {"name":"bench", "main":"psrpi_main", "defaults":{"sys":"bench"}}
+        svc = [{"name":"mqtt",  "module":"mod_mqtt"},
+               {"name":"ds",    "module":"mod_ds", "sub":"#",
+                "fn":os.path.join(tmp,"mqtt_dat.txt"), "fn_idx":os.path.join(tmp,"mqtt_idx.txt")},
+               {"name":"d_get", "module":"mod_ds_get", "ds":"ds", "sub":"bench/ds/get"}]
+        parms["services"] = svc
+
+    for p in svc:
+        if p["name"] == "mqtt":
+            p.update({"client_module":"ps_fake_mqtt", "host":_host, "print":False})
+    svc.append({"name":"probe", "module":"bench_e2e", "sub":"#"})
+    return parms
+
+async def bench(args):
+    import bench_e2e    # module psrpi_main runs the probe service from
+    import psrpi_main
+    from mod_stats import mem_stats
+
+    tmp = tempfile.mkdtemp(prefix="bench_e2e_")
+    parms = make_parms(args,tmp)
+    config = {"sys":"bench"}
+
+    main = asyncio.create_task(psrpi_main.main(parms,config))
+
+    # wait for mod_mqtt to connect and the probe to subscribe
+    t = time.perf_counter()
+    while bench_e2e._probe == None or bench_e2e._probe.get_mqtt()._client == None:
+        if time.perf_counter() - t > 30 or main.done():
+            raise RuntimeError("services did not start")
+        await asyncio.sleep(0.01)
+
+    probe = bench_e2e._probe
+    mqtt  = probe.get_mqtt()
+    ds_get = probe.get_svc("d_get")
+
+    if args.replay != None:
+        msgs = gen_replay(args.replay)
+        source = "replay " + args.replay
+    else:
+        msgs = gen_mix(args.topics)
+        source = args.topics
+
+    get_topic = args.get_topic
+    if ds_get == None:
+        get_topic = None
+
+    async with ps_fake_mqtt.Client(_host) as client:
+        resp_t = {}
+        get_ms = []
+
+        async def read_resp():
+            async with client.messages() as messages:
+                await client.subscribe("bench/resp/#")
+                async for msg in messages:
+                    t = resp_t.pop(msg.topic,None)
+                    if t != None:
+                        get_ms.append((time.perf_counter() - t) * 1000)
+
+        reader = asyncio.create_task(read_resp())
+        await asyncio.sleep(0)
+
+        print("bench: publishing {} messages from {}".format(args.count,source))
+        dups0 = mqtt.dups
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            if args.rate > 0:
+                ahead = t0 + i/args.rate - time.perf_counter()
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+
+            (topic,payload) = next(msgs)
+            probe.sent.setdefault((topic,payload),[]).append(time.perf_counter())
+            await client.publish(topic,payload)
+
+            if get_topic != None and args.get_every > 0 and i % args.get_every == 0:
+                rt = "bench/resp/{}".format(i)
+                resp_t[rt] = time.perf_counter()
+                await client.publish(get_topic,json.dumps({"resp_topic":rt,"filter":topic,"max_cnt":10}))
+
+            await asyncio.sleep(0)
+
+        # wait for all messages to be received and all queues to empty
+        while True:
+            st = mqtt.get_stats()
+            busy = (len(probe.ingest_ms) + st["dups"] - dups0 < args.count or len(resp_t) > 0 or
+                    any(s["qsize"] > 0 for s in st["subs"]))
+            if not busy or time.perf_counter() - t0 > args.timeout:
+                break
+            await asyncio.sleep(0.001)
+        secs = time.perf_counter() - t0
+
+        reader.cancel()
+
+    main.cancel()
+
+    result = {"label":args.label, "dt":time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python":sys.version.split()[0], "source":source,
+              "count":args.count, "rate":args.rate, "get_every":args.get_every,
+              "secs":round(secs,3), "msgs_s":round(args.count/secs,1),
+              "ingest_ms":pcts(probe.ingest_ms), "get_ms":pcts(get_ms),
+              "dups":mqtt.dups - dups0, "lost":len(resp_t), "mem":mem_stats()}
+    del result["mem"]["gc_count"]
+    return result
+
+# print result and its change from the last result with the same label
+def report(result,prev):
+    def line(name,v,pv):
+        chg = ""
+        if pv != None and pv != 0:
+            chg = "{:+.1f}%".format((v - pv) / pv * 100)
+        print("  {:14} {:12} {:>8}".format(name,v,chg))
+
+    def get(r,k1,k2=None):
+        if r == None:
+            return None
+        v = r.get(k1)
+        if k2 != None and v != None:
+            v = v.get(k2)
+        return v
+
+    print("bench: {} {} messages in {}s".format(result["label"],result["count"],result["secs"]))
+    if prev != None:
+        print("  compared with {}".format(prev["dt"]))
+    line("msgs/s",result["msgs_s"],get(prev,"msgs_s"))
+    for k in ["ingest_ms","get_ms"]:
+        for p in ["p50","p99"]:
+            line("{} {}".format(k,p),result[k][p],get(prev,k,p))
+    for k in result["mem"]:
+        line(k,result["mem"][k],get(prev,"mem",k))
+    print("  dups {} lost {}".format(result["dups"],result["lost"]))
+
+def main():
+    ap = argparse.ArgumentParser(description="psrpi end to end benchmark")
+    ap.add_argument("--parms",    default=None, help="psrpi parms json file")
+    ap.add_argument("--count",    type=int,   default=10000, help="messages to publish")
+    ap.add_argument("--rate",     type=float, default=0, help="messages per second, 0 for as fast as possible")
+    ap.add_argument("--topics",   default="sensor/temp:4,sensor/hum:2,cam/status:1", help="topic:weight,...")
+    ap.add_argument("--replay",   default=None, help="datastore file to replay")
+    ap.add_argument("--get_every",type=int,   default=100, help="send a ds_get request every n messages, 0 for none")
+    ap.add_argument("--get_topic",default="bench/ds/get", help="ds_get request topic")
+    ap.add_argument("--timeout",  type=float, default=120, help="seconds to wait for messages")
+    ap.add_argument("--label",    default=None, help="name to compare results by, default is the source and rate")
+    ap.add_argument("--out",      default="bench_e2e.jsonl", help="file to append results to")
+    args = ap.parse_args()
+
+    if args.label == None:
+        args.label = "{} rate {:g}".format(args.replay or args.topics,args.rate)
+
+    result = asyncio.run(bench(args))
+
+    prev = None
+    if os.path.exists(args.out):
+        with open(args.out) as f:
+            for ln in f:
+                r = json.loads(ln)
+                if r.get("label") == result["label"]:
+                    prev = r
+
+    report(result,prev)
+    with open(args.out,"a") as f:
+        f.write(json.dumps(result))
+        f.write("\n")
+
+if __name__ == '__main__':
+    main()
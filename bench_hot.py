@@ -0,0 +1,263 @@
+'''
+    Benchmark the functions run for every message
+
+      - filter_match : match a topic against 1000 subscriptions
+      - in_buff      : mod_mqtt duplicate check with 10000 messages in the window
+      - get_parm     : PsosParms.get_parm of a service parm
+      - to_str       : ps_util.to_str of a 100 byte payload
+      - to_bytes     : ps_util.to_bytes of a 100 character payload
+      - get_dt       : PsrpiModule.get_dt
+      - get_idx_pos  : mod_ds._get_idx_pos of a random row
+      - get_blk      : mod_ds._get_blk of 10 rows at a random row
+
+    The datastore is ds_mb MB, by default the size the baselines were saved
+    with, or 1024, and is created the first time in the temporary directory
+    then reused. get_idx_pos and get_blk depend on its size, so results are
+    not compared with baselines saved with another size.
+
+    Times are the best of several runs, in ns per call. They are compared with
+    the baselines in bench_hot.json and the benchmark fails, exit code 1, if any
+    is slower than its baseline by more than the tolerance, 25% by default.
+    A benchmark slower than its baseline is re-run up to --retries times, keeping
+    the best time, so a busy machine does not fail the benchmark.
+    Baselines are only comparable on the machine they were saved on,
+    use --save to save new baselines after an intended change.
+
+    To run:  python bench_hot.py
+             python bench_hot.py --save
+             python bench_hot.py --tolerance 0.5
+'''
+
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from ps_parms import PsosParms, PsosDefaults
+from ps_subscr import Subscription
+import ps_util
+
+_baseline_fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),"bench_hot.json")
+
+# return best time of repeat runs of n calls of fn, in ns per call.
+# setup, if not None, is called before each run and is not timed.
+def measure(fn,n,repeat=20,setup=None):
+    # warm up
+    if setup != None:
+        setup()
+    for i in range(max(1,n//10)):
+        fn()
+
+    best = None
+    for r in range(repeat):
+        if setup != None:
+            setup()
+        t = time.perf_counter()
+        for i in range(n):
+            fn()
+        t = time.perf_counter() - t
+        if best == None or t < best:
+            best = t
+    return best / n * 1e9
+
+def svc_parms(parms):
+    return PsosParms(parms,PsosDefaults({"services":{}}),{})
+
+def bench_filter_match(n):
+    levels = ["home","cam01","cam02","temp","hum","status","log","pi4","pico","garage"]
+    random.seed(1)
+    subs = []
+    for i in range(1000):
+        f = [random.choice(levels) for l in range(random.randint(1,4))]
+        if i % 10 == 0:
+            f[-1] = "#"
+        elif i % 10 == 1:
+            f[0] = "+"
+        subs.append(Subscription("/".join(f),None))
+
+    t_split = "home/cam02/status".split('/')
+    def run():
+        for s in subs:
+            s.filter_match(t_split)
+    return measure(run,n//1000)
+
+def bench_in_buff(n):
+    import mod_mqtt
+    mqtt = mod_mqtt.ModuleService(svc_parms({"name":"mqtt"}))
+
+    # messages expire from the window after 3 seconds,
+    # so fill it again before each run
+    def fill():
+        t = ps_util.ticks_ms()
+        mqtt._msg_buff[:] = [(t,"home/temp{}".format(i%50),b'{"temp":%d}' % i) for i in range(10000)]
+
+    i = [0]
+    def run():
+        i[0] += 1
+        mqtt._in_buff("home/new",b'{"seq":%d}' % i[0])
+    # keep the window near 10000 messages
+    return measure(run,min(n//100,1000),setup=fill)
+
+def bench_get_parm(n):
+    p = svc_parms({"name":"d_get","module":"mod_ds_get","ds":"ds","sub":"{sys}/ds/get","workers":3})
+    return measure(lambda: p.get_parm("workers"),n)
+
+def bench_to_str(n):
+    b = b'{"temp":72.5,"hum":41.2,"dev":"pi4","status":"ok","seq":123456,"msg":"all good here"}  '
+    return measure(lambda: ps_util.to_str(b),n)
+
+def bench_to_bytes(n):
+    s = '{"temp":72.5,"hum":41.2,"dev":"pi4","status":"ok","seq":123456,"msg":"all good here"}  '
+    return measure(lambda: ps_util.to_bytes(s),n)
+
+def bench_get_dt(n):
+    from ps_mod import PsrpiModule
+    m = PsrpiModule(svc_parms({"name":"m"}))
+    return measure(m.get_dt,n//10)
+
+# create a datastore of about mb MB, if not already created
+def make_ds(mb):
+    d = os.path.join(tempfile.gettempdir(),"bench_hot_ds_{}".format(mb))
+    fn = os.path.join(d,"mqtt_dat.txt")
+    fn_idx = os.path.join(d,"mqtt_idx.txt")
+    if os.path.exists(fn_idx):
+        return (fn,fn_idx)
+
+    print("bench: creating {} MB datastore in {}".format(mb,d))
+    os.makedirs(d,exist_ok=True)
+    pos = 0
+    row = 0
+    with open(fn,"wb") as f, open(fn_idx+".tmp","wb") as f_idx:
+        while pos < mb * 1024 * 1024:
+            lines = []
+            idx = []
+            for i in range(10000):
+                ln = '4/{}/2023 {}:{:02d}:{:02d}\thome/temp{}\t{{"temp":{},"seq":{}}}\n'.format(
+                        row//864000%28+1,row//36000%24,row//600%60,row//10%60,row%20,row%90,row).encode("utf-8")
+                idx.append(pos)
+                pos += len(ln)
+                lines.append(ln)
+                row += 1
+            f.write(b''.join(lines))
+            f_idx.write(struct.pack("{}i".format(len(idx)),*idx))
+    os.replace(fn_idx+".tmp",fn_idx)
+    return (fn,fn_idx)
+
+def get_ds(mb):
+    import mod_ds
+    (fn,fn_idx) = make_ds(mb)
+    return mod_ds.ModuleService(svc_parms({"name":"ds","fn":fn,"fn_idx":fn_idx}))
+
+def bench_get_idx_pos(n,ds):
+    rows = ds.row_cnt()
+    return measure(lambda: ds._get_idx_pos(random.randrange(rows)),n//100)
+
+def bench_get_blk(n,ds):
+    rows = ds.row_cnt()
+    def run():
+        ds._get_blk(ds._get_idx_pos(random.randrange(rows-10)),10)
+    return measure(run,n//100)
+
+# return list of (name,function returning ns per call)
+def benchmarks(n,ds_mb):
+    ds = get_ds(ds_mb)
+    return [("filter_match",lambda: bench_filter_match(n)),
+            ("in_buff",     lambda: bench_in_buff(n)),
+            ("get_parm",    lambda: bench_get_parm(n)),
+            ("to_str",      lambda: bench_to_str(n)),
+            ("to_bytes",    lambda: bench_to_bytes(n)),
+            ("get_dt",      lambda: bench_get_dt(n)),
+            ("get_idx_pos", lambda: bench_get_idx_pos(n,ds)),
+            ("get_blk",     lambda: bench_get_blk(n,ds))]
+
+# return ns per call of each benchmark
+def bench(tests):
+    results = {}
+    for (name,fn) in tests:
+        results[name] = round(fn(),1)
+        print("  {:12} {:12.1f} ns".format(name,results[name]))
+    return results
+
+# compare results with baselines, returning list of regressions
+def compare(results,base,tolerance):
+    failed = []
+    print("{:14} {:>12} {:>12} {:>8}".format("","baseline ns","ns","change"))
+    for (name,ns) in results.items():
+        b = base.get(name)
+        if b == None:
+            print("{:14} {:>12} {:12.1f}".format(name,"-",ns))
+            continue
+        chg = (ns - b) / b
+        flag = ""
+        if chg > tolerance:
+            flag = " REGRESSION"
+            failed.append(name)
+        print("{:14} {:12.1f} {:12.1f} {:+7.1f}%{}".format(name,b,ns,chg*100,flag))
+    return failed
+
+def main():
+    ap = argparse.ArgumentParser(description="benchmark per message functions")
+    ap.add_argument("-n",type=int,default=100000,help="calls of the fastest functions")
+    ap.add_argument("--ds_mb",type=int,default=None,help="datastore size in MB, default is the baselines' size")
+    ap.add_argument("--tolerance",type=float,default=None,help="allowed slow down, 0.25 for 25%%")
+    ap.add_argument("--save",action="store_true",help="save results as the new baselines")
+    ap.add_argument("--baseline",default=_baseline_fn,help="baselines json file")
+    ap.add_argument("--retries",type=int,default=2,help="times to re-run a benchmark slower than its baseline")
+    args = ap.parse_args()
+
+    base = {"tolerance":0.25, "baselines":{}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            base = json.load(f)
+    tolerance = args.tolerance
+    if tolerance == None:
+        tolerance = base.get("tolerance",0.25)
+
+    if args.ds_mb == None:
+        args.ds_mb = base.get("ds_mb",1024)
+    if not args.save and "ds_mb" in base and base["ds_mb"] != args.ds_mb:
+        print("bench: baselines were saved with a {} MB datastore, not {} MB, use --save to save new baselines".
+              format(base["ds_mb"],args.ds_mb))
+        return 1
+
+    print("bench: python {}, datastore {} MB".format(sys.version.split()[0],args.ds_mb))
+    tests = benchmarks(args.n,args.ds_mb)
+    results = bench(tests)
+
+    if args.save:
+        # baselines are the best of several runs
+        for i in range(args.retries):
+            for (name,ns) in bench(tests).items():
+                results[name] = min(results[name],ns)
+        base["baselines"] = results
+        base["saved"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        base["python"] = sys.version.split()[0]
+        base["ds_mb"] = args.ds_mb
+        with open(args.baseline,"w") as f:
+            json.dump(base,f,indent=2)
+            f.write("\n")
+        print("bench: saved baselines to",args.baseline)
+        return 0
+
+    # re-run regressions in case of a busy machine, keeping the best time
+    failed = compare(results,base["baselines"],tolerance)
+    for i in range(args.retries):
+        if len(failed) == 0:
+            break
+        print("bench: re-running",", ".join(failed))
+        for (name,ns) in bench([t for t in tests if t[0] in failed]).items():
+            results[name] = min(results[name],ns)
+        failed = compare(results,base["baselines"],tolerance)
+
+    if len(failed) > 0:
+        print("bench: FAILED, slower than baseline by more than {:.0f}%: {}".format(tolerance*100,", ".join(failed)))
+        return 1
+    print("bench: passed")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+'''
+    Benchmark PsosParms.get_parm
+
+    Compares get_parm using the resolved parameter dictionary
+    with the lookup chain of parms, then defaults, then config.
+
+    To run:  python bench_parms.py
+'''
+
+import timeit
+
+from ps_parms import PsosParms, PsosDefaults
+
+def make_parms(defaults):
+    config   = {"cust":"cust", "sys":"win01", "parms":"parms", "path":["base"]}
+    defaults.update({"sys":"win01", "services":{}, "config":config, "started":True})
+    svc = {"name":"d_get", "module":"mod_ds_get", "ds":"ds",
+           "sub":"{sys}/ds/get", "pub_stats":"{sys}/ds/stats", "workers":3}
+    return PsosParms(svc,defaults,config)
+
+def bench(n=200_000):
+    snap  = make_parms(PsosDefaults())
+    chain = make_parms({})
+
+    tests = [("parm",      "get_parm('workers')"),
+             ("formatted", "get_parm('sub')"),
+             ("default",   "get_parm('started')"),
+             ("config",    "get_parm('cust')"),
+             ("missing",   "get_parm('tz',-8)"),
+             ("contains",  "'pub_stats' in p")]
+
+    print("{:10} {:>10} {:>10} {:>8}".format("lookup","chain ns","snap ns","speedup"))
+    for (name,stmt) in tests:
+        t_chain = timeit.timeit(stmt.replace("get_parm","p.get_parm"),number=n,globals={"p":chain})
+        t_snap  = timeit.timeit(stmt.replace("get_parm","p.get_parm"),number=n,globals={"p":snap})
+        print("{:10} {:10.1f} {:10.1f} {:7.1f}x".format(name,t_chain/n*1e9,t_snap/n*1e9,t_chain/t_snap))
+
+if __name__ == '__main__':
+    bench()
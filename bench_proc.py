@@ -0,0 +1,171 @@
+'''
+    Worker Process Scaling Benchmark
+
+    Measures how message throughput scales with the number of worker
+    processes, see ps_proc. Boots psrpi_main with mod_mqtt connected to an
+    in-process fake broker, see ps_fake_mqtt, and runs a work service in
+    each worker process. Each work service subscribes to its own topic,
+    spends --work_us of CPU on each message and publishes an ack.
+    Messages are published round robin to the work topics and the
+    benchmark waits for every ack.
+
+    --procs 0 runs the work service in the main process, the baseline
+    for the cost of sending messages to and from the worker processes.
+
+    Reports for each number of worker processes:
+      - msgs/s  : messages acked per second
+      - speedup : msgs/s over msgs/s of the first --procs
+      - dropped : messages dropped by the links to the workers
+
+    Each result is appended as a json line to the --out file.
+
+    To run:  python bench_proc.py --procs 0,1,2,4 --count 20000
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from ps_mod import PsrpiModule
+import ps_fake_mqtt
+
+_host  = "bench_proc"
+_probe = None
+
+'''
+    Work service, run in each worker process, or with no "sub" parm
+    the probe the benchmark reaches the main process services through.
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+        self.sub     = self.get_parm("sub",None)
+        self.ack     = self.get_parm("ack","bench/ack")
+        self.work_us = self.get_parm("work_us",100)
+
+    async def run(self):
+        global _probe
+        if self.sub == None:
+            _probe = self
+            return
+
+        mqtt = self.get_mqtt()
+        q = asyncio.Queue()
+        await mqtt.subscribe(self.sub,q)
+
+        work_s = self.work_us / 1000000
+        while True:
+            data = await q.get()
+            t = time.perf_counter() + work_s
+            while time.perf_counter() < t:
+                pass
+            await mqtt.publish(self.ack,data[2])
+
+def make_parms(procs,args):
+    svc = [{"name":"mqtt", "module":"mod_mqtt", "client_module":"ps_fake_mqtt",
+            "host":_host, "print":False},
+           {"name":"probe", "module":"bench_proc"}]
+    for i in range(max(procs,1)):
+        p = {"name":"work{}".format(i), "module":"bench_proc", "sub":"bench/work/{}".format(i),
+             "work_us":args.work_us}
+        if procs > 0:
+            p["proc"] = i + 1
+        svc.append(p)
+    return {"name":"bench_proc", "main":"psrpi_main", "defaults":{"sys":"bench"}, "services":svc}
+
+async def bench(procs,args):
+    import bench_proc   # module psrpi_main runs the probe service from
+    import psrpi_main
+
+    parms = make_parms(procs,args)
+    n = max(procs,1)
+    main = asyncio.create_task(psrpi_main.main(parms,{"sys":"bench"}))
+
+    async with ps_fake_mqtt.Client(_host) as client:
+        acks = 0
+        done = asyncio.Event()
+
+        async def read_acks():
+            nonlocal acks
+            async with client.messages() as messages:
+                await client.subscribe("bench/ack")
+                async for msg in messages:
+                    acks += 1
+                    if acks >= args.count:
+                        done.set()
+
+        reader = asyncio.create_task(read_acks())
+
+        # wait for every work service to subscribe
+        t = time.perf_counter()
+        while True:
+            if bench_proc._probe != None:
+                subs = [s["filter"] for s in bench_proc._probe.get_mqtt().get_stats()["subs"]]
+                if all("bench/work/{}".format(i) in subs for i in range(n)):
+                    break
+            if time.perf_counter() - t > 60 or main.done():
+                raise RuntimeError("services did not start")
+            await asyncio.sleep(0.05)
+
+        print("bench: {} procs, publishing {} messages".format(procs,args.count))
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            await client.publish("bench/work/{}".format(i % n),str(i))
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+
+        try:
+            await asyncio.wait_for(done.wait(),args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        secs = time.perf_counter() - t0
+        reader.cancel()
+
+    workers = bench_proc._probe.get_defaults().get("proc_workers",{})
+    dropped = sum(w.get_stats()["dropped"] for w in workers.values())
+    bench_proc._probe = None
+    for w in workers.values():
+        w.proc.terminate()
+    main.cancel()
+    try:
+        await main
+    except asyncio.CancelledError:
+        pass
+
+    return {"procs":procs, "count":args.count, "acked":acks, "work_us":args.work_us,
+            "secs":round(secs,3), "msgs_s":round(acks/secs,1), "dropped":dropped}
+
+def main():
+    ap = argparse.ArgumentParser(description="psrpi worker process scaling benchmark")
+    ap.add_argument("--procs",   default="0,1,2,4", help="numbers of worker processes to run")
+    ap.add_argument("--count",   type=int,   default=20000, help="messages to publish")
+    ap.add_argument("--work_us", type=int,   default=100, help="us of CPU each message takes")
+    ap.add_argument("--timeout", type=float, default=120, help="seconds to wait for acks")
+    ap.add_argument("--out",     default="bench_proc.jsonl", help="file to append results to")
+    args = ap.parse_args()
+
+    dt = time.strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    for procs in [int(p) for p in args.procs.split(",")]:
+        results.append(asyncio.run(bench(procs,args)))
+
+    base = results[0]["msgs_s"]
+    print("bench: {} messages, {}us each, {} cpus".format(args.count,args.work_us,os.cpu_count()))
+    print("  {:>5} {:>10} {:>8} {:>8}".format("procs","msgs/s","speedup","dropped"))
+    for r in results:
+        r["speedup"] = round(r["msgs_s"] / base,2) if base > 0 else 0
+        print("  {:>5} {:>10} {:>8} {:>8}".format(r["procs"],r["msgs_s"],r["speedup"],r["dropped"]))
+
+    with open(args.out,"a") as f:
+        for r in results:
+            r.update({"dt":dt, "python":sys.version.split()[0]})
+            f.write(json.dumps(r))
+            f.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -44,5 +44,8 @@ except AttributeError:
     print("not windows")
     pass
 
-main = __import__(main_name)
-asyncio.run(main.main(parms,cfg))
+# worker processes started with multiprocessing "spawn"
+# import this file but must not start psrpi again, see ps_proc
+if __name__ == "__main__":
+    main = __import__(main_name)
+    asyncio.run(main.main(parms,cfg))
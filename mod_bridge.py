@@ -0,0 +1,258 @@
+"""
+    MQTT Bridge Module
+
+    Connects to two MQTT brokers, a and b, and forwards messages matching
+    the filters of each direction's rules to the other broker, rewriting
+    the topic prefix. For example, to bridge the LAN Mosquitto broker with
+    HiveMQ, with LAN topics under "lan/" on HiveMQ:
+        {"name":"bridge", "module":"mod_bridge", "host_a":"10.0.0.231", "host_b":"hivemq",
+         "a_to_b":[{"filter":"#", "to":"lan/"}],
+         "b_to_a":[{"filter":"lan/#", "from":"lan/", "to":""}]}
+
+    Loops - a forwarded message comes back from the broker it was sent to,
+    and would be forwarded again, when it also matches a rule of the
+    other direction, as "lan/#" above, or another bridge sends it back.
+    Each forwarded message's fingerprint, a hash of its payload and topic
+    without the rule prefixes, is kept for loop_ms with the broker it was sent
+    to. A message received from that broker with the fingerprint is dropped
+    instead of forwarded, once per message forwarded, so the bridge never
+    generates duplicates. The same message received again from the broker
+    it came from is a repeat, such as a sensor reading which has not
+    changed, and is forwarded.
+
+    Messages to forward are added to a queue for each direction and a
+    task publishes them in batches. It waits batch_ms for more messages,
+    drops repeats of a topic and payload in the batch, publishes at most
+    batch messages then, if rate is set, waits so at most rate messages a
+    second are published. A full queue drops its oldest message.
+    Messages wait in the queue while the other broker is not connected.
+
+    Module Parameters:
+      - host_a         : broker a host name. Default is "10.0.0.231".
+      - host_b         : broker b host name - required
+      - client_module  : module providing the asyncio_mqtt Client and MqttError.
+                         Default is "asyncio_mqtt", see mod_mqtt.
+      - a_to_b         : rules for messages from a to b, a list of
+                         {"filter":topic filter, "from":prefix removed, "to":prefix added}.
+                         "from" and "to" default to "". Default is none.
+      - b_to_a         : rules for messages from b to a. Default is none.
+      - queue          : most messages waiting in each direction. Default is 1000.
+      - batch          : most messages published at a time. Default is 100.
+      - batch_ms       : time to wait for more messages before publishing. Default is 10.
+      - rate           : most messages a second published in each direction, 0 for no limit. Default is 0.
+      - loop_ms        : time fingerprints are kept. Default is 5000.
+      - retain         : forward the retain flag. Default is true.
+      - reconnect_secs : time between connection attempts. Default is 5.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import collections
+import importlib
+import time
+
+from ps_util import to_str, to_bytes
+from ps_subscr import Subscription
+
+# A rule forwarding messages matching filter, replacing prefix frm with to
+class Rule:
+
+    def __init__(self, filter, frm="", to=""):
+        self.subscr = Subscription(filter,None)
+        self.frm = frm
+        self.to  = to
+
+    # return topic rewritten, None if the rule does not match
+    def rewrite(self,topic,t_split):
+        if not topic.startswith(self.frm) or not self.subscr.filter_match(t_split):
+            return None
+        return self.to + topic[len(self.frm):]
+
+# Messages forwarded from broker src to broker dest
+class Direction:
+
+    def __init__(self, src, dest, rules, queue):
+        self.src   = src
+        self.dest  = dest
+        self.rules = [Rule(r["filter"],r.get("from",""),r.get("to","")) for r in rules]
+        self.q     = collections.deque(maxlen=queue)    # (topic,payload,retain,pending entry)
+        self.ready = asyncio.Event()
+
+        self.rcvd    = 0
+        self.fwd     = 0
+        self.loops   = 0
+        self.dups    = 0
+        self.dropped = 0
+
+    def get_stats(self):
+        return {"rcvd":self.rcvd, "fwd":self.fwd, "loops":self.loops, "dups":self.dups,
+                "dropped":self.dropped, "qsize":len(self.q)}
+
+'''
+    MQTT Bridge Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.hosts = {"a":self.get_parm("host_a","10.0.0.231"), "b":self.get_parm("host_b",None)}
+        queue = self.get_parm("queue",1000)
+        self.dirs = {"a":Direction("a","b",self.get_parm("a_to_b",[]),queue),
+                     "b":Direction("b","a",self.get_parm("b_to_a",[]),queue)}
+
+        self.batch     = self.get_parm("batch",100)
+        self.batch_ms  = self.get_parm("batch_ms",10)
+        self.rate      = self.get_parm("rate",0)
+        self.loop_secs = self.get_parm("loop_ms",5000) / 1000
+        self.retain    = self.get_parm("retain",True)
+        self.reconnect = self.get_parm("reconnect_secs",5)
+
+        # prefixes added to topics sent to each broker, removed to fingerprint
+        self.prefixes = {"a":self._prefixes(self.dirs["b"]), "b":self._prefixes(self.dirs["a"])}
+
+        self._clients = {"a":None, "b":None}
+        self._connected = {"a":asyncio.Event(), "b":asyncio.Event()}
+
+        # Each message forwarded has a pending entry [expire time, (dest, fingerprint), live]
+        # until it is seen back from broker dest, expires or is dropped before it was sent.
+        # (dest, fingerprint): deque of its live entries, oldest first
+        self._pending = {}
+        self._expire  = collections.deque()     # entries in the order they expire
+
+    # return the prefixes a direction adds, longest first
+    def _prefixes(self,d):
+        return sorted(set(r.to for r in d.rules if r.to != ""),key=len,reverse=True)
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    async def run(self):
+        if self.hosts["b"] == None:
+            return await self.fatal_err("{} exiting - no broker b (host_b) specified".format(self._name))
+
+        aiomqtt = importlib.import_module(self.get_parm("client_module","asyncio_mqtt"))
+
+        self._tasks = [asyncio.create_task(self.connect(aiomqtt,"a")),
+                       asyncio.create_task(self.connect(aiomqtt,"b")),
+                       asyncio.create_task(self.forward(self.dirs["a"])),
+                       asyncio.create_task(self.forward(self.dirs["b"]))]
+        await asyncio.gather(*self._tasks)
+
+    # connect to broker side, reconnecting when the connection is lost
+    async def connect(self,aiomqtt,side):
+        d = self.dirs[side]
+        while True:
+            try:
+                async with aiomqtt.Client(self.hosts[side]) as client:
+                    print("{}: connected to {}".format(self._name,self.hosts[side]))
+                    async with client.messages() as messages:
+                        for r in d.rules:
+                            await client.subscribe(r.subscr._filter)
+                        self._clients[side] = client
+                        self._connected[side].set()
+                        async for msg in messages:
+                            self.receive(d,to_str(msg.topic),msg.payload,msg.retain)
+
+            except aiomqtt.MqttError as error:
+                print('{}: {} error "{}". Reconnecting in {} seconds.'.
+                      format(self._name,self.hosts[side],error,self.reconnect))
+            finally:
+                self._clients[side] = None
+                self._connected[side].clear()
+            await asyncio.sleep(self.reconnect)
+
+    # return the fingerprint of a message received from side
+    def fingerprint(self,side,topic,payload):
+        for p in self.prefixes[side]:
+            if topic.startswith(p):
+                topic = topic[len(p):]
+                break
+        return hash((topic,to_bytes(payload)))
+
+    # forget a message forwarded which was seen back, expired or will not be sent
+    def _unpend(self,entry):
+        if not entry[2]:
+            return
+        entry[2] = False
+        entries = self._pending[entry[1]]
+        entries.remove(entry)
+        if len(entries) == 0:
+            del self._pending[entry[1]]
+
+    # queue a message received on the direction's source broker to forward
+    def receive(self,d,topic,payload,retain=False):
+        d.rcvd += 1
+
+        # remove fingerprints of messages not seen back in time
+        now = time.monotonic()
+        while len(self._expire) > 0 and self._expire[0][0] < now:
+            self._unpend(self._expire.popleft())
+
+        fp = self.fingerprint(d.src,topic,payload)
+        entries = self._pending.get((d.src,fp))
+        if entries != None:
+            d.loops += 1
+            self._unpend(entries[0])
+            return
+
+        t_split = topic.split('/')
+        for r in d.rules:
+            t = r.rewrite(topic,t_split)
+            if t != None:
+                if len(d.q) == d.q.maxlen:
+                    d.dropped += 1
+                    self._unpend(d.q[0][3])
+                entry = [now + self.loop_secs,(d.dest,fp),True]
+                d.q.append((t,payload,retain and self.retain,entry))
+                self._pending.setdefault(entry[1],collections.deque()).append(entry)
+                self._expire.append(entry)
+                d.ready.set()
+                return
+
+    # publish queued messages of direction d in batches
+    async def forward(self,d):
+        while True:
+            await d.ready.wait()
+            await self._connected[d.dest].wait()
+            if self.batch_ms > 0:
+                await asyncio.sleep(self.batch_ms / 1000)
+
+            batch = []
+            seen = set()
+            while len(d.q) > 0 and len(batch) < self.batch:
+                m = d.q.popleft()
+                if (m[0],m[1]) in seen:
+                    d.dups += 1
+                    self._unpend(m[3])
+                    continue
+                seen.add((m[0],m[1]))
+                batch.append(m)
+            if len(d.q) == 0:
+                d.ready.clear()
+
+            client = self._clients[d.dest]
+            for (i,(topic,payload,retain,entry)) in enumerate(batch):
+                try:
+                    await client.publish(topic,to_bytes(payload),retain=retain)
+                    d.fwd += 1
+                except Exception as e:
+                    # put back to send after reconnecting
+                    for m in reversed(batch[i:]):
+                        d.q.appendleft(m)
+                    d.ready.set()
+                    print("{}: publish to {} failed {}".format(self._name,self.hosts[d.dest],e))
+                    await asyncio.sleep(self.reconnect)
+                    break
+
+            if self.rate > 0:
+                await asyncio.sleep(len(batch) / self.rate)
+
+    def get_stats(self):
+        return {"a_to_b":self.dirs["a"].get_stats(), "b_to_a":self.dirs["b"].get_stats(),
+                "connected":{s:self._clients[s] != None for s in self._clients},
+                "pending":len(self._pending)}
@@ -0,0 +1,341 @@
+"""
+    Document Store Module
+
+    Saves MQTT messages as documents in MongoDB, or a stand in for it.
+
+    Messages for the filters in subs with a json payload are converted to documents
+        {"_id":..., "topic":topic, "ts":seconds since the epoch, "dt":date time, "data":payload}
+    Messages with other payloads are saved with "payload" set to the payload string
+    instead of "data" if raw is true, otherwise they are counted and skipped.
+
+    Documents are added to a batch which is inserted with one bulk insert once it
+    has batch documents, or batch_ms after its first document. Inserts are run in a
+    thread so a slow store does not hold up the event loop.
+
+    A batch which fails to insert is appended to the spool file, one json line per
+    batch, and inserts stop. Every retry_secs the spooled batches are inserted again,
+    oldest first, and once they are all inserted new batches are inserted as before.
+    A batch is spooled without being inserted while the spool is not empty, so
+    documents are inserted in the order they were received. Each document's _id
+    is set when it is received so a batch inserted again is not saved twice.
+    Once the spool reaches spool_mb new batches are dropped and counted.
+    A spool line which is not a batch, such as a last line cut short by a crash,
+    is moved to the file spool + ".bad" and counted.
+
+    Stores:
+      - mongo     : MongoDB using pymongo. uri may contain {username} and {password}
+                    which are set from ps_secrets.mongodb[secret].
+      - mongomock : in memory MongoDB from the mongomock package, for testing.
+      - memory    : MemoryStore below, for testing without either package.
+    pymongo and mongomock are only imported when run() is called.
+
+    Module Parameters:
+      - subs       : list of topic filters to save. Default is ["#"].
+      - store      : "mongo", "mongomock" or "memory". Default is "mongo".
+      - uri        : MongoDB connection string. Default is "mongodb://localhost:27017".
+      - secret     : name of ps_secrets.mongodb entry with username and password - optional
+      - db         : database name. Default is "psrpi".
+      - collection : collection name. Default is "mqtt".
+      - raw        : save payloads which are not json. Default is false.
+      - batch      : most documents inserted at a time. Default is 100.
+      - batch_ms   : longest time a document waits to be inserted. Default is 1000.
+      - spool      : spool file name. Default is "docstore_spool.jsonl".
+      - spool_mb   : largest spool file size. Default is 64.
+      - retry_secs : time between attempts to insert spooled batches. Default is 10.
+      - timeout_ms : MongoDB server selection timeout. Default is 5000.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import time
+
+from ps_util import to_str, file_sz
+import ps_codec
+from ps_stats import Histogram
+
+# seconds over which docs_sec is measured
+RATE_SECS = 10
+
+# Collection kept in memory with insert_many like pymongo.
+# Set down to True to make inserts fail.
+class MemoryStore:
+
+    def __init__(self):
+        self.docs = {}
+        self.down = False
+
+    def insert_many(self,docs):
+        if self.down:
+            raise ConnectionError("memory store is down")
+        for d in docs:
+            # as MongoDB, an _id already saved is not saved again
+            if not d["_id"] in self.docs:
+                self.docs[d["_id"]] = d
+
+    def count(self):
+        return len(self.docs)
+
+# pymongo or mongomock collection
+class MongoStore:
+
+    def __init__(self, mongo, coll):
+        self.coll = coll
+        self.bulk_error = mongo.BulkWriteError
+
+    def insert_many(self,docs):
+        try:
+            # copies as insert_many adds an _id to documents without one
+            self.coll.insert_many([dict(d) for d in docs],ordered=False)
+        except self.bulk_error as e:
+            # documents already inserted by an earlier attempt
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors",[])):
+                raise
+
+    def count(self):
+        return self.coll.count_documents({})
+
+'''
+    Document Store Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.subs       = self.get_parm("subs",["#"])
+        self.raw        = self.get_parm("raw",False)
+        self.batch      = self.get_parm("batch",100)
+        self.batch_ms   = self.get_parm("batch_ms",1000)
+        self.spool      = self.get_parm("spool","docstore_spool.jsonl")
+        self.spool_sz   = self.get_parm("spool_mb",64) * 1024 * 1024
+        self.retry_secs = self.get_parm("retry_secs",10)
+
+        self.store = None
+        self._docs = []
+        self._full = asyncio.Event()
+        self._id_base = "{:x}".format(time.time_ns())
+        self._seq = 0
+
+        self.inserted  = 0
+        self.batches   = 0
+        self.skipped   = 0
+        self.spooled   = 0
+        self.replayed  = 0
+        self.dropped   = 0
+        self.bad       = 0      # spool lines which were not a batch
+        self.errors    = 0
+        self.insert_ms = Histogram()
+        self._rate = [time.monotonic(),0,0]   # window start time, inserted then and docs_sec
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    # return the store named by the store parm
+    def open_store(self):
+        store = self.get_parm("store","mongo")
+        if store == "memory":
+            return MemoryStore()
+
+        if store == "mongomock":
+            mongo = importlib.import_module("mongomock")
+            client = mongo.MongoClient()
+        else:
+            mongo = importlib.import_module("pymongo")
+            uri = self.get_parm("uri","mongodb://localhost:27017")
+            secret = self.get_parm("secret",None)
+            if secret != None:
+                import ps_secrets
+                uri = uri.format(**ps_secrets.mongodb[secret])
+            client = mongo.MongoClient(uri,serverSelectionTimeoutMS=self.get_parm("timeout_ms",5000))
+            mongo = mongo.errors
+
+        coll = client[self.get_parm("db","psrpi")][self.get_parm("collection","mqtt")]
+        return MongoStore(mongo,coll)
+
+    async def run(self):
+        mqtt = self.get_mqtt()
+
+        try:
+            self.store = self.open_store()
+        except (ImportError,KeyError) as e:
+            return await self.fatal_err("{} exiting - can not open store {}".format(self._name,e))
+
+        self._flush_task = asyncio.create_task(self.flush())
+
+        q = asyncio.Queue()
+        for f in self.subs:
+            await mqtt.subscribe(f,q)
+
+        while True:
+            data = await q.get()
+            self.add(data[1],data[2])
+
+    # add a message to the batch
+    def add(self,topic,payload):
+        payload = ps_codec.to_text(payload)
+        doc = {"_id":None, "topic":to_str(topic), "ts":time.time(), "dt":self.get_dt()}
+        try:
+            doc["data"] = json.loads(payload)
+        except ValueError:
+            if not self.raw:
+                self.skipped += 1
+                return
+            doc["payload"] = payload
+
+        self._seq += 1
+        doc["_id"] = "{}-{}".format(self._id_base,self._seq)
+        self._docs.append(doc)
+        if len(self._docs) >= self.batch:
+            self._full.set()
+
+    # insert batches every batch_ms or when full
+    async def flush(self):
+        retry = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(),self.batch_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            # keep flushing, documents are added until it is stopped
+            try:
+                retry = await self.flush_batches(retry)
+            except Exception as e:
+                self.errors += 1
+                retry = time.monotonic() + self.retry_secs
+                print("{}: flush failed {}".format(self._name,e))
+
+    # Insert spooled batches, if it is time to retry them, then the documents
+    # waiting. Returns the time to next retry the spooled batches.
+    async def flush_batches(self,retry):
+        # spooled batches are inserted before new ones
+        if file_sz(self.spool) > 0 and time.monotonic() >= retry:
+            if not await self.replay():
+                retry = time.monotonic() + self.retry_secs
+
+        # Documents added while inserting wait for the next batch.
+        # A batch is only removed once it is inserted or spooled,
+        # so stop() spools it if the flush is cancelled.
+        n = len(self._docs)
+        while n > 0:
+            docs = self._docs[:min(n,self.batch)]
+            n -= len(docs)
+
+            if file_sz(self.spool) == 0 and await self.insert(docs):
+                del self._docs[:len(docs)]
+                continue
+            await asyncio.to_thread(self.spool_batch,docs)
+            del self._docs[:len(docs)]
+            if retry < time.monotonic():
+                retry = time.monotonic() + self.retry_secs
+        return retry
+
+    # insert docs, returning False if the insert failed
+    async def insert(self,docs):
+        t = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.store.insert_many,docs)
+        except Exception as e:
+            self.errors += 1
+            print("{}: insert of {} documents failed {}".format(self._name,len(docs),e))
+            return False
+
+        self.insert_ms.add((time.perf_counter() - t) * 1000)
+        self.inserted += len(docs)
+        self.batches += 1
+        return True
+
+    # append a batch to the spool, dropping it if it can not be written
+    def spool_batch(self,docs):
+        if file_sz(self.spool) >= self.spool_sz:
+            self.dropped += len(docs)
+            return
+        try:
+            with open(self.spool,"a") as f:
+                f.write(json.dumps(docs))
+                f.write('\n')
+        except OSError as e:
+            print("{}: spool of {} documents failed {}".format(self._name,len(docs),e))
+            self.dropped += len(docs)
+            return
+        self.spooled += len(docs)
+
+    # Insert spooled batches, returning True once all are inserted.
+    # Batches not inserted are kept in the spool,
+    # lines which are not a batch are moved to the bad file.
+    async def replay(self):
+        tmp = self.spool + ".tmp"
+        done = True
+        f = await asyncio.to_thread(open,self.spool)
+        try:
+            while True:
+                ln = await asyncio.to_thread(f.readline)
+                if ln == "":
+                    break
+                try:
+                    docs = json.loads(ln)
+                except ValueError:
+                    docs = None
+                if not isinstance(docs,list) or not all(isinstance(d,dict) for d in docs):
+                    self.bad += 1
+                    await asyncio.to_thread(self.spool_bad,ln)
+                    continue
+
+                if not await self.insert(docs):
+                    # keep this and the following batches
+                    await asyncio.to_thread(self.spool_rest,ln,f,tmp)
+                    done = False
+                    break
+                self.replayed += len(docs)
+        finally:
+            f.close()
+
+        if done:
+            await asyncio.to_thread(os.remove,self.spool)
+        else:
+            await asyncio.to_thread(os.replace,tmp,self.spool)
+        return done
+
+    # write spool line ln and the rest of spool file f to tmp
+    def spool_rest(self,ln,f,tmp):
+        with open(tmp,"w") as f_tmp:
+            f_tmp.write(ln)
+            shutil.copyfileobj(f,f_tmp)
+
+    # append a spool line which is not a batch to the bad file
+    def spool_bad(self,ln):
+        print("{}: spool line is not a batch {}".format(self._name,ln[:80]))
+        with open(self.spool + ".bad","a") as f:
+            f.write(ln.rstrip('\n'))
+            f.write('\n')
+
+    # spool documents not yet inserted when stopped by a reload,
+    # they are inserted by the next run()
+    async def stop(self):
+        await super().stop()
+        if len(self._docs) > 0:
+            await asyncio.to_thread(self.spool_batch,self._docs)
+            self._docs = []
+
+    # return insert statistics, docs_sec is the insert rate
+    # over the last window of at least RATE_SECS
+    def get_stats(self):
+        now = time.monotonic()
+        (t,n,rate) = self._rate
+        if now - t >= RATE_SECS:
+            rate = round((self.inserted - n) / (now - t),1)
+            self._rate = [now,self.inserted,rate]
+        return {"inserted":self.inserted, "batches":self.batches, "skipped":self.skipped,
+                "spooled":self.spooled, "replayed":self.replayed, "dropped":self.dropped,
+                "bad":self.bad, "errors":self.errors, "waiting":len(self._docs), "spool_kb":file_sz(self.spool) // 1024,
+                "docs_sec":rate,
+                "insert_ms":self.insert_ms.summary()}
@@ -17,6 +17,22 @@
       - fn      : name of primary file
       - fn_idx  : index file name
       - sub_req : topic for which read requests can be made.
+      - blk_rows  : number of rows in a block. Default is 256.
+      - blk_cache : number of complete blocks to keep in memory. Default is 32.
+      - hot       : true to keep new rows in memory and write them to the files
+                    in large chunks, see ps_hot. Default is false.
+      - hot_dir   : directory for the hot tier journal, on a tmpfs such as /dev/shm,
+                    so rows in memory survive a restart. Default is none, no journal.
+      - hot_kb    : rows in memory are written once they reach this size. Default is 1024.
+      - hot_secs  : rows in memory are written at least this often. Default is 60,
+                    the most rows lost if the Pi loses power.
+
+    Rows are grouped into blocks of blk_rows rows, block n holding rows
+    n*blk_rows to (n+1)*blk_rows-1. get_block returns a DsBlock for a block.
+    Complete blocks are cached along with any payload fields parsed from them,
+    so repeated queries over the same rows do not re-read or re-parse them.
+    read_block and read_page read rows from the files in a thread so
+    services reading the datastore do not hold up the event loop.
     
 """
 
@@ -24,15 +40,161 @@ from ps_mod import PsrpiModule
 import asyncio
 # import queue
 import gc
+import itertools
 
 from ps_util import to_str,to_bytes,file_sz, sleep_ms
 import ps_util
 from ps_subscr import Subscription
 import struct
 import os
+import json
+import mmap
+import time
+
+import ps_pred
+import ps_codec
+from ps_fts import TokenIndex
+from ps_zone import ZoneMap
+from ps_stats import Histogram
+from ps_hot import HotTier
+from ps_trace import Stages
+
+# return the date time of a data file row as seconds since the epoch,
+# None if the row does not start with a valid date time
+def _row_secs(ln):
+    try:
+        return ps_util.dt_secs(ln.split(b'\t',1)[0].decode("utf-8"))
+    except (ValueError,UnicodeDecodeError):
+        return None
+
+# Memory mapped view of an index file
+# giving the data file position of each row.
+# Use as a context manager so the map is closed:
+#   with DsIdx(fn_idx) as idx:
+#       pos = idx[row]
+class DsIdx:
+
+    def __init__(self, fn_idx):
+        self._f  = open(fn_idx,"rb")
+        self._mm = None
+        self._idx = []
+
+        n = file_sz(fn_idx) // 4
+        if n > 0:
+            self._mm = mmap.mmap(self._f.fileno(),n*4,access=mmap.ACCESS_READ)
+            self._idx = memoryview(self._mm).cast('i')
+
+    def __len__(self):
+        return len(self._idx)
+
+    def __getitem__(self,row):
+        return self._idx[row]
+
+    def close(self):
+        if self._mm != None:
+            self._idx.release()
+            self._mm.close()
+            self._mm = None
+            self._idx = []
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+# A block of rows read from the data store.
+# Topics, parsed payloads and payload field columns
+# are created the first time they are needed.
+class DsBlock:
+
+    def __init__(self, start, lines):
+        self.start = start
+        self.lines = lines
+        self._topics   = None
+        self._raw      = None
+        self._payloads = None
+        self._times    = None
+        self._cols     = {}
+        self._tmatch   = {}
+
+    def __len__(self):
+        return len(self.lines)
+
+    def _split(self):
+        self._topics = []
+        self._raw = []
+        for ln in self.lines:
+            r = ln.split('\t',2)
+            while len(r) < 3:
+                r.append("")
+            self._topics.append(r[1])
+            self._raw.append(r[2])
+
+    def topics(self):
+        if self._topics == None:
+            self._split()
+        return self._topics
+
+    # return list of payloads parsed as json,
+    # None for payloads which are not json objects
+    def payloads(self):
+        if self._payloads == None:
+            if self._topics == None:
+                self._split()
+
+            pl = []
+            for p in self._raw:
+                v = None
+                if p.startswith('{'):
+                    try:
+                        v = json.loads(p)
+                    except ValueError:
+                        pass
+                pl.append(v)
+            self._payloads = pl
+
+        return self._payloads
+
+    # return list of bool, one per row, True if the row topic
+    # matches the Subscription subscr
+    def topic_match(self,subscr):
+        m = self._tmatch.get(subscr._filter)
+        if m == None:
+            m = [subscr.filter_match(t.split('/')) for t in self.topics()]
+            self._tmatch[subscr._filter] = m
+        return m
+
+    # return list of row date times as seconds since the epoch,
+    # None for rows without a valid date time
+    def times(self):
+        if self._times == None:
+            self._times = []
+            for ln in self.lines:
+                try:
+                    self._times.append(ps_util.dt_secs(ln.split('\t',1)[0]))
+                except ValueError:
+                    self._times.append(None)
+        return self._times
+
+    def num_col(self,field):
+        k = ('n',field)
+        if not k in self._cols:
+            self._cols[k] = ps_pred.num_column(self.payloads(),field)
+        return self._cols[k]
+
+    def str_col(self,field):
+        k = ('s',field)
+        if not k in self._cols:
+            self._cols[k] = ps_pred.str_column(self.payloads(),field)
+        return self._cols[k]
     
 # All initialization classes are named ModuleService
 class ModuleService(PsrpiModule):
+
+    # ready once token index and zone map are loaded
+    ready_on_start = False
     
     def __init__(self, parms):
         super().__init__(parms)
@@ -41,36 +203,219 @@ class ModuleService(PsrpiModule):
         self.fn     = self.get_parm("fn","mqtt_dat.txt")
         self.fn_idx = self.get_parm("fn_idx","mqtt_idx.txt")
 
+        self.blk_rows  = self.get_parm("blk_rows",256)
+        self.blk_cache = self.get_parm("blk_cache",32)
+        self._blks = {}
+
+        self.fts = None
+        if self.get_parm("fts",False):
+            self.fts = TokenIndex(self.get_parm("fn_fts","mqtt_fts.txt"))
+        self.fts_secs = self.get_parm("fts_secs",300)
+
+        self.zone = None
+        if self.get_parm("zone",False):
+            self.zone = ZoneMap(self.get_parm("fn_zone","mqtt_zone.txt"),self.blk_rows,
+                                self.get_parm("zone_fields",[]))
+
+        self.hot = None
+        if self.get_parm("hot",False):
+            hot_dir = self.get_parm("hot_dir",None)
+            journal = None
+            if hot_dir != None:
+                journal = os.path.join(hot_dir,os.path.basename(self.fn) + ".hot")
+            self.hot = HotTier(self.fn,self.fn_idx,journal,
+                               self.get_parm("hot_kb",1024) * 1024,self.get_parm("hot_secs",60))
+
+        # rows and bytes saved and time to save each row
+        self.saved   = 0
+        self.bytes   = 0
+        self.save_ms = Histogram()
+
+        # ms from receive to taken off the queue and to saved, see ps_trace
+        self.lat = Stages(self._name)
+
     # Save all MQTT messages for the defined filter
     async def run(self):
         mqtt = self.get_mqtt()
 
-        q = asyncio.Queue()
-        await mqtt.subscribe(self.sub,q)
+        if self.hot != None:
+            n = self.hot.recover()
+            if n > 0:
+                print("{}: {} rows recovered from hot tier".format(self._name,n))
+            self._hot_task = asyncio.create_task(self.hot.run())
+
+        # services waiting for ds are told if it can not start
+        try:
+            await self.load_indexes()
+            if self.fts != None:
+                self._fts_task = asyncio.create_task(self.compact_fts())
+
+            q = asyncio.Queue()
+            await mqtt.subscribe(self.sub,q)
+        except Exception as e:
+            self.set_failed(e)
+            raise
+        self.set_ready()
 
         while True:
             data = await q.get()
+            self.lat.mark("queue",data)
             await self.save_data(data[1],data[2])
+            self.lat.mark("saved",data)
     
     # save message
     async def save_data(self,topic,payload):
+        if self.hot != None:
+            return self.save_hot(topic,payload)
+
+        row = file_sz(self.fn_idx) // 4
         self.write_idx()
         
         await sleep_ms(0)
 
+        t = time.perf_counter()
+        dt = self.get_dt()
         f = open(self.fn,"a")
-        f.write(self.get_dt())
+        f.write(dt)
         f.write('\t')
         f.write(to_str(topic))
         f.write('\t')
         
         # remove newline - messes log file
-        s = to_str(payload).replace("\\n","↵")
+        s = ps_codec.to_text(payload).replace("\\n","↵")
         s = s.replace("\n","↵")
         f.write(s)
         
         f.write('\n')
         f.close()
+
+        self.saved += 1
+        self.bytes += len(dt) + len(to_str(topic)) + len(s) + 3
+        self.save_ms.add((time.perf_counter() - t) * 1000)
+
+        if self.fts != None:
+            self.fts.add(row,to_str(topic),s)
+        if self.zone != None:
+            self.zone.add(ps_util.dt_secs(dt),to_str(topic),s)
+
+    # save message to the hot tier
+    def save_hot(self,topic,payload):
+        t = time.perf_counter()
+        dt = self.get_dt()
+        topic = to_str(topic)
+        s = ps_codec.to_text(payload).replace("\\n","↵").replace("\n","↵")
+        row = self.hot.append(dt + '\t' + topic + '\t' + s)
+
+        self.saved += 1
+        self.bytes += len(dt) + len(topic) + len(s) + 3
+        self.save_ms.add((time.perf_counter() - t) * 1000)
+
+        if self.fts != None:
+            self.fts.add(row,topic,s)
+        if self.zone != None:
+            self.zone.add(ps_util.dt_secs(dt),topic,s)
+
+    # load token index and zone map and add any rows
+    # saved since they were written
+    async def load_indexes(self):
+        fts  = self.fts
+        zone = self.zone
+        if fts == None and zone == None:
+            return
+
+        start = self.row_cnt()
+        if fts != None:
+            await asyncio.to_thread(fts.load)
+            start = min(start,fts.rows)
+        if zone != None:
+            await asyncio.to_thread(zone.load)
+            start = min(start,zone.rows())
+
+        secs = 0
+        for (row,ln) in self.iter_rows(start):
+            r = ln.split('\t',2)
+            while len(r) < 3:
+                r.append("")
+
+            if fts != None and row >= fts.rows:
+                fts.add(row,r[1],r[2])
+
+            if zone != None and row >= zone.rows():
+                try:
+                    secs = ps_util.dt_secs(r[0])
+                except ValueError:
+                    pass
+                zone.add(secs,r[1],r[2])
+
+            if row % 1000 == 0:
+                await sleep_ms(0)
+
+        print("{}: indexes loaded, {} rows re-indexed".format(self._name,self.row_cnt()-start))
+
+    # write rows in the hot tier to the files when stopped by a reload
+    async def stop(self):
+        await super().stop()
+        if self.hot != None:
+            await self.hot.close()
+
+    # return save statistics
+    def get_stats(self):
+        stats = {"rows":self.row_cnt(), "saved":self.saved, "bytes":self.bytes,
+                 "save_ms":self.save_ms.summary(), "lat_ms":self.lat.summary(),
+                 "blks":len(self._blks)}
+        if self.hot != None:
+            stats["hot"] = self.hot.get_stats()
+        return stats
+
+    # return False if block blk_no can not contain a row matching
+    # the topic filter in subscr, predicate pred and date time range
+    def may_match(self,blk_no,subscr=None,pred=None,t_from=None,t_to=None):
+        if self.zone == None:
+            return True
+        return self.zone.may_match(blk_no,subscr,pred,t_from,t_to)
+
+    # periodically merge new rows into the token index and save it
+    async def compact_fts(self):
+        while True:
+            await asyncio.sleep(self.fts_secs)
+            if self.fts.delta_len() > 0:
+                self.fts.compact()
+                await asyncio.to_thread(self.fts.write,self.fts.rows)
+
+    # Return up to n (row,line) for rows containing all tokens in terms,
+    # newest first, starting before row before, read in a thread
+    async def search_rows(self,terms,before,n):
+        return await asyncio.to_thread(self._search_rows,terms,before,n)
+
+    def _search_rows(self,terms,before,n):
+        found = self.search(terms,before)
+        try:
+            return list(itertools.islice(found,n))
+        finally:
+            found.close()
+
+    # Generator of (row,line) for rows containing all tokens in terms,
+    # newest first, starting before row before.
+    def search(self,terms,before=None):
+        with DsIdx(self.fn_idx) as idx, open(self.fn,"rb") as f:
+            for row in self.fts.search(terms,before):
+                ln = self._read_row(row,idx,f)
+                # row indexed after the index map was opened
+                if ln == None:
+                    continue
+                yield (row,ln.decode("utf-8").rstrip())
+
+    # Return row as bytes from the hot tier or the open DsIdx idx
+    # and data file f, None if the row is in neither
+    def _read_row(self,row,idx,f):
+        if self.hot != None:
+            ln = self.hot.line(row)
+            if ln != None:
+                return ln
+        if row >= len(idx):
+            return None
+        f.seek(idx[row])
+        return f.readline()
                         
     # write the current size (next position to write) 
     # as a 4 byte int to the index file
@@ -86,7 +431,53 @@ class ModuleService(PsrpiModule):
         EXTERNAL ONLY METHODS
     '''
     def max_idx(self):
+        if self.hot != None:
+            return self.hot.rows() - 1
         return int(round(file_sz(self.fn_idx)/4) - 1)
+
+    # return number of rows in the data store
+    def row_cnt(self):
+        return self.max_idx() + 1
+
+    # Return DsBlock blk_no, or None if past the last row.
+    # Only complete blocks are cached since the last block
+    # grows as rows are added.
+    def get_block(self,blk_no):
+        blk = self._cached_block(blk_no)
+        if blk == None:
+            blk = self._cache_block(blk_no,self._load_block(blk_no))
+        return blk
+
+    # get_block reading a block which is not cached in a thread
+    async def read_block(self,blk_no):
+        blk = self._cached_block(blk_no)
+        if blk == None:
+            blk = self._cache_block(blk_no,await asyncio.to_thread(self._load_block,blk_no))
+        return blk
+
+    def _cached_block(self,blk_no):
+        blk = self._blks.pop(blk_no,None)
+        if blk != None:
+            # move to end of the least recently used order
+            self._blks[blk_no] = blk
+        return blk
+
+    # read block blk_no, None if past the last row.
+    # Does not use the cache so can be run in a thread.
+    def _load_block(self,blk_no):
+        start = blk_no * self.blk_rows
+        pos = self._get_idx_pos(start)
+        if pos < 0:
+            return None
+        return DsBlock(start,self._get_blk(pos,self.blk_rows))
+
+    # cache blk if it is complete, returning it
+    def _cache_block(self,blk_no,blk):
+        if blk != None and len(blk) == self.blk_rows:
+            self._blks[blk_no] = blk
+            if len(self._blks) > self.blk_cache:
+                del self._blks[next(iter(self._blks))]
+        return blk
     
     # Return a page of row entries starting at entry init_pos,
     # where init_pos is the index number of a line in the data file where
@@ -113,8 +504,7 @@ class ModuleService(PsrpiModule):
 
         prev_idx = start - 1
 
-        pos = self._get_idx_pos(start)
-        result = self._get_blk(pos,blk_cnt)
+        result = await self._read_rows(start,blk_cnt)
 
         next_idx = start + len(result)
         if next_idx > self.max_idx():
@@ -135,18 +525,131 @@ class ModuleService(PsrpiModule):
         else:
             prev_idx = init_pos - 1
 
-        pos = self._get_idx_pos(init_pos)
-        result = self._get_blk(pos,blk_cnt)
+        result = await self._read_rows(init_pos,blk_cnt)
         next_idx = init_pos + len(result)
         if next_idx > self.max_idx():
             next_idx = 0
 
         return (prev_idx,result,next_idx)
 
+    # Return blk_cnt rows from row start, read in a thread
+    # unless they are all in the hot tier
+    async def _read_rows(self,start,blk_cnt):
+        if self.hot != None and start >= self.hot.base_rows:
+            return self._get_rows(start,blk_cnt)
+        return await asyncio.to_thread(self._get_rows,start,blk_cnt)
+
+    def _get_rows(self,start,blk_cnt):
+        return self._get_blk(self._get_idx_pos(start),blk_cnt)
+
+    # Generator returning (row,line) for rows start up to but not including end.
+    # Rows are read from the data file in chunk byte reads so memory use
+    # does not depend on the number of rows. end of None reads to the last row.
+    def iter_rows(self,start=0,end=None,chunk=1<<20):
+        if self.hot == None:
+            yield from self._iter_file(start,end,chunk)
+            return
+
+        hot = self.hot
+        if end == None or end > hot.rows():
+            end = hot.rows()
+        row = max(start,0)
+        while row < end:
+            # rows may move to the files while iterating
+            base = hot.base_rows
+            if row < base:
+                for r in self._iter_file(row,min(end,base),chunk):
+                    yield r
+                row = min(end,base)
+                continue
+
+            lines = hot.lines(row,end)
+            if lines == None:
+                continue
+            for ln in lines:
+                yield (row,ln)
+                row += 1
+            break
+
+    # iter_rows of rows in the data file
+    def _iter_file(self,start=0,end=None,chunk=1<<20):
+        with DsIdx(self.fn_idx) as idx:
+            n = len(idx)
+            if end == None or end > n:
+                end = n
+            if start < 0:
+                start = 0
+            if start >= end:
+                return
+
+            pos = idx[start]
+            end_pos = None
+            if end < n:
+                end_pos = idx[end]
+
+        row = start
+        rest = b''
+        with open(self.fn,"rb") as f:
+            f.seek(pos)
+            while row < end:
+                sz = chunk
+                if end_pos != None:
+                    sz = min(chunk,end_pos - pos)
+                b = f.read(sz) if sz > 0 else b''
+                pos += len(b)
+
+                if len(b) == 0:
+                    # last row without a newline
+                    if len(rest) > 0:
+                        yield (row,rest.decode("utf-8").rstrip())
+                    return
+
+                lines = (rest + b).split(b'\n')
+                rest = lines.pop()
+                for ln in lines:
+                    yield (row,ln.decode("utf-8").rstrip())
+                    row += 1
+                    if row >= end:
+                        return
+
+    # Return the first row with a date time at or after secs,
+    # seconds since the epoch, or row_cnt() if there is no such row.
+    # Assumes rows are in date time order.
+    # Reads the data file so should be run in a thread by async callers.
+    def find_row(self,secs):
+        with DsIdx(self.fn_idx) as idx:
+            lo = 0
+            hi = len(idx)
+            if self.hot != None:
+                hi = self.hot.rows()
+            with open(self.fn,"rb") as f:
+                while lo < hi:
+                    mid = (lo + hi) // 2
+
+                    # skip rows without a valid date time
+                    r = mid
+                    t = None
+                    while r < hi and t == None:
+                        ln = self._read_row(r,idx,f)
+                        if ln != None:
+                            t = _row_secs(ln)
+                        r += 1
+
+                    if t != None and t < secs:
+                        lo = r
+                    else:
+                        hi = mid
+        return lo
+
     # Translates a row index in the index file
     #  to a row position in the data file.
     # Entry 0 is first indexed entry.
     def _get_idx_pos(self,row_idx):
+        if self.hot != None:
+            p = self.hot.pos(row_idx)
+            if p != None:
+                return p
+
         p = int(row_idx * 4)
         if p >= file_sz(self.fn_idx):
             return -1
@@ -161,6 +664,9 @@ class ModuleService(PsrpiModule):
     # If less than blk_cnt lines are returned then
     # EOF was hit.
     def _get_blk(self,pos,blk_cnt):
+        if self.hot != None:
+            return self._get_blk_hot(pos,blk_cnt)
+
         lines = []
         with open(self.fn) as f:
             f.seek(pos)
@@ -171,3 +677,34 @@ class ModuleService(PsrpiModule):
                     return lines
 
         return lines
+
+    # _get_blk reading rows in the data file up to the hot tier,
+    # then rows in the hot tier. Rows migrated to the data file
+    # while reading, which are no longer in the hot tier, are read
+    # from the data file.
+    def _get_blk_hot(self,pos,blk_cnt):
+        lines = []
+        while len(lines) < blk_cnt:
+            base_pos = self.hot.base_pos
+            if pos < base_pos:
+                with open(self.fn,"rb") as f:
+                    f.seek(pos)
+                    while pos < base_pos and len(lines) < blk_cnt:
+                        ln = f.readline()
+                        if len(ln) == 0:
+                            break
+                        pos += len(ln)
+                        lines.append(ln.decode("utf-8").rstrip())
+                if len(lines) >= blk_cnt or pos < base_pos:
+                    break
+
+            row = self.hot.row_at(pos)
+            if row != None:
+                hot_lines = self.hot.lines(row,row + blk_cnt - len(lines))
+                if hot_lines != None:
+                    lines += hot_lines
+                    break
+            # migrated since base_pos was read
+            if self.hot.base_pos == base_pos:
+                break
+        return lines
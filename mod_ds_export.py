@@ -0,0 +1,384 @@
+"""
+    Data Store Export Module
+
+    Exports a range of rows from the datastore created by mod_ds to
+    csv or numpy column files for offline analysis.
+
+    Columns exported are:
+        - ts     : date time of the row as seconds since the epoch
+        - topic  : topic id, the index of the row's topic in the list of exported topics
+        - one column for each requested payload json field, nan if missing or not a number
+
+    Formats:
+        - csv : one csv file with columns ts, topic id, topic and the payload fields
+        - npy : one .npy file per column named <out>_<column>.npy
+                plus <out>_topics.json with the list of topics
+        - npz : one .npz file with an array per column plus a "topics" array
+
+    Files are written as rows are read so memory use does not depend on the
+    number of rows exported. numpy is not needed to write .npy or .npz files.
+
+    Module Parameters:
+      - ds      : name of mod_ds module that stores data - must be in same json parms
+      - sub     : topic for which export requests can be made.
+      - out_dir : directory export files are written to. Default is "."
+
+    Export Requests -
+    The parameters for an export request are in the MQTT message payload as json:
+        - resp_topic : topic to publish the result to - optional
+        - out        : output file name, without directory - required
+        - fmt        : "csv", "npy" or "npz". Default is the extension of out
+                       if it is one of these, otherwise "csv"
+        - fields     : list of payload fields to export, names of letters, digits
+                       and _, with "." between the names of nested fields, other than
+                       ts, topic, topic_id and topics. Default is []
+        - filter     : only export rows with a topic matching this filter. Default is "#"
+        - start_row  : first row to export. Default is 0
+        - end_row    : export up to but not including this row. Default is all rows
+        - from_dt    : first date time to export, for example "4/9/2023 9:00:00"
+        - to_dt      : export rows before this date time
+
+    The result published to resp_topic contains the files written, number of rows exported,
+    number of rows skipped because they could not be parsed and seconds taken.
+
+    Can also be run as a command, for example:
+        python mod_ds_export.py --fmt npz --fields temp,hum --from-dt "4/10/2023 0:00:00" dht.npz
+"""
+
+import json
+from ps_mod import PsrpiModule
+import asyncio
+
+from ps_util import ticks_ms, ticks_diff
+import ps_util
+import ps_pred
+from ps_subscr import Subscription
+import array
+import os
+import re
+import sys
+import zipfile
+
+_npy_hdr_len = 128
+
+FORMATS = ("csv","npy","npz")
+
+# names of the built-in columns and files, which fields can not have
+RESERVED = ("ts","topic","topic_id","topics")
+
+# field names are used in file names, so only letters, digits, _ and .
+_field_re = re.compile(r"[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*")
+
+# return the format to export out in, fmt or if None from the extension of out
+def out_fmt(out,fmt=None):
+    ext = os.path.splitext(out)[1][1:]
+    if fmt == None:
+        return ext if ext in FORMATS else "csv"
+    if ext in FORMATS and ext != fmt:
+        raise ValueError("format {} does not match {}".format(fmt,out))
+    return fmt
+
+# return the .npy header for a 1 dimensional array of n values
+# header is padded to a fixed length so it can be rewritten
+# once the number of values is known
+def npy_header(descr,n):
+    h = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(descr,n)
+    h = h.ljust(_npy_hdr_len - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(h).to_bytes(2,"little") + h.encode("latin1")
+
+# A single column written to a .npy file
+class NpyCol:
+
+    def __init__(self, fn, typecode, descr):
+        self.fn = fn
+        self._typecode = typecode
+        self._descr = descr
+        self._buff = array.array(typecode)
+        self._n = 0
+        self._f = open(fn,"wb")
+        self._f.write(npy_header(descr,0))
+
+    def append(self,v):
+        self._buff.append(v)
+        if len(self._buff) >= 65536:
+            self.flush()
+
+    def flush(self):
+        self._n += len(self._buff)
+        self._f.write(self._buff.tobytes())
+        self._buff = array.array(self._typecode)
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.flush()
+        self._f.seek(0)
+        self._f.write(npy_header(self._descr,self._n))
+        self._f.close()
+
+    # close without finishing the file, when an export fails
+    def discard(self):
+        self._f.close()
+
+# write a list of strings as a .npy unicode array
+def write_npy_str(fn,strs):
+    w = max([len(s) for s in strs] + [1])
+    bo = '<' if sys.byteorder == "little" else '>'
+    with open(fn,"wb") as f:
+        f.write(npy_header("{}U{}".format(bo,w),len(strs)))
+        for s in strs:
+            f.write(s.ljust(w,'\0').encode("utf-32-le" if bo == '<' else "utf-32-be"))
+
+# Export rows start to end of ds to out.
+# Runs without yielding so should be run in a thread by async callers.
+# Returns dictionary with files written, number of rows and seconds taken.
+# If the export fails, the files it started writing are removed.
+def export(ds,out,fmt="csv",fields=[],filter="#",start=0,end=None):
+    t = ticks_ms()
+    subscr = Subscription(filter,None)
+    topic_ids = {}
+    topics = []
+    rows = 0
+    bad  = 0
+
+    if not isinstance(fields,list):
+        raise ValueError("fields must be a list")
+    for fld in fields:
+        if not isinstance(fld,str) or _field_re.fullmatch(fld) == None:
+            raise ValueError("invalid field name {}".format(json.dumps(fld)))
+        if fld in RESERVED:
+            raise ValueError("field name {} is used for a built-in column".format(fld))
+    if len(set(fields)) != len(fields):
+        raise ValueError("fields repeated {}".format(json.dumps(fields)))
+
+    if not fmt in FORMATS:
+        raise ValueError("unknown export format " + str(fmt))
+
+    f = None
+    cols = []
+    files = []      # files written, removed if the export fails
+    try:
+        if fmt == "csv":
+            files.append(out)
+            f = open(out,"w")
+            f.write(",".join(["ts","topic_id","topic"] + fields))
+            f.write("\n")
+        else:
+            base = out
+            if base.endswith("." + fmt):
+                base = base[:-4]
+            bo = '<' if sys.byteorder == "little" else '>'
+            names = [("ts","d",bo+"f8"),("topic","i",bo+"i4")]
+            for fld in fields:
+                names.append((fld,"d",bo+"f8"))
+            for (name,typecode,descr) in names:
+                fn = "{}_{}.npy".format(base,name)
+                files.append(fn)
+                cols.append(NpyCol(fn,typecode,descr))
+
+        nan = float("nan")
+        for (row,ln) in ds.iter_rows(start,end):
+            r = ln.split('\t',2)
+            if len(r) < 3:
+                bad += 1
+                continue
+
+            (dt,topic,payload) = r
+            if not subscr.filter_match(topic.split('/')):
+                continue
+
+            try:
+                ts = ps_util.dt_secs(dt)
+            except ValueError:
+                bad += 1
+                continue
+
+            tid = topic_ids.get(topic)
+            if tid == None:
+                tid = len(topics)
+                topic_ids[topic] = tid
+                topics.append(topic)
+
+            vals = []
+            if len(fields) > 0:
+                p = None
+                if payload.startswith('{'):
+                    try:
+                        p = json.loads(payload)
+                    except ValueError:
+                        pass
+                for fld in fields:
+                    v = ps_pred.num_value(ps_pred.field_value(p,fld))
+                    vals.append(nan if v == None else v)
+
+            rows += 1
+
+            if fmt == "csv":
+                f.write("{},{},{}".format(ts,tid,json.dumps(topic)))
+                for v in vals:
+                    f.write(",")
+                    if v == v:  # not nan
+                        f.write(repr(v))
+                f.write("\n")
+            else:
+                cols[0].append(ts)
+                cols[1].append(tid)
+                for i in range(len(vals)):
+                    cols[i+2].append(vals[i])
+
+        if fmt == "csv":
+            f.close()
+        else:
+            for c in cols:
+                c.close()
+
+            if fmt == "npy":
+                fn = base + "_topics.json"
+                files.append(fn)
+                with open(fn,"w") as f:
+                    json.dump(topics,f)
+            else:
+                # zip the column files into a single .npz file
+                fn = base + "_topics.npy"
+                files.append(fn)
+                write_npy_str(fn,topics)
+                npy = list(files)
+                files.append(base + ".npz")
+                with zipfile.ZipFile(base + ".npz","w",allowZip64=True) as z:
+                    for c in npy:
+                        name = os.path.basename(c)[len(os.path.basename(base))+1:]
+                        z.write(c,name)
+                for c in npy:
+                    os.remove(c)
+                files = [base + ".npz"]
+
+    except BaseException:
+        if f != None:
+            f.close()
+        for c in cols:
+            c.discard()
+        for fn in files:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        raise
+
+    return {"files":files, "rows":rows, "bad":bad, "secs":ticks_diff(ticks_ms(),t)/1000}
+
+# return (start,end) rows for a request from its
+# start_row, end_row, from_dt and to_dt.
+# Reads the data file so should be run in a thread by async callers.
+def req_range(ds,req):
+    start = req.get("start_row",0)
+    end   = req.get("end_row",None)
+
+    if "from_dt" in req:
+        start = max(start,ds.find_row(ps_util.dt_secs(req["from_dt"])))
+    if "to_dt" in req:
+        r = ds.find_row(ps_util.dt_secs(req["to_dt"]))
+        if end == None or r < end:
+            end = r
+
+    return (start,end)
+
+'''
+    Data Store Export Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    # parms naming services this service depends on, with defaults
+    DEP_PARMS = {"ds":"ds"}
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.sub     = self.get_parm("sub",None)
+        self.ds      = self.get_parm("ds","ds")
+        self.ds_svc  = None
+        self.out_dir = self.get_parm("out_dir",".")
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    # Run export requests one at a time
+    async def run(self):
+        mqtt = self.get_mqtt()
+
+        if self.sub == None:
+            return await self.fatal_err( "{} exiting - no subscribe topic (sub) specified".
+                                  format(self._name))
+
+        self.ds_svc = self.get_svc(self.ds)
+        if self.ds_svc == None:
+            return await self.fatal_err("{} exiting - ds module {} not found".
+                                  format(self._name,self.ds))
+
+        q = asyncio.Queue()
+        await mqtt.subscribe(self.sub,q)
+
+        while True:
+            data = await q.get()
+            await self.export_req(data[2])
+
+    async def export_req(self,payload):
+        try:
+            req = json.loads(payload)
+        except ValueError:
+            return await self.fatal_err("{}: invalid json {}".format(self._name,payload))
+
+        if not isinstance(req,dict) or not "out" in req:
+            return await self.fatal_err("{}: out required {}".format(self._name,payload))
+
+        # only write to out_dir
+        out = os.path.join(self.out_dir,os.path.basename(req["out"]))
+
+        try:
+            (start,end) = await asyncio.to_thread(req_range,self.ds_svc,req)
+            fmt = out_fmt(out,req.get("fmt"))
+            result = await asyncio.to_thread(export,self.ds_svc,out,fmt,
+                                req.get("fields",[]),req.get("filter","#"),start,end)
+        except Exception as e:
+            result = {"error":str(e)}
+            await self.fatal_err("{}: export failed {} {}".format(self._name,payload,e))
+
+        await self.log("export {}".format(result))
+        if "resp_topic" in req:
+            await self.get_mqtt().publish(req["resp_topic"],result)
+
+
+if __name__ == '__main__':
+    import argparse
+    from ps_parms import PsosParms
+    import mod_ds
+
+    ap = argparse.ArgumentParser(description="export mod_ds rows to csv, npy or npz")
+    ap.add_argument("out")
+    ap.add_argument("--fn",default="mqtt_dat.txt")
+    ap.add_argument("--fn-idx",default="mqtt_idx.txt")
+    ap.add_argument("--fmt",default=None,choices=["csv","npy","npz"])
+    ap.add_argument("--fields",default="")
+    ap.add_argument("--filter",default="#")
+    ap.add_argument("--start-row",type=int,default=0)
+    ap.add_argument("--end-row",type=int,default=None)
+    ap.add_argument("--from-dt",default=None)
+    ap.add_argument("--to-dt",default=None)
+    a = ap.parse_args()
+
+    fmt = out_fmt(a.out,a.fmt)
+
+    ds = mod_ds.ModuleService(PsosParms({"name":"ds","fn":a.fn,"fn_idx":a.fn_idx},{},{}))
+
+    req = {"start_row":a.start_row,"end_row":a.end_row}
+    if a.from_dt != None:
+        req["from_dt"] = a.from_dt
+    if a.to_dt != None:
+        req["to_dt"] = a.to_dt
+    (start,end) = req_range(ds,req)
+
+    fields = [f for f in a.fields.split(",") if f != ""]
+    print(export(ds,a.out,fmt,fields,a.filter,start,end))
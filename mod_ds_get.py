@@ -21,12 +21,45 @@
         - init_pos   : initial row number in the file, -1 for start at last row, 0 for first row. Default is -1.
         - direction  : direction to read, "fwd" or "back" (forward or backward). Default is "back"
         - follow     : forward updates to the file to resp_topic? true or false. Default is false.
+        - where      : predicate over payload json fields, for example "temp > 75". See ps_pred.
+        - from_dt    : only return rows at or after this date time, for example "4/10/2023 9:00:00"
+        - to_dt      : only return rows before this date time
+        - search     : words which must all be in the row's topic or payload, for example "cam02 uploading".
+                       Requires the ds module to have a token index (fts parameter).
+        - codec      : codec to encode the response with, for example "msgpack". See ps_codec.
+                       Default is the mqtt service's codec for resp_topic.
+
+    Requests are served by a pool of "workers" tasks so one slow read does not hold up
+    requests from other clients. Waiting requests are taken round robin by resp_topic so
+    one client sending many requests can not starve the others. A request identical to
+    one already queued or being read (other than resp_topic) is not read again - the
+    result is sent to the resp_topic of every request waiting for it.
+
+    Additional Module Parameters:
+      - workers    : number of requests read at the same time. Default is 3.
+      - pub_stats  : topic to publish queue wait and service time histograms to. Default is none.
+      - stats_secs : seconds between publishing stats. Default is 60.
+
+    get_stats() also has lat_ms, the ms from a request being received by mqtt
+    to it being taken off the subscription queue (queue), a worker starting to
+    read it (start) and its response being published (reply). See ps_trace.
 
     The module will read starting at the init_pos, reading forward or backward in the file
     starting at "init_pos". Only rows which match the specified "resp_topic" will be returned up to a maximum
     of "max_cnt" rows. If fewer than the optional "min_cnt" rows are found, the read direction will be reversed
     and matching rows will be added to the response until "max_cnt" rows are read or end or beginning of file
     is reached. Response will be an array of rows, each row being an array with date, time, topic and payload.
+
+    If a filter other than "#" or a where predicate is specified, rows are read a ds block at
+    a time and only matching rows are returned, up to max_cnt rows. Topic matches and payload
+    fields are evaluated for a whole block at once and cached with the block by the ds module.
+    prev_idx and next_idx are then the rows to continue reading backward or forward from.
+    If the ds module keeps a zone map, blocks which can not contain a matching row are skipped.
+    The response then also has blk_read and blk_skip, the number of blocks read and skipped.
+
+    If search is specified, rows are found using the ds token index instead of reading the data
+    file. Up to max_cnt rows before init_pos matching search, filter and where are returned newest
+    first. prev_idx is then the row to continue the search from, -1 if there are no more rows.
     
 """
 
@@ -37,9 +70,14 @@ import asyncio
 # import queue
 import gc
 
-from ps_util import to_str,to_bytes,file_sz, sleep_ms
+from ps_util import to_str,to_bytes,file_sz, sleep_ms, ticks_ms, ticks_diff
 import ps_util
+from ps_stats import Histogram
+from ps_trace import Stages
+from ps_pred import Pred, PredError
+from mod_ds import DsBlock
 from ps_subscr import Subscription
+import ps_codec
 import struct
 import os
     
@@ -49,12 +87,36 @@ import os
 '''
 # All initialization classes are named ModuleService
 class ModuleService(PsrpiModule):
+
+    # parms naming services this service depends on, with defaults
+    DEP_PARMS = {"ds":"ds"}
     
     def __init__(self, parms):
         super().__init__(parms)
 
         self.sub    = self.get_parm("sub",None)
         self.ds     = self.get_parm("ds","ds")
+        self.ds_svc = None
+
+        self.workers    = self.get_parm("workers",3)
+        self.pub_stats  = self.get_parm("pub_stats",None)
+        self.stats_secs = self.get_parm("stats_secs",60)
+
+        # requests waiting or being read, by request key
+        self._pending = {}
+
+        # waiting request keys by requester (resp_topic)
+        # and round robin list of requesters with waiting requests
+        self._reqs = {}
+        self._rr   = []
+
+        # one entry for each waiting request
+        self._waiting = asyncio.Queue()
+
+        self.wait_ms   = Histogram()
+        self.svc_ms    = Histogram()
+        self.coalesced = 0
+        self.lat       = Stages(self._name)
 
     async def fatal_err(self,msg):
         print(msg)
@@ -69,22 +131,28 @@ class ModuleService(PsrpiModule):
             return await self.fatal_err( "{} exiting - no subscribe topic (sub) specified".
                                   format(self._name))
         
-        self.ds = self.get_svc(self.ds)
-        if self.ds == None:
+        self.ds_svc = self.get_svc(self.ds)
+        if self.ds_svc == None:
             return await self.fatal_err("{} exiting - ds module {} not found".
-                                  format(self._name,self.get_parm("ds","ds")))
+                                  format(self._name,self.ds))
+
+        # keep references so worker tasks are not garbage collected
+        self._tasks = [asyncio.create_task(self.worker()) for i in range(self.workers)]
+
+        if self.pub_stats != None:
+            self._tasks.append(asyncio.create_task(self.publish_stats()))
 
         q = asyncio.Queue()
         await mqtt.subscribe(self.sub,q)
 
         while True:
             data = await q.get()
-            await self.read_data(data[2])
+            self.lat.mark("queue",data)
+            await self.read_data(data[2],data)
     
-    # Read data from ds from payload
-    async def read_data(self,payload):
-        ds = self.ds
-        mqtt = self.get_mqtt()
+    # Validate a request payload and queue it for a worker.
+    # data is the subscription queue list the request was received in.
+    async def read_data(self,payload,data=None):
         if isinstance(payload,str) and payload.startswith('{'):
             try:
                 payload = json.loads(payload)
@@ -100,13 +168,118 @@ class ModuleService(PsrpiModule):
         if not "resp_topic" in payload:
             return await self.fatal_err("{}: resp_topic required".format(self._name))
 
-        (prev_idx,b,next_idx)  = await self.read_blk(ds,payload)
+        # compile predicate once for the request
+        pred = None
+        if "where" in payload:
+            try:
+                pred = Pred(payload["where"])
+            except PredError as e:
+                return await self.fatal_err("{}: invalid where {}".format(self._name,e))
+
+        if "search" in payload and self.ds_svc.fts == None:
+            return await self.fatal_err("{}: search requires ds fts index".format(self._name))
+
+        if "codec" in payload and not ps_codec.has(payload["codec"]):
+            return await self.fatal_err("{}: codec {} not available".format(self._name,payload["codec"]))
 
-        result = {"prev_idx":prev_idx, "data":b, "next_idx":next_idx}
+        self.queue_req(payload,pred,data)
+
+    # Queue a request, coalescing it with an identical
+    # request already waiting or being read
+    def queue_req(self,payload,pred=None,data=None):
         resp_topic = payload["resp_topic"]
-        await mqtt.publish(resp_topic,result)
 
-    async def read_blk(self,ds,p):
+        key = dict(payload)
+        del key["resp_topic"]
+        key = json.dumps(key,sort_keys=True)
+
+        entry = self._pending.get(key)
+        if entry != None:
+            if not resp_topic in entry["resp"]:
+                entry["resp"].append(resp_topic)
+            if data != None:
+                entry["data"].append(data)
+            self.coalesced += 1
+            return
+
+        self._pending[key] = {"req":payload, "pred":pred, "resp":[resp_topic], "t":ticks_ms(),
+                              "data":[data] if data != None else []}
+
+        if resp_topic in self._reqs:
+            self._reqs[resp_topic].append(key)
+        else:
+            self._reqs[resp_topic] = [key]
+            self._rr.append(resp_topic)
+
+        self._waiting.put_nowait(key)
+
+    # return the key of the next request to read,
+    # taking requesters round robin
+    def next_req(self):
+        requester = self._rr.pop(0)
+        keys = self._reqs[requester]
+        key = keys.pop(0)
+
+        if len(keys) > 0:
+            self._rr.append(requester)
+        else:
+            del self._reqs[requester]
+
+        return key
+
+    # read requests until cancelled
+    async def worker(self):
+        mqtt = self.get_mqtt()
+
+        while True:
+            await self._waiting.get()
+            key = self.next_req()
+            entry = self._pending[key]
+
+            t = ticks_ms()
+            self.wait_ms.add(ticks_diff(t,entry["t"]))
+            for data in entry["data"]:
+                self.lat.mark("start",data)
+
+            try:
+                r = await self.read_blk(self.ds_svc,entry["req"],entry["pred"])
+            except Exception as e:
+                del self._pending[key]
+                await self.fatal_err("{}: read failed {} {}".format(self._name,entry["req"],e))
+                continue
+
+            # requests received from here on need a new read
+            del self._pending[key]
+
+            result = {"prev_idx":r[0], "data":r[1], "next_idx":r[2]}
+
+            # scans also return number of blocks read and skipped
+            if len(r) > 3:
+                result.update(r[3])
+            for resp_topic in entry["resp"]:
+                await mqtt.publish(resp_topic,result,codec=entry["req"].get("codec"))
+            for data in entry["data"]:
+                self.lat.mark("reply",data)
+
+            self.svc_ms.add(ticks_diff(ticks_ms(),t))
+
+    # return request statistics
+    def get_stats(self):
+        return {"wait_ms":self.wait_ms.summary(),
+                "svc_ms":self.svc_ms.summary(),
+                "lat_ms":self.lat.summary(),
+                "coalesced":self.coalesced,
+                "queued":self._waiting.qsize(),
+                "pending":len(self._pending)}
+
+    # periodically publish request statistics
+    async def publish_stats(self):
+        mqtt = self.get_mqtt()
+        while True:
+            await asyncio.sleep(self.stats_secs)
+            await mqtt.publish(self.pub_stats,self.get_stats())
+
+    async def read_blk(self,ds,p,pred=None):
         filter    = "#"
         max_cnt   = 10
         blk_cnt   = 10
@@ -124,6 +297,144 @@ class ModuleService(PsrpiModule):
         if "direction" in p:
             direction = p["direction"]
                 
-       # resp = []
+        t_from = None
+        t_to   = None
+        if "from_dt" in p:
+            t_from = ps_util.dt_secs(p["from_dt"])
+        if "to_dt" in p:
+            t_to = ps_util.dt_secs(p["to_dt"])
+
+        subscr = Subscription(filter,None)
+
+        if "search" in p:
+            return await self.search(ds,p["search"],subscr,pred,t_from,t_to,
+                                     max_cnt,blk_cnt,init_pos)
+
+        if filter == "#" and pred == None and t_from == None and t_to == None:
+            return await ds.read_page(blk_cnt,init_pos,direction)
+
+        return await self.scan(ds,subscr,pred,t_from,t_to,max_cnt,init_pos,direction)
+
+    # return list of bool, True for each row in blk with a topic
+    # matching subscr, matching pred and with a date time from
+    # t_from up to but not including t_to
+    def match(self,blk,subscr,pred,t_from,t_to):
+        match = blk.topic_match(subscr)
+        if pred != None:
+            match = [m and p for m,p in zip(match,pred.eval(blk))]
+
+        if t_from != None or t_to != None:
+            m = []
+            for (x,t) in zip(match,blk.times()):
+                m.append(x and t != None and
+                         (t_from == None or t >= t_from) and
+                         (t_to == None or t < t_to))
+            match = m
+
+        return match
+
+    # Read ds a block at a time starting at row init_pos
+    # and return up to max_cnt rows matching the topic filter in subscr,
+    # the predicate pred and date time range t_from to t_to.
+    # Blocks the ds zone map shows can not have a matching row are not read.
+    async def scan(self,ds,subscr,pred,t_from,t_to,max_cnt,init_pos,direction):
+        row_cnt = ds.row_cnt()
+        back = direction == "back"
+        blk_read = 0
+        blk_skip = 0
+
+        if init_pos < 0 or init_pos >= row_cnt:
+            if back:
+                init_pos = row_cnt - 1
+            else:
+                return (-1,[],0)
+
+        result = []
+        row = init_pos
+        while 0 <= row < row_cnt and len(result) < max_cnt:
+            blk_no = row // ds.blk_rows
+
+            if not ds.may_match(blk_no,subscr,pred,t_from,t_to):
+                blk_skip += 1
+                if back:
+                    row = blk_no * ds.blk_rows - 1
+                else:
+                    row = (blk_no + 1) * ds.blk_rows
+                continue
+
+            blk = await ds.read_block(blk_no)
+            if blk == None or len(blk) == 0:
+                break
+            blk_read += 1
+
+            # index can be ahead of the data file while a row is written
+            if row - blk.start >= len(blk):
+                if not back:
+                    break
+                row = blk.start + len(blk) - 1
+
+            match = self.match(blk,subscr,pred,t_from,t_to)
+
+            if back:
+                rows = range(row - blk.start,-1,-1)
+            else:
+                rows = range(row - blk.start,len(blk))
+
+            for i in rows:
+                if match[i]:
+                    result.append(blk.lines[i])
+                    if len(result) >= max_cnt:
+                        break
+
+            if back:
+                row = blk.start + i - 1
+            else:
+                row = blk.start + i + 1
+
+            # let other requests run between blocks
+            await sleep_ms(0)
+
+        blks = {"blk_read":blk_read, "blk_skip":blk_skip}
+
+        if back:
+            result.reverse()
+            next_idx = init_pos + 1
+            if next_idx >= row_cnt:
+                next_idx = 0
+            return (max(row,-1),result,next_idx,blks)
+
+        if row >= row_cnt:
+            row = 0
+        return (init_pos - 1,result,row,blks)
+
+    # Return up to max_cnt rows before init_pos containing the words in terms
+    # and matching the topic filter in subscr and predicate pred.
+    # Rows found by the ds token index are checked blk_cnt rows at a time.
+    async def search(self,ds,terms,subscr,pred,t_from,t_to,max_cnt,blk_cnt,init_pos):
+        before = None
+        if init_pos >= 0:
+            before = init_pos + 1
+
+        result = []
+        prev_idx = -1
+        while len(result) < max_cnt:
+            found = await ds.search_rows(terms,before,blk_cnt)
+            if len(found) == 0:
+                prev_idx = -1
+                break
+
+            rows  = [row for (row,ln) in found]
+            lines = [ln for (row,ln) in found]
+            before = rows[-1]
+
+            blk = DsBlock(rows[0],lines)
+            match = self.match(blk,subscr,pred,t_from,t_to)
+
+            for i in range(len(rows)):
+                prev_idx = rows[i] - 1
+                if match[i]:
+                    result.append(lines[i])
+                    if len(result) >= max_cnt:
+                        break
 
-        return await ds.read_page(blk_cnt,init_pos,direction)
+        return (prev_idx,result,0)
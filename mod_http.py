@@ -0,0 +1,416 @@
+"""
+    HTTP and WebSocket Gateway Module
+
+    Serves datastore queries over HTTP and live MQTT topics over WebSocket,
+    using asyncio streams so no web framework is needed.
+
+    GET /ds?...
+        Query the mod_ds datastore. Query parameters are those of a
+        mod_ds_get read request: filter, where, from_dt, to_dt, search,
+        init_pos, direction and max_cnt. filter, where, from_dt, to_dt and search
+        are read by the mod_ds_get service named by the "ds_get" parm.
+        Rows are read page rows at a time and each page is sent as a chunk of a
+        chunked response as soon as it is read, so a large result is never held
+        in memory. The response is json in the same form as a mod_ds_get response,
+            {"data":[row,...], "prev_idx":..., "next_idx":...}
+        except that reading "back" returns the newest row first.
+
+    GET /ws
+        WebSocket. Send {"sub":topic filter} to receive the messages for the
+        filter, and {"unsub":topic filter} to stop. Each message is sent as
+        a text frame [topic,payload].
+
+    Slow clients - a connection's writes wait (backpressure) once more than conn_kb
+    is waiting to be sent, which only holds up that connection's task. A WebSocket's
+    messages are queued, at most ws_queue, and further messages are dropped and
+    counted until the client catches up. A connection which can not send for
+    send_secs is closed.
+
+    Connections are kept alive between requests for keep_alive_secs.
+    WebSockets are sent a ping every keep_alive_secs.
+
+    Module Parameters:
+      - port            : port to listen on. Default is 8080.
+      - host            : address to listen on. Default is all.
+      - ds              : name of mod_ds service. Default is "ds".
+      - ds_get          : name of mod_ds_get service for queries with filter,
+                          where, from_dt, to_dt or search. Default is "ds_get".
+      - page            : rows read and sent at a time. Default is 100.
+      - max_rows        : most rows returned by a query. Default is 10000.
+      - max_conn        : most connections at a time. Default is 20.
+      - keep_alive_secs : time an idle connection is kept open. Default is 15.
+      - send_secs       : time a connection can wait to send before it is closed. Default is 30.
+      - conn_kb         : data waiting to be sent before a connection's writes wait. Default is 64.
+      - ws_queue        : most messages waiting to be sent to a WebSocket. Default is 100.
+      - max_msg_kb      : largest WebSocket message or request header accepted. Default is 16.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import urllib.parse
+
+from ps_pred import Pred, PredError
+import ps_codec
+import ps_util
+
+_ws_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_status = {101:"Switching Protocols", 200:"OK", 400:"Bad Request", 404:"Not Found",
+           405:"Method Not Allowed", 500:"Internal Server Error", 503:"Service Unavailable"}
+
+# query parameters which are numbers
+_int_parms = ("init_pos","max_cnt")
+
+# query parameters which need the ds_get service
+_get_parms = ("filter","where","from_dt","to_dt","search")
+
+# query parameters which are date times
+_dt_parms = ("from_dt","to_dt")
+
+class HttpError(Exception):
+
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+# return a WebSocket frame
+def ws_frame(data,opcode=1):
+    n = len(data)
+    if n < 126:
+        hdr = struct.pack("!BB",0x80|opcode,n)
+    elif n < 65536:
+        hdr = struct.pack("!BBH",0x80|opcode,126,n)
+    else:
+        hdr = struct.pack("!BBQ",0x80|opcode,127,n)
+    return hdr + data
+
+# Read a WebSocket frame, returning (fin,opcode,payload).
+# Raises asyncio.TimeoutError if no frame starts within timeout secs.
+# Once it has started the rest of the frame is read without a timeout,
+# a timeout part way through would lose the rest of the frame.
+async def ws_read(reader,max_sz,timeout=None):
+    b = await asyncio.wait_for(reader.readexactly(2),timeout)
+    n = b[1] & 0x7f
+    if n == 126:
+        n = struct.unpack("!H",await reader.readexactly(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q",await reader.readexactly(8))[0]
+    if n > max_sz:
+        raise ValueError("websocket message too large")
+
+    mask = None
+    if b[1] & 0x80:
+        mask = await reader.readexactly(4)
+    data = await reader.readexactly(n)
+    if mask != None and n > 0:
+        m = int.from_bytes((mask * (n // 4 + 1))[:n],"big")
+        data = (int.from_bytes(data,"big") ^ m).to_bytes(n,"big")
+    return (b[0] & 0x80 != 0, b[0] & 0x0f, data)
+
+# A client connection
+class Conn:
+
+    def __init__(self, reader, writer, send_secs, conn_kb):
+        self.reader = reader
+        self.writer = writer
+        self.send_secs = send_secs
+        writer.transport.set_write_buffer_limits(high=conn_kb*1024)
+
+    # write data, waiting while too much is waiting to be sent
+    async def send(self,data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(),self.send_secs)
+
+    async def send_chunk(self,data):
+        await self.send(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    async def send_resp(self,status,body=b"",ctype="application/json",headers={}):
+        hdrs = ["HTTP/1.1 {} {}".format(status,_status.get(status,"")),
+                "Content-Type: " + ctype, "Content-Length: {}".format(len(body))]
+        hdrs += ["{}: {}".format(k,v) for (k,v) in headers.items()]
+        await self.send(("\r\n".join(hdrs) + "\r\n\r\n").encode("utf-8") + body)
+
+    def close(self):
+        self.writer.close()
+
+'''
+    HTTP Gateway Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    # parms naming services this service depends on, with defaults
+    DEP_PARMS = {"ds":"ds"}
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.port       = self.get_parm("port",8080)
+        self.host       = self.get_parm("host",None)
+        self.ds         = self.get_parm("ds","ds")
+        self.ds_svc     = None
+        self.ds_get     = self.get_parm("ds_get","ds_get")
+        self.page       = self.get_parm("page",100)
+        self.max_rows   = self.get_parm("max_rows",10000)
+        self.max_conn   = self.get_parm("max_conn",20)
+        self.keep_alive = self.get_parm("keep_alive_secs",15)
+        self.send_secs  = self.get_parm("send_secs",30)
+        self.conn_kb    = self.get_parm("conn_kb",64)
+        self.ws_queue   = self.get_parm("ws_queue",100)
+        self.max_msg    = self.get_parm("max_msg_kb",16) * 1024
+
+        self.conns    = 0
+        self.requests = 0
+        self.rows     = 0
+        self.rejected = 0
+        self.ws       = 0
+        self.ws_msgs  = 0
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    async def run(self):
+        self.ds_svc = self.get_svc(self.ds)
+        if self.ds_svc == None:
+            return await self.fatal_err("{} exiting - ds module {} not found".
+                                  format(self._name,self.ds))
+
+        self._server = await asyncio.start_server(self.handle,self.host,self.port,limit=self.max_msg)
+        print("{}: listening on port {}".format(self._name,self.port))
+        async with self._server:
+            await self._server.serve_forever()
+
+    # serve requests on a connection until it is closed or idle
+    async def handle(self,reader,writer):
+        conn = Conn(reader,writer,self.send_secs,self.conn_kb)
+        try:
+            if self.conns >= self.max_conn:
+                self.rejected += 1
+                await conn.send_resp(503,b'{"error":"too many connections"}',headers={"Connection":"close"})
+                return
+
+            self.conns += 1
+            try:
+                while await self.request(conn):
+                    pass
+            finally:
+                self.conns -= 1
+
+        except (asyncio.IncompleteReadError,asyncio.LimitOverrunError,asyncio.TimeoutError,
+                ConnectionError,ValueError):
+            pass
+        finally:
+            conn.close()
+
+    # read and serve a request, returning False if the connection is to be closed
+    async def request(self,conn):
+        try:
+            hdr = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"),self.keep_alive)
+        except (asyncio.TimeoutError,asyncio.IncompleteReadError):
+            return False
+
+        lines = hdr.decode("latin-1").split("\r\n")
+        req = lines[0].split(" ")
+        if len(req) != 3:
+            await conn.send_resp(400,b'{"error":"invalid request"}',headers={"Connection":"close"})
+            return False
+
+        headers = {}
+        for ln in lines[1:]:
+            if ":" in ln:
+                (k,v) = ln.split(":",1)
+                headers[k.strip().lower()] = v.strip()
+
+        # requests are not expected to have a body
+        n = int(headers.get("content-length",0))
+        if n > self.max_msg:
+            await conn.send_resp(400,b'{"error":"request too large"}',headers={"Connection":"close"})
+            return False
+        if n > 0:
+            await conn.reader.readexactly(n)
+
+        self.requests += 1
+        url = urllib.parse.urlsplit(req[1])
+        keep = headers.get("connection","").lower() != "close" and req[2] == "HTTP/1.1"
+        try:
+            if req[0] != "GET":
+                raise HttpError(405,"only GET is supported")
+            if url.path == "/ds":
+                return await self.get_ds(conn,urllib.parse.parse_qs(url.query),keep)
+            if url.path == "/ws":
+                await self.websocket(conn,headers)
+                return False
+            raise HttpError(404,"{} not found".format(url.path))
+        except HttpError as e:
+            await conn.send_resp(e.status,json.dumps({"error":str(e)}).encode("utf-8"),
+                                 headers={"Connection":"keep-alive" if keep else "close"})
+            return keep
+
+    # return mod_ds_get read request for query parameters q
+    def ds_req(self,q):
+        req = {k:v[-1] for (k,v) in q.items()}
+        for k in _int_parms:
+            if k in req:
+                try:
+                    req[k] = int(req[k])
+                except ValueError:
+                    raise HttpError(400,"{} must be a number".format(k))
+        req["max_cnt"] = min(req.get("max_cnt",self.max_rows),self.max_rows)
+        req.setdefault("direction","back")
+        req.setdefault("init_pos",-1 if req["direction"] == "back" else 0)
+        return req
+
+    # stream rows of the datastore matching query q
+    async def get_ds(self,conn,q,keep):
+        req = self.ds_req(q)
+        back = req["direction"] == "back"
+
+        ds_get = None
+        pred = None
+        if any(k in req for k in _get_parms):
+            ds_get = self.get_svc(self.ds_get)
+            if ds_get == None:
+                raise HttpError(400,"{} need ds_get service {}".format(", ".join(_get_parms),self.ds_get))
+            if "where" in req:
+                try:
+                    pred = Pred(req["where"])
+                except PredError as e:
+                    raise HttpError(400,"invalid where {}".format(e))
+            if "search" in req and self.ds_svc.fts == None:
+                raise HttpError(400,"search requires ds fts index")
+            for k in _dt_parms:
+                if k in req:
+                    try:
+                        ps_util.dt_secs(req[k])
+                    except (ValueError,OverflowError):
+                        raise HttpError(400,"{} must be a date time like 4/10/2023 9:00:00".format(k))
+
+        await conn.send(("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                         "Transfer-Encoding: chunked\r\nConnection: {}\r\n\r\n").
+                        format("keep-alive" if keep else "close").encode("utf-8"))
+        await conn.send_chunk(b'{"data":[')
+
+        left = req["max_cnt"]
+        pos  = req["init_pos"]
+        r = (-1,[],0)
+        sep = b''
+        while left > 0:
+            n = min(self.page,left)
+            if ds_get != None:
+                r = await ds_get.read_blk(self.ds_svc,dict(req,init_pos=pos,max_cnt=n,blk_cnt=n),pred)
+            else:
+                r = await self.ds_svc.read_page(n,pos,req["direction"])
+
+            rows = r[1]
+            if back:
+                rows = reversed(rows)
+            data = b','.join(json.dumps(ln).encode("utf-8") for ln in rows)
+            if len(data) > 0:
+                await conn.send_chunk(sep + data)
+                sep = b','
+            self.rows += len(r[1])
+            left -= len(r[1])
+
+            # continue from the previous or next row, which
+            # is -1 or 0 once the start or end is reached
+            pos = r[0] if back else r[2]
+            if len(r[1]) == 0 or pos < 0 or (not back and pos == 0):
+                break
+
+        await conn.send_chunk('],"prev_idx":{},"next_idx":{}}}'.format(r[0],r[2]).encode("utf-8"))
+        await conn.send(b"0\r\n\r\n")
+        return keep
+
+    # upgrade to a WebSocket and serve subscriptions until closed
+    async def websocket(self,conn,headers):
+        key = headers.get("sec-websocket-key")
+        if headers.get("upgrade","").lower() != "websocket" or key == None:
+            raise HttpError(400,"websocket upgrade required")
+
+        accept = base64.b64encode(hashlib.sha1(key.encode("latin-1") + _ws_guid).digest()).decode()
+        await conn.send(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                         "Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n").
+                        format(accept).encode("utf-8"))
+
+        mqtt = self.get_mqtt()
+        q = asyncio.Queue(self.ws_queue)
+        filters = set()     # filters to send messages for
+        subscribed = set()  # filters subscribed with mqtt
+        self.ws += 1
+        sender = asyncio.create_task(self.ws_send(conn,q,filters))
+        try:
+            await self.ws_recv(conn,q,filters,subscribed)
+        finally:
+            self.ws -= 1
+            sender.cancel()
+            if len(subscribed) > 0:
+                await mqtt.unsubscribe(q)
+
+    # read WebSocket messages, subscribing and unsubscribing
+    async def ws_recv(self,conn,q,filters,subscribed):
+        mqtt = self.get_mqtt()
+        msg = b''
+        while True:
+            try:
+                (fin,op,data) = await ws_read(conn.reader,self.max_msg,self.keep_alive)
+            except asyncio.TimeoutError:
+                # keep the connection alive
+                await conn.send(ws_frame(b'',9))
+                continue
+
+            if op == 8:
+                await conn.send(ws_frame(data[:2],8))
+                return
+            if op == 9:
+                await conn.send(ws_frame(data,10))
+                continue
+            if op == 10:
+                continue
+
+            msg += data
+            if len(msg) > self.max_msg:
+                raise ValueError("websocket message too large")
+            if not fin:
+                continue
+
+            try:
+                req = json.loads(msg)
+            except ValueError:
+                req = None
+            msg = b''
+            if not isinstance(req,dict):
+                await conn.send(ws_frame(b'{"error":"invalid request"}'))
+                continue
+
+            if "sub" in req:
+                f = str(req["sub"])
+                filters.add(f)
+                if not f in subscribed:
+                    subscribed.add(f)
+                    await mqtt.subscribe(f,q)
+            if "unsub" in req:
+                filters.discard(str(req["unsub"]))
+
+    # send messages for subscribed filters, waiting while the client is slow
+    async def ws_send(self,conn,q,filters):
+        try:
+            while True:
+                data = await q.get()
+                if not data[0] in filters:
+                    continue
+                await conn.send(ws_frame(json.dumps([data[1],ps_codec.to_text(data[2])]).encode("utf-8")))
+                self.ws_msgs += 1
+        except (asyncio.TimeoutError,ConnectionError):
+            # too slow or gone, close so ws_recv ends
+            conn.close()
+
+    def get_stats(self):
+        return {"conns":self.conns, "requests":self.requests, "rows":self.rows,
+                "rejected":self.rejected, "ws":self.ws, "ws_msgs":self.ws_msgs}
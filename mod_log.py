@@ -1,30 +1,164 @@
 """
     Log Service Class
-    
+
     Logs messages.
-    
+
+    log_msg() only adds the message to a ring buffer, so services logging
+    are not held up. A task publishes the buffered messages in batches every
+    flush_ms, or sooner once there are batch messages, and appends them to
+    an optional local file which is rotated when it reaches file_kb.
+
+    With no mqtt service, no file and print false, messages are printed
+    when they are flushed, so they are not lost.
+
+    Each service (source) can log rate messages a second, with bursts of up to
+    burst messages. Messages over the limit, or pushed out of a full buffer,
+    are dropped and counted. The number dropped is logged with the next batch.
+
+    Module Parameters:
+      - pub_log    : topic to publish messages to. Default is "log".
+      - fmt        : "text" to publish "name: msg" lines, one per message,
+                     or "json" to publish a list of [date time, name, msg]. Default is "text".
+      - buf        : most messages buffered. Default is 1000.
+      - batch      : most messages published at a time. Default is 100.
+      - flush_ms   : time between publishing. Default is 1000.
+      - rate       : messages per second allowed from each source. Default is 20.
+      - burst      : messages allowed from each source at once. Default is 50.
+      - file       : file to append messages to. Default is none.
+      - file_kb    : size at which the file is rotated. Default is 1024.
+      - file_count : number of rotated files kept, file.1 is the newest. Default is 3.
+      - print      : print each message. Default is false.
+
 """
 
 from ps_mod import PsrpiModule
 import asyncio
+import collections
+import os
+import time
+
+from ps_util import file_sz
+
+# return date time string for time t, seconds since the epoch
+def _dt(t):
+    return "{1}/{2}/{0} {3}:{4:02d}:{5:02d}".format(*time.localtime(t))
 
 # All initialization classes are named PsrpiModule
 class ModuleService(PsrpiModule):
-    
+
     def __init__(self, parms):
         super().__init__(parms)
         self.pub = parms.get_parm("pub_log","log")
-        
+        self.mqtt = None
+
+        self.fmt        = self.get_parm("fmt","text")
+        self.batch      = self.get_parm("batch",100)
+        self.flush_ms   = self.get_parm("flush_ms",1000)
+        self.rate       = self.get_parm("rate",20)
+        self.burst      = self.get_parm("burst",50)
+        self.file       = self.get_parm("file",None)
+        self.file_sz    = self.get_parm("file_kb",1024) * 1024
+        self.file_count = self.get_parm("file_count",3)
+        self.print      = self.get_parm("print",False)
+
+        # (time, name, msg)
+        self._buf  = collections.deque(maxlen=self.get_parm("buf",1000))
+        self._full = asyncio.Event()
+
+        # name: [tokens, time tokens were counted]
+        self._tokens = {}
+
+        self.dropped   = 0      # pushed out of a full buffer
+        self.limited   = 0      # over a source's rate
+        self.logged    = 0
+        self.batches   = 0
+        self._reported = 0      # dropped + limited already logged
+
     async def run(self):
         self.mqtt = self.get_mqtt()
-    
+
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(),self.flush_ms/1000)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            while len(self._buf) > 0:
+                await self.flush()
+
+    # add a message to the buffer
     async def log_msg(self,name,msg):
-        
-        log_msg = name + ": " + msg
-        
-        if self.mqtt == None:
-            print("no mqtt:",log_msg)
+        t = time.time()
+
+        # refill tokens for time since last message
+        tk = self._tokens.get(name)
+        if tk == None:
+            tk = [self.burst,t]
+            self._tokens[name] = tk
         else:
-            # await mqtt.publish(self._pub_topic,log_msg)
-            print("sending mqtt msg:",self.pub,log_msg)
-            await self.mqtt.publish(self.pub,log_msg)
+            tk[0] = min(self.burst,tk[0] + (t - tk[1]) * self.rate)
+            tk[1] = t
+
+        if tk[0] < 1:
+            self.limited += 1
+            return
+        tk[0] -= 1
+
+        if len(self._buf) == self._buf.maxlen:
+            self.dropped += 1
+        self._buf.append((t,name,str(msg)))
+        self.logged += 1
+
+        if self.print:
+            print(name + ": " + str(msg))
+
+        if len(self._buf) >= self.batch:
+            self._full.set()
+
+    # publish and write up to batch messages
+    async def flush(self):
+        recs = []
+        while len(self._buf) > 0 and len(recs) < self.batch:
+            recs.append(self._buf.popleft())
+
+        lost = self.dropped + self.limited - self._reported
+        if lost > 0:
+            self._reported += lost
+            recs.append((time.time(),self._name,"{} messages dropped".format(lost)))
+
+        if len(recs) == 0:
+            return
+
+        if self.file != None:
+            await asyncio.to_thread(self.write_file,recs)
+
+        if self.mqtt != None:
+            if self.fmt == "json":
+                payload = [[_dt(t),name,msg] for (t,name,msg) in recs]
+            else:
+                payload = "\n".join([name + ": " + msg for (t,name,msg) in recs])
+            self.batches += 1
+            await self.mqtt.publish(self.pub,payload)
+        elif self.file == None and not self.print:
+            for (t,name,msg) in recs:
+                print("no mqtt:",name + ": " + msg)
+
+    # append messages to the log file, rotating it when too big
+    def write_file(self,recs):
+        if file_sz(self.file) >= self.file_sz:
+            for i in range(self.file_count-1,0,-1):
+                if os.path.exists("{}.{}".format(self.file,i)):
+                    os.replace("{}.{}".format(self.file,i),"{}.{}".format(self.file,i+1))
+            if self.file_count > 0:
+                os.replace(self.file,self.file + ".1")
+            else:
+                os.remove(self.file)
+
+        with open(self.file,"a") as f:
+            for (t,name,msg) in recs:
+                f.write("{}\t{}\t{}\n".format(_dt(t),name,msg.replace("\n","↵")))
+
+    def get_stats(self):
+        return {"buffered":len(self._buf), "logged":self.logged, "dropped":self.dropped,
+                "limited":self.limited, "batches":self.batches}
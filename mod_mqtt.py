@@ -6,6 +6,40 @@
     
     Other services use this service to publish and subscribe to MQTT. 
     
+    asyncio_mqtt and ps_secrets are only imported when run() is called
+    so they do not slow down startup of other services.
+
+    Module Parameters:
+      - host          : MQTT broker host name. Default is "10.0.0.231".
+      - client_module : module providing the asyncio_mqtt Client and MqttError.
+                        Default is "asyncio_mqtt". Use "ps_fake_mqtt" for
+                        an in-process broker, see bench_e2e.py.
+      - print         : print each message received and published. Default is true.
+      - print_local   : print messages published to local/ topics. Default is false.
+      - codec         : codec for payloads which are not str or bytes, see ps_codec.
+                        Default is "json".
+      - codecs        : codec for topics matching a filter, for example
+                        {"home/cam/#":"msgpack"}. Default is none.
+      - mqtt5         : connect with MQTT 5 and send the codec's content type as a publish
+                        property. Default is false.
+      - trace         : fraction of messages received to trace, for example 0.01 for 1 in 100,
+                        see ps_trace. Default is 0, no traces.
+      - trace_pub     : topic to publish traces to. Default is "{sys}/trace".
+      - trace_secs    : time hops of a trace are collected before it is published. Default is 2.
+      - reconnect_secs     : time before the first attempt to reconnect, doubled after each
+                             failed attempt. Default is 1.
+      - reconnect_max_secs : longest time between attempts to reconnect. Default is 60.
+      - spool         : file to spool messages published while not connected to, see ps_spool.
+                        Default is none, messages are only sent to local subscribers.
+      - spool_mb      : largest spool size, messages are dropped once it is full. Default is 16.
+      - spool_policy  : policy for topics matching a filter, "all", "latest" or "none",
+                        for example {"+/dht":"latest"}. Default is "all" for every topic.
+      - drain_batch   : most spooled messages published at a time. Default is 500.
+      - drain_rate    : most spooled messages published a second, 0 for no limit. Default is 1000.
+      - drain_first   : true to spool new messages until the spool is drained, so messages
+                        reach the broker in the order published. false to publish new messages
+                        straight away while the spool drains. Default is true.
+
     Notes:
     1. If topic begins with "local/" this service
        a. removes the "local/" prefix
@@ -15,6 +49,9 @@
     2. If there is no wifi service or the wifi service has not yet connected
        or this service has not yet connected to the MQTT broker,
        it will forward published messages to any subscribed service.
+       With a spool they are also spooled and published once connected.
+       Spooled messages already forwarded are not forwarded again when the
+       broker sends them back.
        
        Note that this allows MQTT subscribe/publish to be used without an MQTT broker.
        This can be useful for testing since it allows running the test without
@@ -27,16 +64,19 @@ from ps_mod import PsrpiModule
 import json
 import asyncio
 import binascii
-import ps_secrets
+import collections
 # import queue
 from ps_util import to_str, to_bytes, ticks_ms, ticks_diff
 import sys
 import time
 import gc
-import asyncio_mqtt as aiomqtt
+import importlib
 # import utf8_char
 
 from ps_subscr import Subscription
+import ps_codec
+import ps_trace
+from ps_spool import OutSpool
 
 # make root ca part of this module
 _hivemq_root_ca =  """-----BEGIN CERTIFICATE-----
@@ -71,6 +111,9 @@ mRGunUHBcnWEvgJBQl9nJEiU0Zsnvgc/ubhPgXRR4Xq37Z0j4r7g1SgEEzwxA57d
 emyPxgcYxn/eR44/KJ4EBs+lVDR3veyJm+kXQ99b21/+jh5Xos1AnX5iItreGCc=
 -----END CERTIFICATE-----
 """
+
+# seconds to wait for the broker to send back a spooled message
+_echo_secs = 30
     
 '''
     MQTT Class
@@ -86,20 +129,94 @@ class ModuleService(PsrpiModule):
         self._subscriptions = []       
         self.wifi    = self.get_svc("wifi")
         self._msg_buff = []
+        self.host    = self.get_parm("host","10.0.0.231")
+        self.print   = self.get_parm("print",True)
+        self.mqtt5   = self.get_parm("mqtt5",False)
+
+        # codec for payloads of each topic published, see get_codec
+        self.codec  = ps_codec.get(self.get_parm("codec","json"))
+        self.codecs = [(Subscription(f,None),ps_codec.get(c))
+                       for (f,c) in self.get_parm("codecs",{}).items()]
+        self._topic_codec = {}
+
+        # trace a sample of messages, see ps_trace
+        self.trace      = self.get_parm("trace",0)
+        self.trace_pub  = self.get_parm("trace_pub",None)
+        self.trace_secs = self.get_parm("trace_secs",2)
+        if self.trace_pub == None:
+            try:
+                self.trace_pub = "{sys}/trace".format(**self.get_defaults())
+            except KeyError:
+                self.trace_pub = "trace"
+        self._trace_n = 0
+        self.traced   = 0
+        self.lat      = ps_trace.Stages(self._name)
+
+        self.reconnect     = self.get_parm("reconnect_secs",1)
+        self.reconnect_max = self.get_parm("reconnect_max_secs",60)
+        self.reconnects    = 0
+        self._mqtt_error   = None
+
+        # messages published while not connected, see ps_spool
+        self.spool = None
+        fn = self.get_parm("spool",None)
+        if fn != None:
+            self.spool = OutSpool(fn,self.get_parm("spool_mb",16) * 1024 * 1024,
+                                  self.get_parm("spool_policy",{}))
+        self.drain_batch = self.get_parm("drain_batch",500)
+        self.drain_rate  = self.get_parm("drain_rate",1000)
+        self.drain_first = self.get_parm("drain_first",True)
+        self._drain = asyncio.Event()
+
+        # (topic,payload): spooled messages already forwarded
+        # which the broker has not yet sent back
+        self._echo = {}
+        self._echo_expire = collections.deque()     # (time,(topic,payload))
+        self.echoes = 0
+
+        # message counts, see get_stats
+        self.rcvd       = 0
+        self.dups       = 0
+        self.dispatched = 0
+        self.published  = 0
+        self.pub_local  = 0
 
     def mqtt_callback(self,topic,msg):
+        rcv_t = time.monotonic()
+        self.rcvd += 1
         if self._in_buff(topic,msg):
+            self.dups += 1
+            return
+        if len(self._echo) > 0 and self._is_echo(topic,msg):
+            self.echoes += 1
             return
          
         t = to_str(topic)
-        m = to_str(msg)
+        try:
+            m = to_str(msg)
+        except UnicodeDecodeError:
+            # binary codec payload, see ps_codec
+            m = msg
         
-        print("mod_mqtt: {} rcv {} {}".format(self.get_dt(),t,m))
+        if self.print:
+            print("mod_mqtt: {} rcv {} {}".format(self.get_dt(),t,m))
+
+        # every 1/trace messages is traced, other than the traces published
+        trace_id = None
+        if self.trace > 0 and t != self.trace_pub:
+            self._trace_n += self.trace
+            if self._trace_n >= 1:
+                self._trace_n -= 1
+                self.traced += 1
+                trace_id = ps_trace.start(t,rcv_t)
 
         t_split = t.split('/')
         
         for subscr in self._subscriptions:
-            subscr.put_match(t_split,t,m)
+            if subscr.put_match(t_split,t,m,rcv_t,trace_id):
+                self.dispatched += 1
+
+        self.lat.add("dispatch",rcv_t,trace_id)
             
     # check if we recently received the the same topic and buffer.
     # This deals with duplicate messages received due to the
@@ -124,25 +241,49 @@ class ModuleService(PsrpiModule):
         return False
         
     async def run(self):
-        reconnect_interval = 5  # In seconds
+        # import when needed
+        aiomqtt = importlib.import_module(self.get_parm("client_module","asyncio_mqtt"))
+        try:
+            import ps_secrets
+        except ImportError:
+            ps_secrets = None
+
+        if self.trace > 0:
+            self._trace_task = asyncio.create_task(self.publish_traces())
+
+        if self.spool != None:
+            n = self.spool.open()
+            if n > 0:
+                print("mod_mqtt: {} bytes spooled to publish".format(n))
+            self._drain_task = asyncio.create_task(self.drain())
+
+        self._mqtt_error = aiomqtt.MqttError
+        delay = self.reconnect
         while True:
             try:
                 print("trying to connect to MQTT")
-                async with aiomqtt.Client("10.0.0.231") as client:
+                kw = {}
+                if self.mqtt5:
+                    kw["protocol"] = aiomqtt.ProtocolVersion.V5
+                async with aiomqtt.Client(self.host,**kw) as client:
                     print("mqtt connected")
                     self._client = client
+                    delay = self.reconnect
                     # await self.resubscribe()
                     async with client.messages() as messages:
                         await client.subscribe("#")
                         print("mod_mqtt subscribe #")
+                        self._drain.set()
                         async for msg in messages:
                             self.mqtt_callback(msg.topic,msg.payload)
                             await asyncio.sleep(0)
 
             except aiomqtt.MqttError as error:
                 self._client = None
-                print(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
-                await asyncio.sleep(reconnect_interval)
+                self.reconnects += 1
+                print(f'Error "{error}". Reconnecting in {delay} seconds.')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2,self.reconnect_max)
 
         '''
         async with aiomqtt.Client("10.0.0.231") as client:
@@ -163,6 +304,7 @@ class ModuleService(PsrpiModule):
         await self.log("subscr " + topic_filter)
         
         sub = Subscription(topic_filter,queue,qos)
+        sub._task = asyncio.current_task()
         self._subscriptions.append(sub)
         if self._client != None:
             await sub.subscribe(self._client)
@@ -177,17 +319,60 @@ class ModuleService(PsrpiModule):
             await self.log("resubscr " + to_str(sub._filter))
             await sub.subscribe(self._client)
     
+    # return the codec for topic, codec if given
+    # or the codec of the first matching filter in codecs
+    def get_codec(self,topic,codec=None):
+        if codec != None:
+            return ps_codec.get(codec)
+
+        c = self._topic_codec.get(topic)
+        if c == None:
+            c = self.codec
+            t_split = topic.split('/')
+            for (subscr,tc) in self.codecs:
+                if subscr.filter_match(t_split):
+                    c = tc
+                    break
+            if len(self._topic_codec) > 1000:
+                self._topic_codec.clear()
+            self._topic_codec[topic] = c
+        return c
+
     # publish messages
-    async def publish(self,topic,payload,retain=False, qos=0):
+    # payloads which are not str or bytes are encoded with codec,
+    # by default the topic's codec, see get_codec
+    async def publish(self,topic,payload,retain=False, qos=0, codec=None):
         # if local topic, only send to local services
-        print("{} pub {} {}".format(self.get_dt(),topic,payload))
+        if self.print:
+            print("{} pub {} {}".format(self.get_dt(),topic,payload))
+        self.published += 1
+
+        kw = {}
+        if type(payload) != str and type(payload) != bytes:
+            c = self.get_codec(topic,codec)
+            payload = c.encode(payload)
+            if self.mqtt5:
+                kw["properties"] = ps_codec.props(c)
+
         if topic.startswith('local/'):
+            self.pub_local += 1
             if self.get_parm("print_local",False):
                 print("pub local: ",topic[6:],payload)
             self.mqtt_callback(topic[6:],to_bytes(payload))
         else:
-            if self._client != None:
-                await self._client.publish(topic, to_bytes(payload),retain,qos)
+            # spooled messages are published first
+            if self.spool != None and (self._client == None or
+                                       (self.drain_first and self.spool.pending())):
+                self.spool_msg(topic,payload,qos,retain,self._client == None)
+
+            elif self._client != None:
+                try:
+                    await self._client.publish(topic, to_bytes(payload), qos=qos, retain=retain, **kw)
+                except Exception as e:
+                    # connection lost, run() has not yet seen it
+                    if self.spool == None or not isinstance(e,self._mqtt_error):
+                        raise
+                    self.spool_msg(topic,payload,qos,retain,True)
                 
             # go ahead and publish locally
             else:
@@ -196,9 +381,110 @@ class ModuleService(PsrpiModule):
         # give other tasks a chance to run
         await asyncio.sleep(0)
 
+    # Spool a message to publish once connected. If local, not connected,
+    # the message is also sent to local subscribers as without a spool.
+    def spool_msg(self,topic,payload,qos,retain,local):
+        payload = to_bytes(payload)
+        if local:
+            self.mqtt_callback(topic,payload)
+        self.spool.add(topic,payload,qos,retain,local)
+        if not local:
+            self._drain.set()
+
+    # publish spooled messages while connected, drain_batch at a time
+    # and at most drain_rate a second
+    async def drain(self):
+        spool = self.spool
+        while True:
+            await self._drain.wait()
+            client = self._client
+            if client == None or not spool.pending():
+                self._drain.clear()
+                continue
+
+            sent = 0
+            try:
+                (recs,end,skipped) = await asyncio.to_thread(spool.read,self.drain_batch,spool.snapshot())
+                for (pos,topic,payload,qos,retain,local) in recs:
+                    await client.publish(topic,payload,qos=qos,retain=retain)
+                    # already sent to local subscribers, do not send again
+                    if local:
+                        self._add_echo(topic,payload)
+                    sent += 1
+            except Exception as e:
+                if isinstance(e,self._mqtt_error):
+                    # wait for run() to reconnect
+                    print("mod_mqtt: spool drain stopped {}".format(e))
+                    self._drain.clear()
+                else:
+                    # try again, the spool keeps growing if the drain stops
+                    print("mod_mqtt: spool drain failed {}".format(e))
+                    await asyncio.sleep(self.reconnect)
+                if sent == 0:
+                    continue
+                end = recs[sent][0]
+            try:
+                spool.commit(end,recs[:sent],skipped)
+            except OSError as e:
+                # the position is kept in memory, only a restart sends them again
+                print("mod_mqtt: spool commit failed {}".format(e))
+
+            if self.drain_rate > 0:
+                await asyncio.sleep(len(recs) / self.drain_rate)
+            else:
+                await asyncio.sleep(0)
+
+    def _add_echo(self,topic,payload):
+        key = (topic,payload)
+        self._echo[key] = self._echo.get(key,0) + 1
+        self._echo_expire.append((time.monotonic() + _echo_secs,key))
+
+    def _unecho(self,key):
+        n = self._echo.get(key,0)
+        if n <= 1:
+            self._echo.pop(key,None)
+        else:
+            self._echo[key] = n - 1
+
+    # return True if a message received is a spooled message sent back
+    def _is_echo(self,topic,msg):
+        now = time.monotonic()
+        while len(self._echo_expire) > 0 and self._echo_expire[0][0] < now:
+            self._unecho(self._echo_expire.popleft()[1])
+
+        key = (to_str(topic),to_bytes(msg))
+        if not key in self._echo:
+            return False
+        self._unecho(key)
+        return True
+
+    # publish traces once their hops have been collected
+    async def publish_traces(self):
+        while True:
+            await asyncio.sleep(self.trace_secs / 2)
+            for tr in ps_trace.done(self.trace_secs):
+                await self.publish(self.trace_pub,tr,codec="json")
+
+    # return message counts and the queue of each subscription
+    def get_stats(self):
+        stats = {"rcvd":self.rcvd, "dups":self.dups, "dispatched":self.dispatched,
+                 "published":self.published, "pub_local":self.pub_local,
+                 "connected":self._client != None, "lat_ms":self.lat.summary(),
+                 "subs":[s.get_stats() for s in self._subscriptions]}
+        if self.trace > 0:
+            stats["traced"] = self.traced
+            stats["traces_waiting"] = ps_trace.waiting()
+        stats["reconnects"] = self.reconnects
+        if self.spool != None:
+            stats["spool"] = self.spool.get_stats()
+            stats["echoes"] = self.echoes
+        return stats
+
     # remove all of the subscriptions for a given queue
     async def unsubscribe(self,queue):
-        for s in self._subscriptions:
-            if s._queue == queue:
-                self._subscriptions.remove(s)
+        self._subscriptions = [s for s in self._subscriptions if s._queue != queue]
+
+    # remove all of the subscriptions made by a task
+    def unsubscribe_task(self,task):
+        self._subscriptions = [s for s in self._subscriptions if s._task != task]
                 
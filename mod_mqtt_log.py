@@ -18,7 +18,18 @@
     When acting in this mode, other services can "subscribe" to this service mqtt_log,
     to receive notification that a new record has been received. This service will then
     forward the message to any subscribers who have subscribed to the topic.
-    
+
+    Module Parameters:
+      - log_fn   : log file name. Default is "mqtt_log.txt"
+      - idx_fn   : index file name. Default is none, no index.
+      - sub      : topic to subscribe to and forward - optional
+      - print    : print each message. Default is true.
+      - hot      : true to keep new rows in memory and write them to the files
+                   in large chunks, see ps_hot. Default is false.
+      - hot_dir  : directory for the hot tier journal, on a tmpfs such as /dev/shm,
+                   so rows in memory survive a restart. Default is none, no journal.
+      - hot_kb   : rows in memory are written once they reach this size. Default is 1024.
+      - hot_secs : rows in memory are written at least this often. Default is 60.
     
 """
 
@@ -32,6 +43,9 @@ import ps_util
 from ps_subscr import Subscription
 import struct
 import os
+import time
+from ps_hot import HotTier
+import ps_codec
     
 '''
     MQTT Log Published Messages Class
@@ -46,8 +60,18 @@ class ModuleService(PsrpiModule):
         self.print = self.get_parm("print",True)
 
         self.fn_idx = self.get_parm("idx_fn",None)
+        self.spi_svc = None
 
         self.subs = [] # if we are forwarding msg
+
+        self.hot = None
+        if self.fn != None and self.get_parm("hot",False):
+            hot_dir = self.get_parm("hot_dir",None)
+            journal = None
+            if hot_dir != None:
+                journal = os.path.join(hot_dir,os.path.basename(self.fn) + ".hot")
+            self.hot = HotTier(self.fn,self.fn_idx,journal,
+                               self.get_parm("hot_kb",1024) * 1024,self.get_parm("hot_secs",60))
         
 
     # if a subscription topic is specified, we log all of
@@ -55,6 +79,10 @@ class ModuleService(PsrpiModule):
     # the info to any other services which have subscribed
     # to the topic.
     async def run(self):
+        if self.hot != None:
+            self.hot.recover()
+            self._hot_task = asyncio.create_task(self.hot.run())
+
         sub = self.get_parm("sub",None)
         if sub == None:
             return
@@ -72,6 +100,12 @@ class ModuleService(PsrpiModule):
             data = await q.get()
             await self.publish(data[1],data[2])
     
+    # write rows in the hot tier to the files when stopped by a reload
+    async def stop(self):
+        await super().stop()
+        if self.hot != None:
+            await self.hot.close()
+
     # Subscribe to a given topic
     async def subscribe(self,topic_filter,queue,qos=0):
         # logging might cause loop?
@@ -84,29 +118,32 @@ class ModuleService(PsrpiModule):
         await ps_util.sleep_ms(0)
     
     # publish messages
-    async def publish(self,topic,payload,retain=False, qos=0):
+    async def publish(self,topic,payload,retain=False, qos=0, codec=None):
+        if type(payload) != str and type(payload) != bytes:
+            payload = ps_codec.encode(payload,codec or "json")
         
         if self.print:
             print("svc_mqtt_log publish:",to_str(topic),to_str(payload))
   
         if self.fn != None:
-                        
-            if self.fn_idx != None:
-                self.write_idx()
-            
-            f = open(self.fn,"a")
-            f.write(self.get_dt())
-            f.write('\t')
-            f.write(to_bytes(topic))
-            f.write('\t')
-            
             # remove newline - messes log file
-            s = to_str(payload).replace("\\n","↵")
+            s = ps_codec.to_text(payload).replace("\\n","↵")
             s = s.replace("\n","↵")
-            f.write(to_bytes(s))
-            
-            f.write('\n')
-            f.close()
+
+            if self.hot != None:
+                self.hot.append(self.get_dt() + '\t' + to_str(topic) + '\t' + s)
+            else:
+                if self.fn_idx != None:
+                    self.write_idx()
+
+                f = open(self.fn,"a")
+                f.write(self.get_dt())
+                f.write('\t')
+                f.write(to_str(topic))
+                f.write('\t')
+                f.write(s)
+                f.write('\n')
+                f.close()
 
         # if fowarding msg, send to each matching subscriber
         if len(self.subs) > 0:
@@ -116,7 +153,11 @@ class ModuleService(PsrpiModule):
     # forward messages to local subscribers
     async def local_callback(self,topic,msg):        
         t = to_str(topic)
-        m = to_str(msg)
+        try:
+            m = to_str(msg)
+        except UnicodeDecodeError:
+            # binary codec payload, see ps_codec
+            m = msg
         
         # don't think this would happen,
         # but just in case...
@@ -124,9 +165,10 @@ class ModuleService(PsrpiModule):
             t = t[6:]
         
         t_split = t.split('/')
+        rcv_t = time.monotonic()
         
         for s in self.subs:
-            s.put_match(t_split,t,m)        
+            s.put_match(t_split,t,m,rcv_t)        
             
     # write the current size (next position to write) 
     # as a 4 byte int to the index file
@@ -135,12 +177,14 @@ class ModuleService(PsrpiModule):
         s = file_sz(self.fn)
 
         # write 4 bytes to index file
-        with open(self.fn_idx,'a') as f:
+        with open(self.fn_idx,'ab') as f:
             f.write(struct.pack("i",s))
 
     # return number of enties in the main file.
     # this is simply the length of the index file / 4
     async def log_len(self):
+        if self.hot != None:
+            return self.hot.rows()
         s = file_sz(self.fn_idx)
         return int(s/4)
 
@@ -149,11 +193,16 @@ class ModuleService(PsrpiModule):
     async def read_log_entry(self,idx):
         if self.fn_idx == None:
             return None
+
+        if self.hot != None:
+            ln = self.hot.line(idx)
+            if ln != None:
+                return ln.decode("utf-8").strip()
         
         sz = file_sz(self.fn_idx)
 
         p = idx * 4
-        if p > sz:
+        if p >= sz:
             self.unlock_spi()
             return None
 
@@ -0,0 +1,300 @@
+"""
+    Profiler Module
+
+    Profiles the running process for a set time when requested over MQTT,
+    writes the results to a file and publishes a summary of the top functions
+    or allocations. Nothing is profiled between requests.
+
+    Modes:
+      - cprofile    : cProfile of the event loop thread. With "svc", only the steps
+                      of that service's run() coroutine and of the tasks it created
+                      are profiled, see ps_super.
+                      Written as a pstats file.
+      - sample      : a thread samples the event loop thread's stack every
+                      interval_ms. With "svc", only samples taken while a step of
+                      that service's run() coroutine, or of a task it created, is
+                      running are counted, see ps_super. Lower overhead than
+                      cprofile, but samples are more likely to land on file and
+                      socket calls, where the loop thread releases the GIL.
+                      Written as collapsed stacks, one "f1;f2;f3 count"
+                      line per stack, which flame graph tools can read.
+      - tracemalloc : traces memory allocated while profiling and reports the lines
+                      holding the most memory at the end. With "svc", only allocations
+                      in that service's module are reported. Written as a
+                      tracemalloc snapshot.
+
+    Module Parameters:
+      - sub     : topic for which profile requests can be made.
+      - out_dir : directory profile files are written to. Default is "."
+
+    Profile Requests -
+    The parameters for a profile request are in the MQTT message payload as json:
+        - mode        : "cprofile", "sample" or "tracemalloc" - required
+        - secs        : seconds to profile for. Default is 10.
+        - svc         : name of service to profile. Default is the whole process.
+        - interval_ms : time between stack samples. Default is 5.
+        - top         : number of functions or lines in the summary. Default is 20.
+        - resp_topic  : topic to publish the summary to - optional
+        - stop        : true to stop the profile in progress early.
+
+    Only one profile can run at a time.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# return "file:line(function)" for a code object
+def _func_name(code):
+    return "{}:{}({})".format(os.path.basename(code.co_filename),code.co_firstlineno,code.co_name)
+
+# Thread sampling the stack of thread thread_id every interval_ms.
+# If svc is given, only samples taken while the supervisor sup
+# is running a step of that service are counted.
+class StackSampler(threading.Thread):
+
+    def __init__(self, thread_id, interval_ms, sup=None, svc=None):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.sup = sup
+        self.svc = svc
+        self.stacks  = {}   # (f1,f2,...) outermost first: count
+        self.samples = 0
+        self.skipped = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if self.svc != None:
+                st = self.sup.running
+                if st == None or st.name != self.svc:
+                    self.skipped += 1
+                    continue
+
+            stack = []
+            while frame != None:
+                stack.append(_func_name(frame.f_code))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack,0) + 1
+            self.samples += 1
+
+    # write collapsed stacks
+    def write(self,fn):
+        with open(fn,"w") as f:
+            for (stack,cnt) in sorted(self.stacks.items(),key=lambda s: -s[1]):
+                f.write(";".join(stack))
+                f.write(" {}\n".format(cnt))
+
+    # return top functions by samples in the function itself and in total
+    def summary(self,top):
+        own = {}
+        total = {}
+        for (stack,cnt) in self.stacks.items():
+            if len(stack) == 0:
+                continue
+            own[stack[-1]] = own.get(stack[-1],0) + cnt
+            for fn in set(stack):
+                total[fn] = total.get(fn,0) + cnt
+
+        def pct(d):
+            return [[fn,round(cnt*100/self.samples,1)] for (fn,cnt) in
+                    sorted(d.items(),key=lambda f: -f[1])[:top]]
+
+        return {"samples":self.samples, "skipped":self.skipped,
+                "own_pct":pct(own), "total_pct":pct(total)}
+
+# return top functions by own time from a cProfile.Profile
+def cprofile_summary(prof,top):
+    st = pstats.Stats(prof)
+    funcs = []
+    for (func,(cc,nc,tt,ct,callers)) in st.stats.items():
+        funcs.append(["{}:{}({})".format(os.path.basename(func[0]),func[1],func[2]),
+                      nc,round(tt*1000,3),round(ct*1000,3)])
+    funcs.sort(key=lambda f: -f[2])
+    return {"calls":st.total_calls, "secs":round(st.total_tt,3),
+            "cols":["func","calls","own_ms","total_ms"], "top":funcs[:top]}
+
+# return lines holding the most memory from a tracemalloc snapshot
+def tracemalloc_summary(snap,top):
+    stats = snap.statistics("lineno")
+    return {"kb":round(sum(s.size for s in stats)/1024,1),
+            "cols":["line","kb","count"],
+            "top":[["{}:{}".format(os.path.basename(s.traceback[0].filename),s.traceback[0].lineno),
+                    round(s.size/1024,1),s.count] for s in stats[:top]]}
+
+'''
+    Profiler Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.sub     = self.get_parm("sub",None)
+        self.out_dir = self.get_parm("out_dir",".")
+
+        self._stop = None     # set to stop the profile in progress
+        self._task = None
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    async def run(self):
+        mqtt = self.get_mqtt()
+
+        if self.sub == None:
+            return await self.fatal_err( "{} exiting - no subscribe topic (sub) specified".
+                                  format(self._name))
+
+        q = asyncio.Queue()
+        await mqtt.subscribe(self.sub,q)
+
+        while True:
+            data = await q.get()
+            try:
+                req = json.loads(data[2])
+            except ValueError:
+                await self.fatal_err("{}: invalid json {}".format(self._name,data[2]))
+                continue
+
+            if not isinstance(req,dict):
+                await self.fatal_err("{}: invalid request {}".format(self._name,data[2]))
+            elif req.get("stop",False):
+                if self._stop != None:
+                    self._stop.set()
+            elif self._task != None and not self._task.done():
+                await self.fatal_err("{}: profile already running, ignored {}".format(self._name,data[2]))
+            else:
+                self._task = asyncio.create_task(self.profile_req(req))
+
+    async def profile_req(self,req):
+        try:
+            result = await self.profile(req)
+        except Exception as e:
+            result = {"error":str(e)}
+            await self.fatal_err("{}: profile failed {} {}".format(self._name,req,e))
+
+        await self.log("profile {} {}".format(req.get("mode"),result.get("file",result.get("error"))))
+        if "resp_topic" in req:
+            await self.get_mqtt().publish(req["resp_topic"],result)
+
+    # wait secs or until a stop request
+    async def wait(self,secs):
+        try:
+            await asyncio.wait_for(self._stop.wait(),secs)
+        except asyncio.TimeoutError:
+            pass
+
+    # profile for request req, returning the summary
+    async def profile(self,req):
+        mode = req.get("mode")
+        secs = req.get("secs",10)
+        svc  = req.get("svc",None)
+        top  = req.get("top",20)
+
+        fn = os.path.join(self.out_dir,"prof_{}_{}{}".format(mode,time.strftime("%Y%m%d_%H%M%S"),
+                                                           "_"+svc if svc != None else ""))
+        self._stop = asyncio.Event()
+        t = time.monotonic()
+        try:
+            if mode == "cprofile":
+                fn += ".pstats"
+                result = await self.cprofile(svc,secs,top,fn)
+            elif mode == "sample":
+                fn += ".txt"
+                result = await self.sample(svc,secs,req.get("interval_ms",5),top,fn)
+            elif mode == "tracemalloc":
+                fn += ".tracemalloc"
+                result = await self.trace_malloc(svc,secs,top,fn)
+            else:
+                raise ValueError("unknown mode {}".format(mode))
+        finally:
+            self._stop = None
+
+        result.update({"mode":mode, "svc":svc, "file":fn, "secs":round(time.monotonic()-t,3)})
+        return result
+
+    # return supervisor state of service svc
+    def svc_state(self,svc):
+        sup = self.get_defaults().get("supervisor")
+        if sup == None or not svc in sup.svcs:
+            raise ValueError("service {} is not running".format(svc))
+        return sup.svcs[svc]
+
+    async def cprofile(self,svc,secs,top,fn):
+        prof = cProfile.Profile()
+        if svc == None:
+            prof.enable()
+            try:
+                await self.wait(secs)
+            finally:
+                prof.disable()
+        else:
+            st = self.svc_state(svc)
+            st.prof = prof
+            try:
+                await self.wait(secs)
+            finally:
+                st.prof = None
+
+        prof.dump_stats(fn)
+        return cprofile_summary(prof,top)
+
+    async def sample(self,svc,secs,interval_ms,top,fn):
+        sup = None
+        if svc != None:
+            self.svc_state(svc)
+            sup = self.get_defaults()["supervisor"]
+
+        # The sampler only gets the GIL when the event loop thread releases it,
+        # when waiting for events or every switch interval. Shorten the switch
+        # interval while sampling so busy steps are sampled too.
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch,interval_ms/1000/10))
+
+        sampler = StackSampler(threading.get_ident(),interval_ms,sup,svc)
+        sampler.start()
+        try:
+            await self.wait(secs)
+        finally:
+            sampler.stopped.set()
+            sys.setswitchinterval(switch)
+            await asyncio.to_thread(sampler.join)
+
+        sampler.write(fn)
+        return sampler.summary(top)
+
+    async def trace_malloc(self,svc,secs,top,fn):
+        if tracemalloc.is_tracing():
+            raise ValueError("tracemalloc is already tracing")
+
+        tracemalloc.start()
+        try:
+            await self.wait(secs)
+            snap = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        if svc != None:
+            s = self.get_svc(svc)
+            if s == None:
+                raise ValueError("service {} not found".format(svc))
+            mod = sys.modules[type(s).__module__]
+            snap = snap.filter_traces([tracemalloc.Filter(True,mod.__file__)])
+
+        snap.dump(fn)
+        return tracemalloc_summary(snap,top)
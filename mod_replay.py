@@ -0,0 +1,231 @@
+"""
+    Data Store Replay Module
+
+    Republishes rows saved by mod_ds, for load testing or to rebuild
+    the state of services from the message history.
+
+    Rows are read by a thread with large sequential reads of the data file,
+    see mod_ds iter_rows, and passed to the publishing task in batches through
+    a queue holding at most "read_ahead" batches, so memory use does not depend
+    on the number of rows replayed.
+
+    Module Parameters:
+      - ds         : name of mod_ds module that stores data - must be in same json parms
+      - sub        : topic for which replay requests can be made.
+      - read_ahead : number of batches of rows read ahead of publishing. Default is 8.
+      - batch      : rows in a batch. Default is 256.
+      - chunk      : bytes read from the data file at a time. Default is 1MB.
+
+    Replay Requests -
+    The parameters for a replay request are in the MQTT message payload as json:
+        - resp_topic : topic to publish the result to when done - optional
+        - start_row  : first row to replay. Default is 0
+        - end_row    : replay up to but not including this row. Default is all rows
+        - from_dt    : first date time to replay, for example "4/9/2023 9:00:00"
+        - to_dt      : replay rows before this date time
+        - filter     : only replay rows with a topic matching this filter. Default is "#"
+        - speed      : 1 to publish rows with their original timing, 2 for twice as fast and so on.
+                       0 to publish as fast as possible. Default is 1.
+        - prefix     : added to the front of each topic, for example "local/" to only
+                       publish to local services, or "replay/". Default is "".
+        - stop       : true to stop the replay in progress.
+
+    Requests are run one at a time, a stop request is handled immediately.
+    If mod_ds subscribes to the replayed topics, replayed rows are saved again.
+
+    The result published to resp_topic contains the rows read and published,
+    rows skipped because they did not match the filter or had no valid date time,
+    seconds taken and whether the replay was stopped.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+
+import ps_util
+from ps_subscr import Subscription
+from mod_ds_export import req_range
+
+'''
+    Data Store Replay Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    # parms naming services this service depends on, with defaults
+    DEP_PARMS = {"ds":"ds"}
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.sub        = self.get_parm("sub",None)
+        self.ds         = self.get_parm("ds","ds")
+        self.ds_svc     = None
+        self.read_ahead = self.get_parm("read_ahead",8)
+        self.batch      = self.get_parm("batch",256)
+        self.chunk      = self.get_parm("chunk",1<<20)
+
+        self._stop = None     # set to stop the replay in progress
+        self.state = {}
+
+    async def fatal_err(self,msg):
+        print(msg)
+        await self.log(msg)
+        return msg
+
+    async def run(self):
+        mqtt = self.get_mqtt()
+
+        if self.sub == None:
+            return await self.fatal_err( "{} exiting - no subscribe topic (sub) specified".
+                                  format(self._name))
+
+        self.ds_svc = self.get_svc(self.ds)
+        if self.ds_svc == None:
+            return await self.fatal_err("{} exiting - ds module {} not found".
+                                  format(self._name,self.ds))
+
+        q = asyncio.Queue()
+        await mqtt.subscribe(self.sub,q)
+
+        # stop requests are handled as they arrive,
+        # other requests are run one at a time
+        reqs = asyncio.Queue()
+        self._task = asyncio.create_task(self.run_reqs(reqs))
+
+        while True:
+            data = await q.get()
+            try:
+                req = json.loads(data[2])
+            except ValueError:
+                await self.fatal_err("{}: invalid json {}".format(self._name,data[2]))
+                continue
+
+            if not isinstance(req,dict):
+                await self.fatal_err("{}: invalid request {}".format(self._name,data[2]))
+            elif req.get("stop",False):
+                if self._stop != None:
+                    self._stop.set()
+            else:
+                reqs.put_nowait(req)
+
+    async def run_reqs(self,reqs):
+        while True:
+            req = await reqs.get()
+            try:
+                result = await self.replay(req)
+            except Exception as e:
+                result = {"error":str(e)}
+                await self.fatal_err("{}: replay failed {} {}".format(self._name,req,e))
+
+            await self.log("replay {}".format(result))
+            if "resp_topic" in req:
+                await self.get_mqtt().publish(req["resp_topic"],result)
+
+    # replay rows for request req, returning the result
+    async def replay(self,req):
+        mqtt   = self.get_mqtt()
+        speed  = req.get("speed",1)
+        prefix = req.get("prefix","")
+
+        (start,end) = await asyncio.to_thread(req_range,self.ds_svc,req)
+        subscr = Subscription(req.get("filter","#"),None)
+
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue(self.read_ahead)
+        stop = threading.Event()
+        self._stop = stop
+
+        self.state = {"rows":0, "pub":0, "skip":0, "start":start, "end":end,
+                      "speed":speed, "behind_ms":0}
+        state = self.state
+
+        t0 = time.monotonic()
+        reader = loop.run_in_executor(None,self._read,loop,q,start,end,subscr,stop,state)
+
+        # date time of first row and when it was published
+        first = None
+        try:
+            while True:
+                rows = await q.get()
+                if rows == None:
+                    break
+
+                for (secs,topic,payload) in rows:
+                    if speed > 0:
+                        if first == None:
+                            first = (secs,time.monotonic())
+                        wait = first[1] + (secs - first[0]) / speed - time.monotonic()
+                        state["behind_ms"] = max(0,round(-wait * 1000))
+                        # wake up to check for a stop request during long gaps
+                        while wait > 0 and not stop.is_set():
+                            await asyncio.sleep(min(wait,0.5))
+                            wait = first[1] + (secs - first[0]) / speed - time.monotonic()
+
+                    await mqtt.publish(prefix + topic,payload)
+                    state["pub"] += 1
+
+                    if stop.is_set():
+                        break
+                if stop.is_set():
+                    break
+        finally:
+            stop.set()
+            self._stop = None
+            await reader
+
+        return {"rows":state["rows"], "pub":state["pub"], "skip":state["skip"],
+                "start_row":start, "secs":round(time.monotonic() - t0,3),
+                "stopped":state["pub"] + state["skip"] < state["rows"]}
+
+    # Read rows start to end in a thread, putting batches of
+    # (secs,topic,payload) on queue q. None is put on q when done.
+    def _read(self,loop,q,start,end,subscr,stop,state):
+        rows = []
+        try:
+            for (row,ln) in self.ds_svc.iter_rows(start,end,self.chunk):
+                if stop.is_set():
+                    return
+
+                state["rows"] += 1
+                r = ln.split('\t',2)
+                try:
+                    secs = ps_util.dt_secs(r[0])
+                except ValueError:
+                    secs = None
+                if secs == None or len(r) < 3 or not subscr.filter_match(r[1].split('/')):
+                    state["skip"] += 1
+                    continue
+
+                rows.append((secs,r[1],r[2]))
+                if len(rows) >= self.batch:
+                    self._put(loop,q,rows,stop)
+                    rows = []
+
+            if len(rows) > 0:
+                self._put(loop,q,rows,stop)
+        finally:
+            self._put(loop,q,None,stop)
+
+    # put rows on q, waiting while it is full unless stopped
+    def _put(self,loop,q,rows,stop):
+        if stop.is_set() and rows != None:
+            return
+
+        f = asyncio.run_coroutine_threadsafe(q.put(rows),loop)
+        while True:
+            try:
+                f.result(0.2)
+                return
+            except concurrent.futures.TimeoutError:
+                # queue is full, so publishing will see stop
+                if stop.is_set():
+                    f.cancel()
+                    return
+
+    def get_stats(self):
+        return self.state
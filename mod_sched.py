@@ -0,0 +1,255 @@
+"""
+    Scheduler Module
+
+    Runs all scheduled jobs from a single task. Jobs are kept in a heap
+    ordered by when they are next due, and the task sleeps until the first
+    one is due, or a job is registered or cancelled.
+
+    Jobs are one of:
+      - interval : every interval_ms, first after start_ms, default interval_ms.
+                   The next time is from when the job was due,
+                   not when it ran, so jobs do not drift. If a job is late by more
+                   than its interval, the missed runs are skipped and counted.
+      - cron     : "minute hour day month weekday" in local time, each field
+                   "*", a number, a range "a-b", a list "a,b,c" or a step "*/n".
+                   Weekday 0 is Sunday. For example "*/15 8-17 * * 1-5".
+      - one shot : once after delay_ms.
+
+    Each job can have jitter_ms, a random delay of up to jitter_ms added each time
+    it runs so jobs with the same schedule, such as device polls, are spread out
+    instead of arriving in one burst. Jitter does not move the schedule.
+
+    A job either publishes msg to topic, or calls callback(). If callback
+    returns a coroutine it is run as a separate task.
+
+    Other services register jobs with:
+        sched = self.get_svc("sched")
+        job = sched.register("poll",topic="home/poll",interval_ms=60000,jitter_ms=5000)
+        sched.cancel(job)    # or sched.cancel("poll")
+
+    Module Parameters:
+      - jobs : list of jobs to register at startup, each a dictionary with the
+               register() arguments, for example
+               [{"name":"poll", "topic":"home/poll", "msg":"", "interval_ms":60000, "jitter_ms":5000},
+                {"name":"night", "topic":"home/lights", "msg":"off", "cron":"0 23 * * *"}]
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import heapq
+import random
+import time
+
+from ps_stats import Histogram
+
+# return set of values in a cron field
+def _cron_field(f,lo,hi):
+    vals = set()
+    for part in f.split(','):
+        step = 1
+        if '/' in part:
+            (part,step) = part.split('/')
+            step = int(step)
+        if part == '*':
+            (a,b) = (lo,hi)
+        elif '-' in part:
+            (a,b) = [int(v) for v in part.split('-')]
+        else:
+            a = b = int(part)
+        if a < lo or b > hi or a > b or step < 1:
+            raise ValueError("cron field {} out of range {}-{}".format(f,lo,hi))
+        vals.update(range(a,b+1,step))
+    return vals
+
+# Cron schedule "minute hour day month weekday"
+class Cron:
+
+    def __init__(self, spec):
+        f = spec.split()
+        if len(f) != 5:
+            raise ValueError("cron needs 5 fields: {}".format(spec))
+        self.spec    = spec
+        self.minutes = _cron_field(f[0],0,59)
+        self.hours   = _cron_field(f[1],0,23)
+        self.days    = _cron_field(f[2],1,31)
+        self.months  = _cron_field(f[3],1,12)
+        self.wdays   = _cron_field(f[4],0,6)
+        self.any_day  = f[2] == '*'
+        self.any_wday = f[4] == '*'
+
+    def _day_match(self,t):
+        wday = (t.tm_wday + 1) % 7      # tm_wday 0 is Monday
+        if self.any_day or self.any_wday:
+            return t.tm_mday in self.days and wday in self.wdays
+        # like cron, either day or weekday
+        return t.tm_mday in self.days or wday in self.wdays
+
+    # return the next time after secs, seconds since the epoch, matching the schedule
+    def next(self,secs):
+        t = int(secs) // 60 * 60 + 60
+        end = t + 366 * 24 * 3600
+        while t < end:
+            lt = time.localtime(t)
+            if not (lt.tm_mon in self.months and self._day_match(lt)):
+                # start of next day
+                t += (24 - lt.tm_hour) * 3600 - lt.tm_min * 60
+                continue
+            if not lt.tm_hour in self.hours:
+                t += 3600 - lt.tm_min * 60
+                continue
+            if lt.tm_min in self.minutes:
+                return t
+            t += 60
+        raise ValueError("cron {} never runs".format(self.spec))
+
+class Job:
+
+    def __init__(self, name, callback=None, topic=None, msg="",
+                 interval_ms=None, cron=None, delay_ms=None, jitter_ms=0, start_ms=None):
+        if callback == None and topic == None:
+            raise ValueError("job {} needs a callback or topic".format(name))
+        if [interval_ms,cron,delay_ms].count(None) != 2:
+            raise ValueError("job {} needs one of interval_ms, cron or delay_ms".format(name))
+
+        self.name = name
+        self.callback = callback
+        self.topic = topic
+        self.msg = msg
+        self.interval = None if interval_ms == None else interval_ms / 1000
+        self.cron = None if cron == None else Cron(cron)
+        self.delay = None if delay_ms == None else delay_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.start  = None if start_ms == None else start_ms / 1000
+
+        self.due = None         # time.monotonic() job is next due, without jitter
+        self.cancelled = False
+        self.runs = 0
+        self.missed = 0
+
+    # set when the job is first due
+    def first(self,now):
+        if self.interval != None:
+            if self.start != None:
+                self.due = now + self.start
+            else:
+                self.due = now + self.interval
+        elif self.cron != None:
+            self.due = now + self.cron.next(time.time()) - time.time()
+        else:
+            self.due = now + self.delay
+
+    # set when the job is next due after running, False if it is not to run again
+    def reschedule(self,now):
+        if self.interval != None:
+            self.due += self.interval
+            if self.due < now:
+                missed = int((now - self.due) / self.interval) + 1
+                self.missed += missed
+                self.due += missed * self.interval
+            return True
+        if self.cron != None:
+            self.due = now + self.cron.next(time.time()) - time.time()
+            return True
+        return False
+
+'''
+    Scheduler Class
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self._heap = []         # (run time, seq, job)
+        self._seq  = 0
+        self._jobs = {}         # name: job
+        self._wake = asyncio.Event()
+        self._tasks = set()     # callback tasks still running
+
+        self.fired   = 0
+        self.late_ms = Histogram()
+
+        for j in self.get_parm("jobs",[]):
+            self.register(**j)
+
+    # register a job, replacing any job with the same name, see Job
+    def register(self,name,**kwargs):
+        job = Job(name,**kwargs)
+        self.cancel(name)
+        self._jobs[name] = job
+        job.first(time.monotonic())
+        self._push(job)
+        return job
+
+    # cancel a job or the job named job
+    def cancel(self,job):
+        if type(job) == str:
+            job = self._jobs.get(job)
+        if job == None:
+            return
+        job.cancelled = True
+        if self._jobs.get(job.name) == job:
+            del self._jobs[job.name]
+        # removed from the heap when it comes due
+        self._wake.set()
+
+    def _push(self,job):
+        self._seq += 1
+        heapq.heappush(self._heap,(job.due + random.uniform(0,job.jitter),self._seq,job))
+        self._wake.set()
+
+    # times are time.monotonic(), which is also the event loop's clock
+    async def run(self):
+        while True:
+            self._wake.clear()
+            heap = self._heap
+
+            # drop cancelled jobs from the top of the heap
+            while len(heap) > 0 and heap[0][2].cancelled:
+                heapq.heappop(heap)
+
+            if len(heap) == 0:
+                await self._wake.wait()
+                continue
+
+            wait = heap[0][0] - time.monotonic()
+            if wait > 0:
+                # wake when the job is due or the jobs change. Not wait_for,
+                # which loses a cancel that arrives as the event is set.
+                timer = asyncio.get_running_loop().call_later(wait,self._wake.set)
+                try:
+                    await self._wake.wait()
+                finally:
+                    timer.cancel()
+                continue
+
+            (t,seq,job) = heapq.heappop(heap)
+            now = time.monotonic()
+            self.late_ms.add((now - t) * 1000)
+            await self.fire(job)
+            if job.reschedule(now) and not job.cancelled:
+                self._push(job)
+            elif self._jobs.get(job.name) == job:
+                del self._jobs[job.name]
+
+    async def fire(self,job):
+        job.runs += 1
+        self.fired += 1
+        try:
+            if job.callback != None:
+                r = job.callback()
+                if asyncio.iscoroutine(r):
+                    task = asyncio.create_task(r)
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            else:
+                await self.get_mqtt().publish(job.topic,job.msg)
+        except Exception as e:
+            await self.log("job {} failed {}".format(job.name,e))
+
+    def get_stats(self):
+        return {"jobs":len(self._jobs), "fired":self.fired,
+                "missed":sum(j.missed for j in self._jobs.values()),
+                "late_ms":self.late_ms.summary()}
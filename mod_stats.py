@@ -0,0 +1,129 @@
+"""
+    Statistics Module
+
+    Periodically publishes the statistics of every service which keeps them,
+    such as mqtt message counts and subscription queue depths, datastore rows,
+    bytes and save times and ds_get request latencies, see each service's get_stats().
+    Also publishes the process memory use, event loop lag, supervisor service
+    step times, garbage collection pauses and parms reloads.
+
+    Services only count and add to histograms as they run, the statistics are
+    only gathered when published, so it is cheap enough to leave running.
+
+    Published payload is a dictionary:
+        {"dt":..., "pid":..., "mem":{...}, "lag_ms":{...},
+         "svc":{service name:stats}, "supervisor":{...}, "gc":{...}, "reload":{...}}
+
+    Module Parameters:
+      - pub      : topic to publish statistics to. Default is "{sys}/stats".
+      - pub_secs : seconds between publishing. Default is 60.
+      - lag_ms   : how often to measure event loop lag. Default is 1000.
+      - services : list of service names to publish statistics for. Default is all.
+      - reset    : if true, reset the loop lag histogram after publishing. Default is false.
+"""
+
+from ps_mod import PsrpiModule
+import asyncio
+import gc
+import os
+import time
+
+from ps_stats import Histogram
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# return process memory use in KB
+def mem_stats():
+    mem = {"gc_count":gc.get_count()}
+
+    # current resident set size, linux only
+    try:
+        with open("/proc/self/statm") as f:
+            pages = f.read().split()
+        mem["rss_kb"] = int(pages[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError,ValueError,AttributeError):
+        pass
+
+    # peak resident set size, KB on linux
+    if resource != None:
+        mem["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return mem
+
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+
+        self.pub      = self.get_parm("pub",None)
+        self.pub_secs = self.get_parm("pub_secs",60)
+        self.lag_int  = self.get_parm("lag_ms",1000)
+        self.svc_names = self.get_parm("services",None)
+        self.reset_lag = self.get_parm("reset",False)
+
+        if self.pub == None:
+            try:
+                self.pub = "{sys}/stats".format(**self.get_defaults())
+            except KeyError:
+                self.pub = "stats"
+
+        self.lag_ms = Histogram()
+
+    async def run(self):
+        mqtt = self.get_mqtt()
+
+        self._lag_task = asyncio.create_task(self.measure_lag())
+
+        while True:
+            await asyncio.sleep(self.pub_secs)
+            await mqtt.publish(self.pub,self.get_all_stats())
+            if self.reset_lag:
+                self.lag_ms.reset()
+
+    # time how late the event loop is in waking up from a sleep
+    async def measure_lag(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(self.lag_int/1000)
+            self.lag_ms.add(max(0,(time.perf_counter() - t) * 1000 - self.lag_int))
+
+    def get_stats(self):
+        return {"lag_ms":self.lag_ms.summary()}
+
+    # gather statistics from all services
+    def get_all_stats(self):
+        defaults = self.get_defaults()
+        services = defaults["services"]
+
+        names = self.svc_names
+        if names == None:
+            names = list(services)
+
+        svc = {}
+        for name in names:
+            s = services.get(name)
+            if s == None or s == self:
+                continue
+            try:
+                st = s.get_stats()
+            except Exception as e:
+                st = {"error":str(e)}
+            if st != None:
+                svc[name] = st
+
+        stats = {"dt":self.get_dt(), "pid":os.getpid(), "mem":mem_stats(),
+                 "lag_ms":self.lag_ms.summary(), "svc":svc}
+
+        for k in ["supervisor","gc","reload"]:
+            if k in defaults and hasattr(defaults[k],"get_stats"):
+                stats[k] = defaults[k].get_stats()
+
+        workers = defaults.get("proc_workers",{})
+        if len(workers) > 0:
+            stats["workers"] = dict((str(n),w.get_stats()) for (n,w) in workers.items())
+
+        return stats
@@ -9,6 +9,13 @@
     
     Service will wait 10ms between publishing so it doesn't send
     too many messages in a short period of time.
+
+    If there is a scheduler service (mod_sched), named by the "sched" parm,
+    default "sched", each topic is registered with it as an interval job
+    instead and this service's task ends. Each publish is then delayed by a
+    random time of up to jitter_ms, default sleep_ms, so topics are spread out
+    rather than published one after another. The jobs are cancelled when the
+    service is stopped, and the service is restarted with the scheduler.
     
 """
 
@@ -20,9 +27,14 @@ import time
 
 # All initialization classes are named ModuleService
 class ModuleService(PsrpiModule):
+
+    # parms naming services this service depends on, with defaults
+    DEP_PARMS = {"sched":"sched"}
     
     def __init__(self, parms):
         super().__init__(parms)
+        self._sched = None
+        self._jobs  = []    # names of jobs registered with the scheduler
         
     async def run(self):
         
@@ -36,6 +48,19 @@ class ModuleService(PsrpiModule):
         initial_wait_ms = self.get_parm("init_wait",wait)*1000
         sleep     = self.get_parm("sleep_ms",10)
         
+        # let the scheduler publish, if there is one
+        sched = self.get_svc(self.get_parm("sched","sched"))
+        if sched != None:
+            self._sched = sched
+            jitter_ms = self.get_parm("jitter_ms",sleep)
+            for i in range(len(topics)):
+                m = msg[i] if i < len(msg) else ""
+                name = "{}/{}".format(self._name,i)
+                sched.register(name,topic=topics[i],msg=m,
+                               interval_ms=wait_ms,start_ms=initial_wait_ms,jitter_ms=jitter_ms)
+                self._jobs.append(name)
+            return
+
         # function aliases 
         ticks_add = ps_util.ticks_add
         ticks_ms  = ps_util.ticks_ms
@@ -44,7 +69,6 @@ class ModuleService(PsrpiModule):
         next_time = ticks_add(ticks_ms(),initial_wait_ms)
         
         while True:
-            print("sleeping {}ms".format(ticks_add(next_time,-ticks_ms())))
             await sleep_ms(ticks_add(next_time,-ticks_ms()))
             next_time = ticks_add(next_time,wait_ms)
             
@@ -56,3 +80,11 @@ class ModuleService(PsrpiModule):
                     
                 await mqtt.publish(topics[i],m)
                 await sleep_ms(sleep)
+
+    # cancel the jobs registered with the scheduler
+    async def stop(self):
+        await super().stop()
+        if self._sched != None:
+            for name in self._jobs:
+                self._sched.cancel(name)
+        self._jobs = []
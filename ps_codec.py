@@ -0,0 +1,110 @@
+'''
+    Payload codecs - encode python objects published as MQTT payloads
+    and decode them when received.
+
+    Codecs:
+      - json    : stdlib json, always available
+      - orjson  : json using the orjson package, if installed. Same
+                  payloads as json, several times faster.
+      - msgpack : MessagePack using the msgpack package, if installed
+      - cbor    : CBOR using the cbor2 package, if installed
+
+    Services choose a codec by name, see mod_mqtt publish() and its
+    "codecs" parameter, and the "codec" field of mod_ds_get requests.
+    Payloads encoded with a binary codec are not utf-8 text, so they are
+    passed to subscribers as bytes instead of str. Use decode() with the
+    codec the publisher used, advertised as the message's content type
+    when mod_mqtt uses MQTT 5, see props().
+'''
+
+import base64
+import json
+
+class Codec:
+
+    def __init__(self, name, content_type, encode, decode, binary=False):
+        self.name = name
+        self.content_type = content_type
+        self.encode = encode    # object to bytes
+        self.decode = decode    # bytes or str to object
+        self.binary = binary    # payloads are not utf-8 text
+
+    def __repr__(self):
+        return "Codec({})".format(self.name)
+
+_codecs = {}
+
+# add a codec to the registry, replacing any with the same name
+def register(codec):
+    _codecs[codec.name] = codec
+
+# return codec name, raising ValueError if it is not available
+def get(name):
+    c = _codecs.get(name)
+    if c == None:
+        raise ValueError("codec {} not available, available are {}".format(name,", ".join(names())))
+    return c
+
+def has(name):
+    return name in _codecs
+
+# names of the codecs available
+def names():
+    return list(_codecs)
+
+def encode(obj,name="json"):
+    return get(name).encode(obj)
+
+def decode(data,name="json"):
+    return get(name).decode(data)
+
+# Return a payload as text to save, for example in mod_ds.
+# Payloads which are not utf-8, from binary codecs, are saved as
+# "b64:" and the payload in base64.
+def to_text(payload):
+    if type(payload) == str:
+        return payload
+    if type(payload) == bytes:
+        try:
+            return payload.decode("utf-8")
+        except UnicodeDecodeError:
+            return "b64:" + base64.b64encode(payload).decode("ascii")
+    return str(payload)
+
+class _Props:
+    pass
+
+# Return MQTT 5 publish properties with codec's content type,
+# as ContentType and a "content-type" user property
+def props(codec):
+    try:
+        from paho.mqtt.properties import Properties
+        from paho.mqtt.packettypes import PacketTypes
+        p = Properties(PacketTypes.PUBLISH)
+    except ImportError:
+        p = _Props()
+    p.ContentType = codec.content_type
+    p.UserProperty = [("content-type",codec.content_type)]
+    return p
+
+register(Codec("json","application/json",lambda o: json.dumps(o).encode("utf-8"),json.loads))
+
+try:
+    import orjson
+    register(Codec("orjson","application/json",orjson.dumps,orjson.loads))
+except ImportError:
+    pass
+
+try:
+    import msgpack
+    register(Codec("msgpack","application/msgpack",
+                   lambda o: msgpack.packb(o,use_bin_type=True),
+                   lambda b: msgpack.unpackb(b,raw=False),True))
+except ImportError:
+    pass
+
+try:
+    import cbor2
+    register(Codec("cbor","application/cbor",cbor2.dumps,cbor2.loads,True))
+except ImportError:
+    pass
@@ -0,0 +1,178 @@
+'''
+    In-process fake of the asyncio_mqtt client, for tests and benchmarks.
+
+    Supports the parts of asyncio_mqtt used by mod_mqtt:
+        async with Client(hostname) as client:
+            async with client.messages() as messages:
+                await client.subscribe("#")
+                async for msg in messages:
+                    ... msg.topic, msg.payload ...
+            await client.publish(topic,payload,qos=0,retain=False)
+
+    Each hostname is a separate broker, so tests can use more than one.
+    Messages published to a broker are delivered to every client of that broker
+    with a matching subscription, including the publisher. Retained messages
+    are delivered to new subscriptions.
+
+    To use with mod_mqtt set its parms:
+        {"name":"mqtt", "module":"mod_mqtt", "client_module":"ps_fake_mqtt"}
+
+    Call a broker's set_down(True) to drop its clients and refuse connections.
+'''
+
+import asyncio
+
+from ps_util import to_bytes
+
+class MqttError(Exception):
+    pass
+
+class ProtocolVersion:
+    V31  = 3
+    V311 = 4
+    V5   = 5
+
+class Message:
+
+    def __init__(self, topic, payload, qos=0, retain=False, properties=None):
+        self.topic   = topic
+        self.payload = payload
+        self.qos     = qos
+        self.retain  = retain
+        self.properties = properties
+
+# return True if MQTT topic filter matches topic
+def topic_match(topic_filter,topic):
+    f = topic_filter.split('/')
+    t = topic.split('/')
+    for i in range(len(f)):
+        if f[i] == '#':
+            return True
+        if i >= len(t):
+            return False
+        if f[i] != '+' and f[i] != t[i]:
+            return False
+    return len(f) == len(t)
+
+class FakeBroker:
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.clients  = []
+        self.retained = {}
+        self.down     = False
+        self.published = 0
+
+    # stop or restart the broker
+    def set_down(self,down=True):
+        self.down = down
+        if down:
+            for c in list(self.clients):
+                c.disconnect()
+
+    def publish(self,topic,payload,qos=0,retain=False,properties=None):
+        self.published += 1
+        if retain:
+            if len(payload) == 0:
+                self.retained.pop(topic,None)
+            else:
+                self.retained[topic] = payload
+
+        msg = Message(topic,payload,qos,retain,properties)
+        for c in self.clients:
+            c._deliver(msg)
+
+_brokers = {}
+
+# return the broker for hostname, creating it if needed
+def get_broker(hostname):
+    b = _brokers.get(hostname)
+    if b == None:
+        b = FakeBroker(hostname)
+        _brokers[hostname] = b
+    return b
+
+# remove all brokers
+def reset():
+    _brokers.clear()
+
+class _Messages:
+
+    def __init__(self, queue):
+        self._queue = queue
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self._queue.get()
+        if msg == None:
+            raise MqttError("disconnected")
+        return msg
+
+class _MessagesCtx:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def __aenter__(self):
+        return _Messages(self._client._queue)
+
+    async def __aexit__(self,*args):
+        pass
+
+class Client:
+
+    def __init__(self, hostname, port=1883, **kwargs):
+        self._broker = get_broker(hostname)
+        self._filters = []
+        self._queue = asyncio.Queue()
+        self._connected = False
+
+    async def __aenter__(self):
+        if self._broker.down:
+            raise MqttError("broker {} is down".format(self._broker.hostname))
+        self._broker.clients.append(self)
+        self._connected = True
+        return self
+
+    async def __aexit__(self,*args):
+        self.disconnect()
+
+    # drop the connection, as if the broker went away
+    def disconnect(self):
+        if self._connected:
+            self._connected = False
+            self._broker.clients.remove(self)
+            self._queue.put_nowait(None)
+
+    def _deliver(self,msg):
+        for f in self._filters:
+            if topic_match(f,msg.topic):
+                self._queue.put_nowait(msg)
+                return
+
+    def messages(self):
+        return _MessagesCtx(self)
+
+    async def subscribe(self,topic,qos=0,**kwargs):
+        self._check()
+        if not topic in self._filters:
+            self._filters.append(topic)
+        for (t,p) in list(self._broker.retained.items()):
+            if topic_match(topic,t):
+                self._queue.put_nowait(Message(t,p,qos,True))
+
+    async def unsubscribe(self,topic,**kwargs):
+        if topic in self._filters:
+            self._filters.remove(topic)
+
+    async def publish(self,topic,payload=None,qos=0,retain=False,properties=None,**kwargs):
+        self._check()
+        if payload == None:
+            payload = b''
+        self._broker.publish(topic,to_bytes(payload),qos,retain,properties)
+
+    def _check(self):
+        if not self._connected or self._broker.down:
+            raise MqttError("not connected")
@@ -0,0 +1,141 @@
+'''
+    Token Index - full text index of data store rows.
+
+    Maps each token in a row's topic and payload to a posting list,
+    a sorted array of the numbers of the rows containing the token.
+    Tokens are lower case runs of letters, digits and '_'.
+
+    Rows are added to an in memory delta as they are saved.
+    compact() merges the delta into the base posting lists
+    and write() saves the base lists to a file so only rows
+    added since the last compaction need to be re-indexed on restart.
+
+    File format is a json header line {"rows":n} where n is the number
+    of rows indexed, followed by a line per token:
+        token<tab>first row,difference to next row,...
+'''
+
+import array
+import bisect
+import json
+import os
+import re
+
+_tok_re = re.compile(r'[0-9a-z_]+')
+
+# return the set of tokens in a string
+def tokens(s):
+    return set(t for t in _tok_re.findall(s.lower()) if len(t) <= 32)
+
+class TokenIndex:
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.rows = 0       # rows 0 to rows-1 have been indexed
+        self._base  = {}    # token: array of rows
+        self._delta = {}    # token: array of rows added since compact()
+
+    # add row with topic and payload to the index
+    def add(self,row,topic,payload):
+        for t in tokens(topic) | tokens(payload):
+            a = self._delta.get(t)
+            if a == None:
+                a = array.array('i')
+                self._delta[t] = a
+            a.append(row)
+
+        if row >= self.rows:
+            self.rows = row + 1
+
+    def _postings(self,t):
+        b = self._base.get(t)
+        d = self._delta.get(t)
+        if d == None:
+            return b
+        if b == None:
+            return d
+        return b + d
+
+    # Generator of rows containing all tokens in terms,
+    # newest (highest row number) first, starting before row before.
+    def search(self,terms,before=None):
+        toks = tokens(terms)
+        if len(toks) == 0:
+            return
+
+        lists = []
+        for t in toks:
+            p = self._postings(t)
+            if p == None:
+                return
+            lists.append(p)
+
+        # walk the shortest list, checking the others with binary search
+        lists.sort(key=len)
+        first = lists[0]
+        others = lists[1:]
+
+        i = len(first)
+        if before != None:
+            i = bisect.bisect_left(first,before)
+
+        while i > 0:
+            i -= 1
+            row = first[i]
+            for p in others:
+                j = bisect.bisect_left(p,row)
+                if j >= len(p) or p[j] != row:
+                    break
+            else:
+                yield row
+
+    # number of tokens waiting to be compacted
+    def delta_len(self):
+        return len(self._delta)
+
+    # merge the delta into the base posting lists
+    def compact(self):
+        for (t,d) in self._delta.items():
+            b = self._base.get(t)
+            if b == None:
+                self._base[t] = d
+            else:
+                b.extend(d)
+        self._delta = {}
+
+    # write the base posting lists to the index file.
+    # Can be run in a thread since rows are only added to
+    # the delta which is not written.
+    def write(self,rows):
+        tmp = self.fn + ".tmp"
+        with open(tmp,"w") as f:
+            f.write(json.dumps({"rows":rows}))
+            f.write("\n")
+            for (t,b) in list(self._base.items()):
+                prev = 0
+                d = []
+                for r in b:
+                    d.append(str(r - prev))
+                    prev = r
+                f.write(t)
+                f.write("\t")
+                f.write(",".join(d))
+                f.write("\n")
+
+        os.replace(tmp,self.fn)
+
+    # load the base posting lists from the index file if it exists
+    def load(self):
+        if self.fn == None or not os.path.exists(self.fn):
+            return
+
+        with open(self.fn) as f:
+            self.rows = json.loads(f.readline())["rows"]
+            for ln in f:
+                (t,d) = ln.rstrip("\n").split("\t")
+                a = array.array('i')
+                r = 0
+                for x in d.split(","):
+                    r += int(x)
+                    a.append(r)
+                self._base[t] = a
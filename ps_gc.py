@@ -0,0 +1,114 @@
+'''
+    Garbage Collection Policy
+
+    Controls when psrpi_main runs the python garbage collector
+    and times every collection.
+
+    Parameters are in the "gc" dictionary of the main parms json:
+      - policy     : one or a list of:
+            "legacy" : collect before each service is created and started, then every 5 seconds.
+            "freeze" : collect once after services start then gc.freeze() the startup heap
+                       so later collections do not scan it.
+            "tune"   : set the generation thresholds to "thresholds".
+            "idle"   : disable automatic collection and collect young generations
+                       only when the event loop is idle. A full collection is run
+                       every full_secs, when the loop is idle.
+                       Default is "legacy".
+      - thresholds : [gen0,gen1,gen2] thresholds for "tune". Default is [2000,20,20].
+      - idle_ms    : how often to check if the loop is idle. Default is 1000.
+      - idle_lag_ms: loop is idle if a sleep of idle_ms is late by less than this. Default is 5.
+      - max_gen0   : with "idle", collect generation 0 even if not idle once this many
+                     objects have been allocated. Default is 50000.
+      - full_secs  : seconds between full collections with "idle". Default is 600.
+      - pub        : topic to publish collection pause times to. Default is none.
+      - pub_secs   : seconds between publishing. Default is 60.
+'''
+
+import asyncio
+import gc
+import time
+
+from ps_stats import Histogram
+
+class GcPolicy:
+
+    def __init__(self, parms={}):
+        policy = parms.get("policy","legacy")
+        if type(policy) == str:
+            policy = [policy]
+        self.policy = policy
+
+        self.thresholds  = parms.get("thresholds",[2000,20,20])
+        self.idle_ms     = parms.get("idle_ms",1000)
+        self.idle_lag_ms = parms.get("idle_lag_ms",5)
+        self.max_gen0    = parms.get("max_gen0",50000)
+        self.full_secs   = parms.get("full_secs",600)
+        self.pub         = parms.get("pub",None)
+        self.pub_secs    = parms.get("pub_secs",60)
+
+        # pause time of collections of each generation
+        self.pause_ms = [Histogram(),Histogram(),Histogram()]
+        self.collected = 0
+        self._t = 0
+        gc.callbacks.append(self._callback)
+
+    # called by gc at the start and end of each collection
+    def _callback(self,phase,info):
+        if phase == "start":
+            self._t = time.perf_counter()
+        else:
+            self.pause_ms[info["generation"]].add((time.perf_counter() - self._t) * 1000)
+            self.collected += info["collected"]
+
+    # called during startup, before each service is created and started
+    def startup(self):
+        if "legacy" in self.policy:
+            gc.collect()
+
+    # called once all services have been started
+    def after_init(self):
+        if "tune" in self.policy:
+            gc.set_threshold(*self.thresholds)
+
+        if "freeze" in self.policy:
+            gc.collect()
+            gc.freeze()
+
+        if "idle" in self.policy:
+            gc.disable()
+
+    def get_stats(self):
+        return {"policy":self.policy,
+                "pause_ms":dict((str(i),self.pause_ms[i].summary()) for i in range(3)),
+                "collected":self.collected,
+                "count":gc.get_count(),
+                "frozen":gc.get_freeze_count()}
+
+    # runs forever in place of psrpi_main's idle loop
+    async def run(self,services):
+        idle = "idle" in self.policy
+        t_pub  = time.monotonic()
+        t_full = time.monotonic()
+
+        while True:
+            if "legacy" in self.policy:
+                gc.collect()
+                await asyncio.sleep(5)
+            else:
+                t = time.monotonic()
+                await asyncio.sleep(self.idle_ms/1000)
+                lag_ms = (time.monotonic() - t) * 1000 - self.idle_ms
+
+                if idle:
+                    if time.monotonic() - t_full > self.full_secs and lag_ms < self.idle_lag_ms:
+                        gc.collect()
+                        t_full = time.monotonic()
+                    elif lag_ms < self.idle_lag_ms:
+                        gc.collect(1)
+                    elif gc.get_count()[0] > self.max_gen0:
+                        gc.collect(0)
+
+            mqtt = services.get("mqtt")
+            if self.pub != None and mqtt != None and time.monotonic() - t_pub > self.pub_secs:
+                t_pub = time.monotonic()
+                await mqtt.publish(self.pub,self.get_stats())
@@ -0,0 +1,250 @@
+'''
+    Hot Tier - recent rows of an indexed log kept in memory.
+
+    Rows are appended to an in memory segment instead of the data and index
+    files on the SD card. migrate() appends the whole segment to the files
+    in two large sequential writes, a data write and an index write, then
+    removes the rows from the segment. run() migrates every secs seconds, or
+    sooner once the segment holds sz bytes.
+
+    Row positions are the positions the rows will have in the data file,
+    so rows are numbered and indexed the same whether in the segment or the file.
+    Rows before base_rows, base_pos bytes, are in the files, later rows are in the segment.
+
+    If a journal file is given, normally on a tmpfs such as /dev/shm, each row is
+    also appended to it. The journal starts with a json header line
+    {"base_pos":p, "base_rows":n}, the size of the files when the segment started,
+    followed by the segment's rows. recover() on restart truncates the files
+    to the header's size, undoing a migration cut short, and reloads the rows.
+    The journal survives the process restarting but not the power failing,
+    so at most secs seconds or sz bytes of rows are lost if the Pi loses power.
+    Without a journal they are also lost if the process stops.
+
+    Only the hot tier may write to the files while it is in use.
+    close() migrates the rows left in the segment and closes the journal,
+    so the files can be used by another hot tier or without one.
+
+    Reads from other threads are safe, rows move from the segment
+    to the files under a lock.
+'''
+
+import asyncio
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+
+from ps_util import file_sz
+
+class HotTier:
+
+    def __init__(self, fn, fn_idx=None, journal=None, sz=1<<20, secs=60):
+        self.fn = fn
+        self.fn_idx = fn_idx
+        self.journal = journal
+        self.sz = sz
+        self.secs = secs
+
+        self.base_pos  = file_sz(fn)
+        self.base_rows = file_sz(fn_idx) // 4 if fn_idx != None else 0
+
+        self._lines = []    # rows in the segment, bytes ending with newline
+        self._pos   = []    # data file position of each row in the segment
+        self._bytes = 0
+        self._lock  = threading.Lock()
+        self._full  = asyncio.Event()
+        self._jf    = None
+        self._mig_lock = asyncio.Lock()   # one migration at a time
+
+        # rows and bytes migrated, migrations and time each took
+        self.migrated  = 0
+        self.mig_bytes = 0
+        self.mig_cnt   = 0
+        self.mig_ms    = 0
+        self.recovered = 0
+
+    # Reload rows from the journal, undoing any migration cut short,
+    # and start a new journal. Call before appending rows.
+    def recover(self):
+        if self.journal == None:
+            return 0
+
+        lines = []
+        if os.path.exists(self.journal):
+            with open(self.journal,"rb") as f:
+                hdr = json.loads(f.readline())
+                for ln in f:
+                    # last row may have been cut short
+                    if ln.endswith(b'\n'):
+                        lines.append(ln)
+
+            # the files may hold part of the segment if migration was cut short
+            if file_sz(self.fn) > hdr["base_pos"]:
+                os.truncate(self.fn,hdr["base_pos"])
+            if self.fn_idx != None and file_sz(self.fn_idx) > hdr["base_rows"] * 4:
+                os.truncate(self.fn_idx,hdr["base_rows"] * 4)
+
+            self.base_pos  = file_sz(self.fn)
+            self.base_rows = file_sz(self.fn_idx) // 4 if self.fn_idx != None else 0
+            if self.base_pos != hdr["base_pos"] or self.base_rows != hdr["base_rows"]:
+                print("hot tier {}: files are smaller than journal {}, rows appended at end".
+                      format(self.fn,self.journal))
+
+        pos = self.base_pos
+        for ln in lines:
+            self._lines.append(ln)
+            self._pos.append(pos)
+            pos += len(ln)
+        self._bytes = pos - self.base_pos
+        self.recovered = len(lines)
+
+        self._write_journal()
+        return len(lines)
+
+    # start a new journal holding the segment's rows
+    def _write_journal(self):
+        if self._jf != None:
+            self._jf.close()
+
+        tmp = self.journal + ".tmp"
+        with open(tmp,"wb") as f:
+            f.write(json.dumps({"base_pos":self.base_pos, "base_rows":self.base_rows}).encode("utf-8"))
+            f.write(b'\n')
+            f.write(b''.join(self._lines))
+        os.replace(tmp,self.journal)
+        self._jf = open(self.journal,"ab",buffering=0)
+
+    # append a row, a string without a newline, returning its row number
+    def append(self,ln):
+        b = ln.encode("utf-8") + b'\n'
+        with self._lock:
+            row = self.base_rows + len(self._lines)
+            self._pos.append(self.base_pos + self._bytes)
+            self._lines.append(b)
+            self._bytes += len(b)
+
+        if self._jf != None:
+            self._jf.write(b)
+        if self._bytes >= self.sz:
+            self._full.set()
+        return row
+
+    # number of rows in the files and segment
+    def rows(self):
+        return self.base_rows + len(self._lines)
+
+    # data file position of row, -1 if past the last row, None if in the files
+    def pos(self,row):
+        with self._lock:
+            i = row - self.base_rows
+            if i < 0:
+                return None
+            if i >= len(self._pos):
+                return -1
+            return self._pos[i]
+
+    # return row at data file position pos, or the row after it, None if in the files
+    def row_at(self,pos):
+        with self._lock:
+            if pos < self.base_pos:
+                return None
+            return self.base_rows + bisect.bisect_left(self._pos,pos)
+
+    # return row as bytes, None if not in the segment
+    def line(self,row):
+        with self._lock:
+            i = row - self.base_rows
+            if i < 0 or i >= len(self._lines):
+                return None
+            return self._lines[i]
+
+    # return rows start up to end as strings, None if start is in the files
+    def lines(self,start,end):
+        with self._lock:
+            i = start - self.base_rows
+            if i < 0:
+                return None
+            lines = self._lines[i:end-self.base_rows]
+        return [ln.decode("utf-8").rstrip() for ln in lines]
+
+    # append the segment to the files and remove its rows
+    async def migrate(self):
+        async with self._mig_lock:
+            await self._migrate()
+
+    async def _migrate(self):
+        n = len(self._lines)
+        if n == 0:
+            return
+
+        t = time.perf_counter()
+        lines = self._lines[:n]
+        pos = self._pos[:n]
+        await asyncio.to_thread(self._write,lines,pos,self.base_rows)
+
+        with self._lock:
+            sz = self._pos[n] - self.base_pos if n < len(self._pos) else self._bytes
+            del self._lines[:n]
+            del self._pos[:n]
+            self.base_rows += n
+            self.base_pos  += sz
+            self._bytes    -= sz
+        if self.journal != None:
+            self._write_journal()
+
+        self.migrated  += n
+        self.mig_bytes += sz
+        self.mig_cnt   += 1
+        self.mig_ms     = round((time.perf_counter() - t) * 1000,3)
+
+    # write rows to the end of the files, data first so the
+    # index never points past the end of the data file.
+    # On an error the files are truncated so the rows can be written again.
+    def _write(self,lines,pos,base_rows):
+        if file_sz(self.fn) != pos[0]:
+            raise ValueError("hot tier {}: file size {} is not {}".format(self.fn,file_sz(self.fn),pos[0]))
+        try:
+            with open(self.fn,"ab") as f:
+                f.write(b''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self.fn_idx != None:
+                with open(self.fn_idx,"ab") as f:
+                    f.write(struct.pack("{}i".format(len(pos)),*pos))
+                    f.flush()
+                    os.fsync(f.fileno())
+        except OSError:
+            os.truncate(self.fn,pos[0])
+            if self.fn_idx != None and file_sz(self.fn_idx) > base_rows * 4:
+                os.truncate(self.fn_idx,base_rows * 4)
+            raise
+
+    # migrate every secs seconds, or once the segment holds sz bytes
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(),self.secs)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                # a migration is finished even if run() is cancelled
+                await asyncio.shield(self.migrate())
+            except (OSError,ValueError) as e:
+                print("hot tier {}: migrate failed {}".format(self.fn,e))
+
+    # migrate the rows left in the segment and close the journal.
+    # Call once run() has been cancelled.
+    async def close(self):
+        await self.migrate()
+        if self._jf != None:
+            self._jf.close()
+            self._jf = None
+
+    def get_stats(self):
+        return {"rows":len(self._lines), "bytes":self._bytes, "migrated":self.migrated,
+                "mig_bytes":self.mig_bytes, "mig_cnt":self.mig_cnt, "mig_ms":self.mig_ms,
+                "recovered":self.recovered}
@@ -13,7 +13,17 @@ import time
 import ps_util
 import gc
 
+# raised by wait_ready() when the service failed to become ready
+class ServiceFailed(Exception):
+    pass
+
 class PsrpiModule:
+
+    # Services which need to do some work in run() before
+    # services which depend on them can start set this to False
+    # and call set_ready() once they are ready, or set_failed()
+    # if they can not be.
+    ready_on_start = True
     
     def __init__(self, parms):
         self._parms   = parms
@@ -21,6 +31,9 @@ class PsrpiModule:
                 
         self.tz       = self.get_parm("tz",-8)
         self.dev      = self.get_parm("dev","?")
+
+        self._ready   = asyncio.Event()
+        self.failed   = None    # why the service failed to become ready
         
     # get a parameter value
     # return default if parameter not specified
@@ -35,10 +48,9 @@ class PsrpiModule:
     def get_mqtt(self):
         return self.get_svc("mqtt")
                 
-    # get formatted date and time
+    # get formatted date and time, see ps_util.dt_str
     def get_dt(self):
-        t = time.localtime(time.mktime(time.localtime()))
-        return "{1}/{2}/{0} {3}:{4:02d}:{5:02d}".format(*t)
+        return ps_util.dt_str()
     
     def get_defaults(self):
         return self._parms._defaults
@@ -85,9 +97,50 @@ class PsrpiModule:
         else:
             print(self._name,":",str(msg))
     
+    # mark service as ready for services which depend on it
+    def set_ready(self):
+        self.failed = None
+        self._ready.set()
+
+    # mark service as failed to become ready, waking services waiting
+    # for it, which wait again for it to be ready once it is restarted
+    def set_failed(self,err):
+        self.failed = str(err)
+        self._ready.set()
+        self._ready.clear()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    # wait until service is ready,
+    # raising ServiceFailed if it fails to become ready
+    async def wait_ready(self):
+        await self._ready.wait()
+        if self.failed != None and not self._ready.is_set():
+            raise ServiceFailed("{} failed {}".format(self._name,self.failed))
+
+    # return a dictionary of statistics for mod_stats to publish,
+    # None if the service keeps no statistics
+    def get_stats(self):
+        return None
+
     # default run method - just return
     async def run(self):
         pass
+
+    # Called after run() is cancelled when the service is stopped
+    # by a parms reload, see ps_reload. Cancels the tasks the service
+    # keeps in _tasks or in attributes ending in _task. Services with
+    # other resources to release override this and call super().stop().
+    async def stop(self):
+        tasks = list(getattr(self,"_tasks",[]))
+        for (k,v) in self.__dict__.items():
+            if k.endswith("_task") and isinstance(v,asyncio.Task):
+                tasks.append(v)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
         
 
 
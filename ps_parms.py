@@ -19,8 +19,51 @@
     If name is not in the default dictionary
     get_parm will return the default value.
 
+    When the defaults are a PsosDefaults, the parms, defaults and config
+    are resolved once into a single dictionary, with {...} in parm values
+    already formatted, so get_parm is a single dictionary lookup.
+    The resolved dictionary is rebuilt on the next get_parm after set_parm
+    is called or the defaults are changed.
+    See bench_parms.py for a comparison with the lookup chain.
+
 """
 
+# Dictionary of default parameters which counts changes
+# so PsosParms know when to re-resolve their parameters.
+# Changes to objects in the dictionary, such as adding
+# to the "services" dictionary, are not counted.
+class PsosDefaults(dict):
+
+    ver = 0
+
+    def __setitem__(self,key,value):
+        super().__setitem__(key,value)
+        self.ver += 1
+
+    def __delitem__(self,key):
+        super().__delitem__(key)
+        self.ver += 1
+
+    def update(self,*args,**kwargs):
+        super().update(*args,**kwargs)
+        self.ver += 1
+
+    def setdefault(self,key,value=None):
+        self.ver += 1
+        return super().setdefault(key,value)
+
+    def pop(self,*args):
+        self.ver += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.ver += 1
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.ver += 1
+
 class PsosParms:
     
     def __init__(self, parms, default_parms, config):
@@ -32,8 +75,41 @@ class PsosParms:
             self.no_fmt = default_parms["no_format"]
         except KeyError:
             self.no_fmt = ["format"]        
-        
+
+        self._snap = {}
+        self._ver  = -1
+
+        # can only tell when defaults change if they are a PsosDefaults
+        self._resolved = isinstance(default_parms,PsosDefaults)
+
+    # resolve parms, defaults and config into a single dictionary
+    def _resolve(self):
+        snap = dict(self.config)
+        snap.update(self._defaults)
+
+        for (key,r) in self._parms.items():
+            if type(r) == str and '{' in r and not key in self.no_fmt:
+                try:
+                    r = r.format(**self._defaults)
+                except KeyError:
+                    # use default or config value, if any
+                    continue
+                except (IndexError,ValueError) as e:
+                    print("parms: can not format {} {} {}".format(key,r,e))
+            snap[key] = r
+
+        self._snap = snap
+        self._ver  = self._defaults.ver
+
     def get_parm(self,key,parm_default=None):
+        if not self._resolved:
+            return self._lookup(key,parm_default)
+        if self._ver != self._defaults.ver:
+            self._resolve()
+        return self._snap.get(key,parm_default)
+
+    # look up key in parms, then defaults, then config
+    def _lookup(self,key,parm_default=None):
         try:
             r = self._parms[key]
             # if '{' in result
@@ -59,6 +135,7 @@ class PsosParms:
     
     def set_parm(self,key,value):
         self._parms[key] = value
+        self._ver = -1
     
     def get_svc(self,svc_name):
         try:
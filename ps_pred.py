@@ -0,0 +1,287 @@
+'''
+    Predicates over JSON payload fields.
+
+    A predicate is a small expression such as:
+
+        temp > 75 and (hum < 40 or dev == "e01")
+
+    Comparisons are field op value where op is one of
+    > >= < <= == != and value is a number or a quoted string.
+    Comparisons can be combined with and, or, not and parentheses.
+    A field name can use '.' to reference a field in a nested object.
+
+    The expression is compiled once by Pred(expr). Pred.eval(blk)
+    then evaluates it for every row of a block at once, using the
+    block's cached payload columns (see mod_ds.DsBlock).
+    If numpy is installed columns are numpy arrays and each comparison
+    is a single array operation, otherwise plain python lists are used.
+
+    Numeric comparisons convert the payload value to a float so
+    values such as " 61" compare as 61. A row without the field,
+    or with a value that is not a number, never matches a numeric comparison.
+'''
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_ops = ('>=','<=','==','!=','>','<','=')
+
+class PredError(Exception):
+    pass
+
+# split an expression into a list of tokens
+def _tokens(expr):
+    toks = []
+    i = 0
+    n = len(expr)
+    while i < n:
+        c = expr[i]
+        if c.isspace():
+            i += 1
+        elif c in '()':
+            toks.append(c)
+            i += 1
+        elif c in '"\'':
+            j = expr.find(c,i+1)
+            if j < 0:
+                raise PredError("unterminated string in: " + expr)
+            toks.append(('s',expr[i+1:j]))
+            i = j + 1
+        elif c in '<>=!':
+            for op in _ops:
+                if expr.startswith(op,i):
+                    toks.append(op)
+                    i += len(op)
+                    break
+            else:
+                raise PredError("invalid operator in: " + expr)
+        else:
+            j = i
+            while j < n and not expr[j].isspace() and not expr[j] in '()<>=!"\'':
+                j += 1
+            toks.append(expr[i:j])
+            i = j
+
+    return toks
+
+# recursive descent parser returning a tree of tuples:
+#   ("cmp",field,op,value) ("and",a,b) ("or",a,b) ("not",a)
+class _Parser:
+
+    def __init__(self, expr):
+        self._expr = expr
+        self._toks = _tokens(expr)
+        self._i = 0
+
+    def _peek(self):
+        if self._i < len(self._toks):
+            return self._toks[self._i]
+        return None
+
+    def _next(self):
+        t = self._peek()
+        if t == None:
+            raise PredError("unexpected end of: " + self._expr)
+        self._i += 1
+        return t
+
+    def parse(self):
+        tree = self._or()
+        if self._peek() != None:
+            raise PredError("unexpected {} in: {}".format(self._peek(),self._expr))
+        return tree
+
+    def _or(self):
+        a = self._and()
+        while self._peek() == "or":
+            self._next()
+            a = ("or",a,self._and())
+        return a
+
+    def _and(self):
+        a = self._not()
+        while self._peek() == "and":
+            self._next()
+            a = ("and",a,self._not())
+        return a
+
+    def _not(self):
+        if self._peek() == "not":
+            self._next()
+            return ("not",self._not())
+        return self._atom()
+
+    def _atom(self):
+        t = self._next()
+        if t == '(':
+            a = self._or()
+            if self._next() != ')':
+                raise PredError("missing ) in: " + self._expr)
+            return a
+
+        if type(t) != str or t in _ops or t == ')':
+            raise PredError("field expected in: " + self._expr)
+
+        op = self._next()
+        if not op in _ops:
+            raise PredError("operator expected after {} in: {}".format(t,self._expr))
+        if op == '=':
+            op = '=='
+
+        v = self._next()
+        if type(v) == tuple:
+            v = v[1]
+        else:
+            try:
+                v = float(v)
+            except ValueError:
+                raise PredError("invalid value {} in: {}".format(v,self._expr))
+
+        return ("cmp",t,op,v)
+
+# return the value of field in a parsed payload
+# or None if the payload does not have the field
+def field_value(payload,field):
+    for f in field.split('.'):
+        if not isinstance(payload,dict):
+            return None
+        payload = payload.get(f)
+    return payload
+
+def num_value(v):
+    if v == None or type(v) == bool:
+        return None
+    try:
+        return float(v)
+    except (TypeError,ValueError):
+        return None
+
+# return a column of numeric values for field,
+# a numpy float array with nan for missing values if numpy installed,
+# otherwise a list with None for missing values
+def num_column(payloads,field):
+    col = [num_value(field_value(p,field)) for p in payloads]
+    if np == None:
+        return col
+    return np.array([np.nan if v == None else v for v in col],dtype=float)
+
+# return a column of values as stripped strings, None if missing
+def str_column(payloads,field):
+    col = []
+    for p in payloads:
+        v = field_value(p,field)
+        if v != None:
+            v = str(v).strip()
+        col.append(v)
+    return col
+
+_cmp = {
+    '>' : lambda a,b: a > b,
+    '>=': lambda a,b: a >= b,
+    '<' : lambda a,b: a < b,
+    '<=': lambda a,b: a <= b,
+    '==': lambda a,b: a == b,
+    '!=': lambda a,b: a != b,
+    }
+
+class Pred:
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._tree = _Parser(expr).parse()
+
+        self.fields = set()
+        self._fields(self._tree)
+
+    def _fields(self,t):
+        if t[0] == "cmp":
+            self.fields.add(t[1])
+        else:
+            for a in t[1:]:
+                self._fields(a)
+
+    # Return False if no row with numeric field values in
+    # the ranges rng, {field:[min,max]}, can match.
+    # A range of None means no row has a numeric value for the field.
+    # Fields not in rng and string comparisons are assumed to match.
+    def may_match(self,rng):
+        return self._may(self._tree,rng)
+
+    def _may(self,t,rng):
+        op = t[0]
+        if op == "and":
+            return self._may(t[1],rng) and self._may(t[2],rng)
+        if op == "or":
+            return self._may(t[1],rng) or self._may(t[2],rng)
+        if op == "not":
+            return True
+
+        (_,field,op,v) = t
+        if type(v) == str or not field in rng:
+            return True
+
+        r = rng[field]
+        if r == None:
+            return False
+
+        (lo,hi) = r
+        if op == '>':
+            return hi > v
+        if op == '>=':
+            return hi >= v
+        if op == '<':
+            return lo < v
+        if op == '<=':
+            return lo <= v
+        if op == '==':
+            return lo <= v <= hi
+        return not (lo == v and hi == v)
+
+    # return a list of bool, one for each row in blk
+    def eval(self,blk):
+        r = self._eval(self._tree,blk)
+        if np != None:
+            return r.tolist()
+        return r
+
+    def _eval(self,t,blk):
+        op = t[0]
+        if op == "cmp":
+            return self._eval_cmp(t,blk)
+
+        if op == "not":
+            a = self._eval(t[1],blk)
+            if np != None:
+                return ~a
+            return [not x for x in a]
+
+        a = self._eval(t[1],blk)
+        b = self._eval(t[2],blk)
+        if np != None:
+            if op == "and":
+                return a & b
+            return a | b
+
+        if op == "and":
+            return [x and y for x,y in zip(a,b)]
+        return [x or y for x,y in zip(a,b)]
+
+    def _eval_cmp(self,t,blk):
+        (_,field,op,v) = t
+        f = _cmp[op]
+
+        if type(v) == str:
+            col = blk.str_col(field)
+            r = [x != None and f(x,v) for x in col]
+            if np != None:
+                return np.array(r,dtype=bool)
+            return r
+
+        col = blk.num_col(field)
+        if np != None:
+            # comparisons with nan are False, except for !=
+            return f(col,v) & ~np.isnan(col)
+
+        return [x != None and f(x,v) for x in col]
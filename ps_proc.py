@@ -0,0 +1,324 @@
+'''
+    Multi-Process Services
+
+    Services with a "proc" parm greater than 0 are run in a separate worker
+    process, one process for each proc number, so they can use other cores.
+    Services without a "proc" parm, including mqtt, run in the main process.
+
+    In a worker process this module is the "mqtt" service. It has the same
+    subscribe, unsubscribe and publish methods as mod_mqtt but sends them over a
+    pipe to the main process. There a ProcWorker subscribes to mqtt on behalf of the
+    worker and sends matching messages back, and publishes what the worker publishes.
+
+    Hops of traced messages, see ps_trace, recorded in a worker process are sent
+    to the main process to be published with the rest of the trace.
+
+    Messages are sent over the pipes in batches, one batch per pass of the event loop,
+    by reader and writer threads so the event loops never wait on a pipe.
+    At most MAX_BATCHES batches wait to be written. Once that many are waiting,
+    as when a worker can not keep up, messages are dropped and counted in
+    get_stats. Messages for the worker are also counted by its subscriptions,
+    as for a full service queue.
+
+    If a worker process exits, the main process removes its subscriptions and
+    get_stats shows it as closed. The worker's services are not restarted.
+    If the main process exits, the worker processes exit.
+
+    Example, running the datastore and its query service in worker process 1:
+        {"name": "ds",    "module":"mod_ds", "sub":"#", "proc":1},
+        {"name": "d_get", "module":"mod_ds_get", "ds":"ds", "sub":"{sys}/ds/get", "proc":1}
+
+    Services in a worker process can only use services in the same process,
+    plus mqtt. The main script must only start psrpi when run as __main__
+    since worker processes are started with the multiprocessing "spawn" method.
+'''
+
+from ps_mod import PsrpiModule
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+
+import ps_trace
+
+# pipes to and from the main process when running as a worker
+_conn_in  = None
+_conn_out = None
+
+# most batches waiting to be written to a pipe
+MAX_BATCHES = 1000
+
+# Sends and receives batches of messages over a pair of pipes.
+# on_msg is called in the event loop thread for each message received.
+# on_eof is called once in the event loop thread if the other process goes away,
+# after which messages sent are dropped.
+class _Link:
+
+    def __init__(self, conn_in, conn_out, on_msg, on_eof=None):
+        self._loop = asyncio.get_running_loop()
+        self._conn_in  = conn_in
+        self._conn_out = conn_out
+        self._on_msg = on_msg
+        self._on_eof = on_eof
+        self._out = []
+        self._wq  = queue.Queue(MAX_BATCHES)
+        self.closed = False
+
+        self.sent = 0
+        self.rcvd = 0
+        self.dropped = 0    # messages not sent, the pipe was backed up or closed
+
+        threading.Thread(target=self._reader,daemon=True).start()
+        threading.Thread(target=self._writer,daemon=True).start()
+
+    # True if messages sent now would be dropped
+    def full(self):
+        return self.closed or self._wq.full()
+
+    # queue a message to be sent at the end of this pass of the loop
+    def send(self,m):
+        if self.closed:
+            self.dropped += 1
+            return
+        if len(self._out) == 0:
+            self._loop.call_soon(self._flush)
+        self._out.append(m)
+
+    def _flush(self):
+        out = self._out
+        self._out = []
+        if self.closed:
+            self.dropped += len(out)
+            return
+        try:
+            self._wq.put_nowait(out)
+            self.sent += len(out)
+        except queue.Full:
+            self.dropped += len(out)
+
+    def _writer(self):
+        while True:
+            batch = self._wq.get()
+            try:
+                self._conn_out.send(batch)
+            except (OSError,EOFError):
+                self._call(self._close)
+                return
+
+    def _reader(self):
+        while True:
+            try:
+                batch = self._conn_in.recv()
+            except (OSError,EOFError):
+                self._call(self._close)
+                return
+            if not self._call(self._deliver,batch):
+                return
+
+    # call fn in the event loop thread, returns False if the loop has closed
+    def _call(self,fn,*args):
+        try:
+            self._loop.call_soon_threadsafe(fn,*args)
+        except RuntimeError:
+            return False
+        return True
+
+    # the other process has gone, stop sending to it
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        while not self._wq.empty():
+            self.dropped += len(self._wq.get_nowait())
+        if self._on_eof != None:
+            self._on_eof()
+
+    def _deliver(self,batch):
+        self.rcvd += len(batch)
+        for m in batch:
+            self._on_msg(m)
+
+# Queue given to mqtt.subscribe in the main process.
+# Messages put on it are sent to the worker. It is full
+# while the link to the worker is backed up or closed.
+class _ProxyQueue:
+
+    def __init__(self, link, sid):
+        self._link = link
+        self._sid  = sid
+
+    def put_nowait(self,data):
+        if self._link.full():
+            raise asyncio.QueueFull()
+        self._link.send(("msg",self._sid,data))
+
+    # batches waiting to be written to the worker
+    def qsize(self):
+        return self._link._wq.qsize()
+
+# Runs in the main process to start a worker process
+# and handle its subscribe and publish requests.
+class ProcWorker:
+
+    def __init__(self, n, parms, config, mqtt):
+        self.n = n
+        self._parms  = parms
+        self._config = config
+        self._mqtt   = mqtt
+        self._subs = {}
+        self._ops  = asyncio.Queue()
+        self.proc = None
+        self.link = None
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        (to_w_in,to_w_out) = ctx.Pipe(False)
+        (fr_w_in,fr_w_out) = ctx.Pipe(False)
+
+        self.proc = ctx.Process(target=worker_main,name="psrpi-{}".format(self.n),
+                                args=(self._parms,self._config,to_w_in,fr_w_out),daemon=True)
+        self.proc.start()
+
+        self.link = _Link(fr_w_in,to_w_out,self._ops.put_nowait,self._on_eof)
+        self._task = asyncio.create_task(self.run())
+
+    # worker process has gone, remove its subscriptions
+    def _on_eof(self):
+        print("proc: worker {} gone".format(self.n))
+        self._ops.put_nowait(("eof",))
+
+    # run subscribe, unsubscribe and publish requests from the worker in order
+    async def run(self):
+        mqtt = self._mqtt
+        while True:
+            m = await self._ops.get()
+            op = m[0]
+            if op == "pub":
+                await mqtt.publish(m[1],m[2],m[3],m[4],codec=m[5])
+            elif op == "sub":
+                q = _ProxyQueue(self.link,m[2])
+                self._subs[m[2]] = q
+                await mqtt.subscribe(m[1],q,m[3])
+            elif op == "unsub":
+                q = self._subs.pop(m[1],None)
+                if q != None:
+                    await mqtt.unsubscribe(q)
+            elif op == "hop":
+                ps_trace.add_hop(m[1],m[2],m[3],m[4])
+            elif op == "eof":
+                for q in self._subs.values():
+                    await mqtt.unsubscribe(q)
+                self._subs.clear()
+                return
+
+    def get_stats(self):
+        return {"pid":self.proc.pid, "alive":self.proc.is_alive(), "closed":self.link.closed,
+                "sent":self.link.sent, "rcvd":self.link.rcvd, "dropped":self.link.dropped,
+                "subs":len(self._subs), "ops":self._ops.qsize()}
+
+# split services in svc by their "proc" parm.
+# Returns list of services to run in the main process
+# and list of (proc number, parms for the worker process).
+def split_services(parms,raw_defaults,svc):
+    local = []
+    procs = {}
+    for p in svc:
+        n = p.get("proc",0)
+        if n == 0:
+            local.append(p)
+        else:
+            p = dict(p)
+            del p["proc"]
+            procs.setdefault(n,[]).append(p)
+
+    workers = []
+    for n in sorted(procs):
+        wp = dict(parms)
+        # only the main process watches the parms files, see ps_reload
+        wp.pop("reload",None)
+        wp["name"] = "{} proc {}".format(parms.get("name","psrpi"),n)
+        wp["defaults"] = raw_defaults
+        wp["services"] = [{"name":"mqtt","module":"ps_proc"}] + procs[n]
+        workers.append((n,wp))
+
+    return (local,workers)
+
+# entry point of a worker process
+def worker_main(parms,config,conn_in,conn_out):
+    global _conn_in, _conn_out
+    _conn_in  = conn_in
+    _conn_out = conn_out
+
+    try:
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    except AttributeError:
+        pass
+
+    import psrpi_main
+    print("proc: starting",parms["name"],os.getpid())
+    asyncio.run(psrpi_main.main(parms,config))
+
+'''
+    Worker process mqtt service
+
+'''
+# All initialization classes are named ModuleService
+class ModuleService(PsrpiModule):
+
+    def __init__(self, parms):
+        super().__init__(parms)
+        self._queues = {}   # sid: (queue, task)
+        self._sid = 0
+        self._link = None
+
+    def _get_link(self):
+        if self._link == None:
+            self._link = _Link(_conn_in,_conn_out,self._on_msg,self._on_eof)
+            ps_trace.set_sink(self._send_hop)
+        return self._link
+
+    def _send_hop(self,trace_id,svc,stage,ms):
+        self._link.send(("hop",trace_id,svc,stage,ms))
+
+    def _on_msg(self,m):
+        # ("msg",sid,data)
+        q = self._queues.get(m[1])
+        if q != None:
+            q[0].put_nowait(m[2])
+
+    # main process has gone, so should we
+    def _on_eof(self):
+        print("proc: main process gone, exiting")
+        os._exit(0)
+
+    async def run(self):
+        self._get_link()
+
+    def get_stats(self):
+        if self._link == None:
+            return None
+        return {"pid":os.getpid(), "sent":self._link.sent, "rcvd":self._link.rcvd,
+                "dropped":self._link.dropped, "subs":len(self._queues)}
+
+    async def subscribe(self,topic_filter,queue,qos=0):
+        self._sid += 1
+        self._queues[self._sid] = (queue,asyncio.current_task())
+        self._get_link().send(("sub",topic_filter,self._sid,qos))
+        await asyncio.sleep(0)
+
+    async def unsubscribe(self,queue):
+        for (sid,q) in list(self._queues.items()):
+            if q[0] == queue:
+                del self._queues[sid]
+                self._get_link().send(("unsub",sid))
+
+    def unsubscribe_task(self,task):
+        for (sid,q) in list(self._queues.items()):
+            if q[1] == task:
+                del self._queues[sid]
+                self._get_link().send(("unsub",sid))
+
+    async def publish(self,topic,payload,retain=False,qos=0,codec=None):
+        self._get_link().send(("pub",topic,payload,retain,qos,codec))
+        await asyncio.sleep(0)
@@ -0,0 +1,105 @@
+'''
+    Parms File Reload
+
+    Watches the parms files and, when one changes, has psrpi_main reload
+    the services without restarting the process, see psrpi_main.reload_services.
+
+    Services are matched by name. A service whose parms are unchanged keeps
+    running with its subscriptions, queues and open files. A service which
+    is new is started, one which is gone is stopped, and one whose parms
+    changed is stopped and started again with its new parms, as is every
+    service which depends on a service stopped.
+
+    Only the services run in the main process are reloaded. Changes to
+    the other parts of the parms file, such as defaults, gc, supervisor and
+    services with a "proc" parm, are reported but need a restart.
+
+    Parameters are in the "reload" dictionary of the main parms json:
+      - secs : how often to check if the parms files have changed,
+               0 to not watch them. Default is 0.
+      - fn   : main parms file. Default is config["fn_parms"] in the
+               config["parms"] directory, as main.py loads it.
+      - ready_secs : longest time a reload waits for the services it starts
+               to be ready. Services not ready by then are reported as
+               not_ready and start once they are. Default is 30.
+
+    If a service can not be created with its new parms, the services the
+    reload stopped are started again with their old parms.
+'''
+
+import asyncio
+import os
+import time
+
+import ps_util
+from ps_stats import Histogram
+
+# return names of services (name: parms) added, removed and changed in new
+def diff_services(old,new):
+    added   = [n for n in new if not n in old]
+    removed = [n for n in old if not n in new]
+    changed = [n for n in new if n in old and new[n] != old[n]]
+    return (added,removed,changed)
+
+class Reloader:
+
+    def __init__(self, parms={}, config={}):
+        self.secs = parms.get("secs",0)
+        self.fn   = parms.get("fn",None)
+        self.ready_secs = parms.get("ready_secs",30)
+        if self.fn == None and "fn_parms" in config and "parms" in config:
+            self.fn = ps_util.filepath(config["parms"],config["fn_parms"])
+
+        self._mtimes = {}   # file name: modification time
+
+        self.reloads   = 0
+        self.errors    = 0
+        self.reload_ms = Histogram()
+        self.last      = None   # changes made by the last reload
+
+    # watch files fns, the main parms file and any services file
+    def watch(self,fns):
+        self._mtimes = dict((fn,self._mtime(fn)) for fn in fns if fn != None)
+
+    def _mtime(self,fn):
+        try:
+            return os.stat(fn).st_mtime_ns
+        except OSError:
+            return None
+
+    # return True if a watched file has changed since the last call
+    def changed(self):
+        changed = False
+        for (fn,t) in self._mtimes.items():
+            mt = self._mtime(fn)
+            if mt != t:
+                self._mtimes[fn] = mt
+                changed = True
+        return changed
+
+    # check for changes every secs, calling reload() when there are.
+    # reload returns a dictionary of the changes made.
+    async def run(self,reload):
+        while True:
+            await asyncio.sleep(self.secs)
+            if not self.changed():
+                continue
+
+            t = time.perf_counter()
+            try:
+                last = await reload()
+            except Exception as e:
+                self.errors += 1
+                print("main: reload failed {}".format(e))
+                continue
+
+            ms = (time.perf_counter() - t) * 1000
+            self.reloads += 1
+            self.reload_ms.add(ms)
+            last["ms"] = round(ms,1)
+            self.last = last
+            print("main: reload {:.1f}ms {}".format(ms,last))
+
+    def get_stats(self):
+        return {"reloads":self.reloads, "errors":self.errors,
+                "reload_ms":self.reload_ms.summary(), "last":self.last}
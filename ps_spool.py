@@ -0,0 +1,208 @@
+'''
+    Outbound Spool - messages published while the MQTT broker is down
+
+    mod_mqtt appends the messages it can not publish to the spool file and,
+    once it has reconnected, reads them back oldest first to publish them.
+    Records are appended, never rewritten, each a header packed as "<HIB",
+    topic length, payload length and flags, followed by the topic and payload.
+    Flag bits are 1 retain and 2 already delivered to local subscribers,
+    bits 4 and up are the qos.
+
+    The position of the next record to publish is kept in the file fn + ".pos"
+    so a restart carries on from where the last one stopped, sending at most
+    one batch again. Once every record has been published the spool is
+    truncated. A last record cut short by a crash or power loss is removed
+    by open().
+
+    Each topic has a policy, from the first filter in policies it matches:
+      - all    : every message is kept. The default.
+      - latest : only the latest message of the topic is published, earlier
+                 ones are skipped when read back. For values such as sensor
+                 readings where only the current one matters.
+      - none   : messages are not spooled.
+    Once the spool holds max_sz bytes new messages are dropped.
+'''
+
+import os
+import struct
+
+from ps_subscr import Subscription
+
+_hdr = struct.Struct("<HIB")
+
+RETAIN = 1
+LOCAL  = 2
+
+class OutSpool:
+
+    def __init__(self, fn, max_sz=16<<20, policies={}):
+        self.fn = fn
+        self.max_sz = max_sz
+        self.policies = [(Subscription(f,None),p) for (f,p) in policies.items()]
+        for (subscr,p) in self.policies:
+            if not p in ("all","latest","none"):
+                raise ValueError("spool policy for {} must be all, latest or none, not {}".
+                                 format(subscr._filter,p))
+        self._topic_policy = {}
+
+        self.pos  = 0           # position of the next record to publish
+        self.size = 0
+        self._latest = {}       # topic with latest policy: position of its latest record
+        self._f = None
+
+        self.spooled  = 0
+        self.dropped  = 0
+        self.skipped  = 0       # not spooled (none) or superseded (latest)
+        self.drained  = 0
+        self.truncated = 0      # bytes of records cut short removed by open
+
+    # return the policy for topic
+    def policy(self,topic):
+        p = self._topic_policy.get(topic)
+        if p == None:
+            p = "all"
+            t_split = topic.split('/')
+            for (subscr,tp) in self.policies:
+                if subscr.filter_match(t_split):
+                    p = tp
+                    break
+            if len(self._topic_policy) > 1000:
+                self._topic_policy.clear()
+            self._topic_policy[topic] = p
+        return p
+
+    # open the spool, carrying on from the last position published
+    def open(self):
+        try:
+            with open(self.fn + ".pos") as f:
+                self.pos = int(f.read())
+        except (OSError,ValueError):
+            self.pos = 0
+
+        self._f = open(self.fn,"ab",buffering=0)
+        self.size = self._f.tell()
+        if self.pos > self.size:
+            self.pos = 0
+
+        # remove a record cut short and anything after it
+        end = self._check(self.pos,self.size)
+        if end < self.size:
+            print("spool {}: {} bytes of records cut short removed".format(self.fn,self.size - end))
+            self.truncated += self.size - end
+            self._f.truncate(end)
+            self.size = end
+
+        # find the latest record of each latest policy topic
+        for rec in self._read(self.pos,self.size,None):
+            if self.policy(rec[1]) == "latest":
+                self._latest[rec[1]] = rec[0]
+        return self.size - self.pos
+
+    # append a message, returning False if it was not spooled
+    def add(self,topic,payload,qos=0,retain=False,local=False):
+        p = self.policy(topic)
+        if p == "none":
+            self.skipped += 1
+            return False
+
+        if self.size >= self.max_sz:
+            self.dropped += 1
+            return False
+
+        t = topic.encode("utf-8")
+        flags = (qos << 4) | (RETAIN if retain else 0) | (LOCAL if local else 0)
+        self._f.write(_hdr.pack(len(t),len(payload),flags) + t + payload)
+
+        if p == "latest":
+            self._latest[topic] = self.size
+        self.size += _hdr.size + len(t) + len(payload)
+        self.spooled += 1
+        return True
+
+    # True if there are records to publish
+    def pending(self):
+        return self.pos < self.size
+
+    # Return the spool state read() reads from. Call where records are added,
+    # on the event loop, so read() can run in a thread while more are added.
+    def snapshot(self):
+        return (self.pos,self.size,dict(self._latest))
+
+    # Return up to n records from the position of snapshot snap to publish,
+    # the position after them and the positions of the records skipped,
+    # a record being (position,topic,payload,qos,retain,local).
+    # Superseded records of latest policy topics are skipped.
+    # Only reads the file and snap so can be run in a thread.
+    # snap of None reads from the current state.
+    def read(self,n,snap=None):
+        if snap == None:
+            snap = self.snapshot()
+        (pos,size,latest) = snap
+        recs = []
+        skipped = []
+        end = pos
+        for rec in self._read(pos,size,n):
+            end = rec[0] + _hdr.size + len(rec[1].encode("utf-8")) + len(rec[2])
+            if rec[1] in latest and latest[rec[1]] != rec[0]:
+                skipped.append(rec[0])
+                continue
+            recs.append(rec)
+        return (recs,end,skipped)
+
+    # Return the end of the complete records from pos up to end.
+    # A record which does not fit before end, or with a topic which
+    # is not utf-8, ends the records.
+    def _check(self,pos,end):
+        with open(self.fn,"rb") as f:
+            f.seek(pos)
+            while pos < end:
+                hdr = f.read(_hdr.size)
+                if len(hdr) < _hdr.size:
+                    break
+                (t_len,p_len,flags) = _hdr.unpack(hdr)
+                if pos + _hdr.size + t_len + p_len > end:
+                    break
+                try:
+                    f.read(t_len).decode("utf-8")
+                except UnicodeDecodeError:
+                    break
+                f.seek(p_len,1)
+                pos += _hdr.size + t_len + p_len
+        return pos
+
+    # generator of records from pos up to end, at most n if n is not None
+    def _read(self,pos,end,n):
+        with open(self.fn,"rb") as f:
+            f.seek(pos)
+            while pos < end and (n == None or n > 0):
+                (t_len,p_len,flags) = _hdr.unpack(f.read(_hdr.size))
+                topic = f.read(t_len).decode("utf-8")
+                payload = f.read(p_len)
+                yield (pos,topic,payload,flags >> 4,(flags & RETAIN) != 0,(flags & LOCAL) != 0)
+                pos += _hdr.size + t_len + p_len
+                if n != None:
+                    n -= 1
+
+    # records recs before pos have been published,
+    # the records at positions skipped were skipped by read()
+    def commit(self,pos,recs,skipped=[]):
+        self.drained += len(recs)
+        self.skipped += len([p for p in skipped if p < pos])
+        for rec in recs:
+            if self._latest.get(rec[1]) == rec[0]:
+                del self._latest[rec[1]]
+
+        self.pos = pos
+        if self.pos >= self.size:
+            # all published, start again
+            self._f.truncate(0)
+            self.pos  = 0
+            self.size = 0
+            self._latest.clear()
+        with open(self.fn + ".pos","w") as f:
+            f.write(str(self.pos))
+
+    def get_stats(self):
+        return {"pending_kb":(self.size - self.pos) // 1024, "spooled":self.spooled,
+                "drained":self.drained, "dropped":self.dropped, "skipped":self.skipped,
+                "truncated":self.truncated}
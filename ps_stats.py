@@ -0,0 +1,60 @@
+'''
+    Simple statistics used by modules to report
+    performance counters.
+
+    Histogram keeps counts in power of 2 buckets so adding
+    a value is cheap and memory use is fixed no matter how
+    many values are added. Percentiles are estimated from
+    the buckets and so are only accurate to within a factor of 2.
+'''
+
+class Histogram:
+
+    def __init__(self, buckets=24):
+        self._cnts = [0] * buckets
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self._cnts)):
+            self._cnts[i] = 0
+        self.cnt = 0
+        self.total = 0
+        self.max = 0
+
+    # add a value, usually a time in ms
+    # bucket i holds values < 2**i
+    def add(self,v):
+        self.cnt += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+        i = int(v).bit_length()
+        if i >= len(self._cnts):
+            i = len(self._cnts) - 1
+        self._cnts[i] += 1
+
+    # return the estimated value for percentile p (0-100)
+    def pct(self,p):
+        if self.cnt == 0:
+            return 0
+
+        n = self.cnt * p / 100
+        c = 0
+        for i in range(len(self._cnts)):
+            c += self._cnts[i]
+            if c >= n:
+                # upper bound of bucket, but never more than max seen
+                return min(2**i,self.max)
+
+        return self.max
+
+    # return dictionary summarizing the histogram
+    def summary(self):
+        avg = 0
+        if self.cnt > 0:
+            avg = round(self.total/self.cnt,3)
+
+        return {"cnt":self.cnt, "avg":avg,
+                "p50":round(self.pct(50),3), "p90":round(self.pct(90),3),
+                "p99":round(self.pct(99),3), "max":round(self.max,3)}
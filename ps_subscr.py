@@ -5,12 +5,12 @@
     and a queue to write messages to when received
     from the mqtt broker.
     
-    Messages placed in queue are JSON formatted strings
-    containing the filter, topic, payload (and perhaps
-    additional info to be determined)
+    Messages placed in queue are lists of the filter, topic,
+    payload, receive time and trace id, see ps_trace.
 '''
 
 # import queue
+import asyncio
 from ps_util import to_str
 
 
@@ -20,6 +20,10 @@ class Subscription:
         self._filter_split = to_str(topic_filter).split('/')
         self._queue = queue
         self._qos   = qos
+        self._task  = None   # task which subscribed
+        self.cnt    = 0      # messages put on queue
+        self.max_q  = 0      # most messages seen waiting on queue
+        self.dropped = 0     # messages not put on a full queue
         
     async def subscribe(self,client):
         print("subscribe "+self._filter)
@@ -28,9 +32,33 @@ class Subscription:
     # write the filter, topic and payload to this subscriptions queue
     # if the topic matches matches the filter.
     # topic_split = topic.split('/')
-    def put_match(self,topic_split,topic,payload):
+    # Returns True if the message was put on the queue.
+    # A queue with a maxsize which is full drops the message.
+    # Payloads which are not utf-8, see ps_codec, are left as bytes.
+    # rcv_t and trace_id are the message's receive time and trace id, see ps_trace.
+    def put_match(self,topic_split,topic,payload,rcv_t=None,trace_id=None):
         if self.filter_match(topic_split):
-            self._queue.put_nowait([to_str(self._filter),to_str(topic),to_str(payload)])
+            if type(payload) != bytes:
+                payload = to_str(payload)
+            try:
+                self._queue.put_nowait([self._filter,to_str(topic),payload,rcv_t,trace_id])
+            except asyncio.QueueFull:
+                self.dropped += 1
+                return False
+            self.cnt += 1
+            n = self._queue.qsize()
+            if n > self.max_q:
+                self.max_q = n
+            return True
+        return False
+
+    # return queue statistics
+    def get_stats(self):
+        task = None
+        if self._task != None:
+            task = self._task.get_name()
+        return {"filter":self._filter, "task":task, "cnt":self.cnt,
+                "qsize":self._queue.qsize(), "max_q":self.max_q, "dropped":self.dropped}
     
     # return True if the topic and queue
     # match this subscription
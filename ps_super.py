@@ -0,0 +1,202 @@
+'''
+    Service Supervisor
+
+    Owns the task running each service's run() method.
+
+    If run() raises an exception, the service is restarted after a delay which
+    doubles on each restart, from restart_ms up to restart_max_ms.
+    The delay is reset once the service has run for restart_max_ms without failing.
+    A run() which returns normally is not restarted.
+    Before a restart, any mqtt subscriptions made by the failed run() are removed
+    and the service's stop() is called to end the tasks it started, so run() is
+    called again on a stopped service, as after a reload.
+
+    A task created while a step of a service is running belongs to that service,
+    as do the tasks it creates. Every step of a service's run() coroutine and of
+    the tasks which belong to it, the time from when the event loop resumes it
+    until it next awaits, is timed. A step longer than stall_ms holds up every
+    other service and is reported as a stall.
+
+    Supervisor.running is the SvcState of the service with a step running on
+    the event loop thread, or None, set by the loop thread at the start and end
+    of each step. The stack sampler of mod_prof reads it to count only a
+    service's samples.
+
+    Setting a service's SvcState.prof to a cProfile.Profile profiles only the
+    steps of that service's run() coroutine and its tasks, see mod_prof.
+
+    Parameters are in the "supervisor" dictionary of the main parms json:
+      - stall_ms       : report steps longer than this. Default is 100.
+      - restart_ms     : delay before first restart. Default is 1000.
+      - restart_max_ms : maximum delay between restarts. Default is 60000.
+'''
+
+import asyncio
+import time
+import traceback
+
+from ps_stats import Histogram
+
+# State of a single supervised service
+class SvcState:
+
+    def __init__(self, name, svc):
+        self.name = name
+        self.svc  = svc
+        self.task = None
+        self.state = "starting"
+        self.restarts = 0
+        self.errors   = 0
+        self.stalls   = 0
+        self.busy_ms  = 0
+        self.step_ms  = Histogram()
+        self.prof     = None    # profiler enabled for each step
+
+    def get_stats(self):
+        return {"state":self.state, "restarts":self.restarts,
+                "errors":self.errors, "stalls":self.stalls,
+                "busy_ms":round(self.busy_ms,1), "step_ms":self.step_ms.summary()}
+
+# Awaitable running coroutine coro of service st, timing each step and
+# setting sup.running to st for the step.
+# Futures the coroutine waits on are passed through to the task.
+class _Timed:
+
+    def __init__(self, coro, st, sup):
+        self._coro = coro
+        self._st   = st
+        self._sup  = sup
+
+    def __await__(self):
+        coro = self._coro
+        st   = self._st
+        sup  = self._sup
+        send = None
+        err  = None
+        while True:
+            sup.running = st
+            t = time.perf_counter()
+            prof = st.prof
+            if prof != None:
+                prof.enable()
+            try:
+                if err != None:
+                    f = coro.throw(err)
+                else:
+                    f = coro.send(send)
+            except StopIteration as e:
+                sup._step(st,t,prof)
+                return e.value
+            except BaseException:
+                sup._step(st,t,prof)
+                raise
+
+            sup._step(st,t,prof)
+
+            try:
+                send = yield f
+                err  = None
+            except BaseException as e:
+                send = None
+                err  = e
+
+# run coro of a task created by service st
+async def _owned(coro,st,sup):
+    return await _Timed(coro,st,sup)
+
+class Supervisor:
+
+    def __init__(self, parms={}):
+        self.stall_ms       = parms.get("stall_ms",100)
+        self.restart_ms     = parms.get("restart_ms",1000)
+        self.restart_max_ms = parms.get("restart_max_ms",60000)
+
+        self.svcs = {}
+        self.running = None     # SvcState of service with a step running
+
+    # task factory making tasks created by a service belong to it
+    def _task_factory(self,loop,coro,context=None):
+        if self.running != None:
+            coro = _owned(coro,self.running,self)
+        if context == None:
+            return asyncio.Task(coro,loop=loop)
+        return asyncio.Task(coro,loop=loop,context=context)
+
+    # record time of a step which started at t
+    def _step(self,st,t,prof=None):
+        self.running = None
+        if prof != None:
+            prof.disable()
+        ms = (time.perf_counter() - t) * 1000
+        st.busy_ms += ms
+        st.step_ms.add(ms)
+        if ms > self.stall_ms:
+            st.stalls += 1
+            print("supervisor: {} held the event loop {:.0f}ms".format(st.name,ms))
+
+    # start running svc.run() as service name
+    def start(self,name,svc):
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() == None:
+            loop.set_task_factory(self._task_factory)
+
+        # the service's task does not belong to a service calling start
+        running = self.running
+        self.running = None
+        st = SvcState(name,svc)
+        self.svcs[name] = st
+        st.task = asyncio.create_task(self._supervise(st),name=name)
+        self.running = running
+        return st
+
+    # cancel service name's task, returning its SvcState
+    def stop(self,name):
+        st = self.svcs.pop(name,None)
+        if st != None:
+            st.task.cancel()
+        return st
+
+    async def _supervise(self,st):
+        delay = self.restart_ms
+        while True:
+            st.state = "running"
+            t = time.monotonic()
+            try:
+                await _Timed(st.svc.run(),st,self)
+                st.state = "done"
+                return
+            except asyncio.CancelledError:
+                st.state = "stopped"
+                raise
+            except Exception as e:
+                st.errors += 1
+                st.state = "restarting"
+                err = str(e)
+                print("supervisor: {} failed {}".format(st.name,err))
+                traceback.print_exc()
+
+            # remove subscriptions made by the failed run() and end its tasks
+            mqtt = st.svc.get_mqtt()
+            if mqtt != None and hasattr(mqtt,"unsubscribe_task"):
+                mqtt.unsubscribe_task(st.task)
+            try:
+                await st.svc.stop()
+            except Exception as e:
+                print("supervisor: {} stop failed {}".format(st.name,e))
+
+            # service ran long enough to reset restart delay
+            if (time.monotonic() - t) * 1000 > self.restart_max_ms:
+                delay = self.restart_ms
+
+            try:
+                await st.svc.log("restarting in {}ms after {}".format(delay,err))
+            except Exception:
+                pass
+
+            await asyncio.sleep(delay/1000)
+            delay = min(delay*2,self.restart_max_ms)
+            st.restarts += 1
+
+    # return statistics for each service
+    def get_stats(self):
+        return dict((name,st.get_stats()) for (name,st) in self.svcs.items())
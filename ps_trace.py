@@ -0,0 +1,106 @@
+'''
+    Message latency tracing
+
+    mod_mqtt stamps each message it receives with its receive time,
+    time.monotonic(), and, for a sample of messages, a trace id. Both are
+    passed to subscribers after the payload in the subscription queue list:
+        [filter, topic, payload, rcv_t, trace_id]
+    trace_id is None for messages which are not sampled.
+
+    Services time the stages of handling a message with Stages, which keeps
+    a Histogram of the ms from receive to the end of each stage and records
+    a hop for sampled messages. mod_mqtt publishes the hops of each sampled
+    message once it is trace_secs old, see mod_mqtt trace parameters:
+        {"id":trace id, "topic":topic,
+         "hops":[{"svc":service name, "stage":stage, "ms":ms since receive},...]}
+
+    time.monotonic() is system wide, so services in worker processes, see
+    ps_proc, time stages from the receive time in the main process. Their
+    hops are sent to the main process with the sink set by set_sink().
+'''
+
+import os
+import time
+
+from ps_stats import Histogram
+
+# most traces kept waiting to be published
+MAX_TRACES = 1000
+
+_traces = {}    # trace id: trace, oldest first
+_seq    = 0
+_sink   = None  # called with hops instead of adding them, in worker processes
+
+# start a trace of a message received at rcv_t, returning its id
+def start(topic,rcv_t):
+    global _seq
+    _seq += 1
+    trace_id = "{:x}-{}".format(os.getpid(),_seq)
+
+    if len(_traces) >= MAX_TRACES:
+        del _traces[next(iter(_traces))]
+    _traces[trace_id] = {"id":trace_id, "topic":topic, "t":rcv_t, "hops":[]}
+    return trace_id
+
+# record that service svc finished stage ms after a traced message was received
+def add_hop(trace_id,svc,stage,ms):
+    if _sink != None:
+        _sink(trace_id,svc,stage,ms)
+        return
+
+    tr = _traces.get(trace_id)
+    if tr != None:
+        tr["hops"].append({"svc":svc, "stage":stage, "ms":round(ms,3)})
+
+# send hops to sink(trace_id,svc,stage,ms) instead of keeping them
+def set_sink(sink):
+    global _sink
+    _sink = sink
+
+# remove and return traces of messages received more than secs ago
+def done(secs):
+    t = time.monotonic() - secs
+    result = []
+    while len(_traces) > 0:
+        trace_id = next(iter(_traces))
+        tr = _traces[trace_id]
+        if tr["t"] > t:
+            break
+        del _traces[trace_id]
+        del tr["t"]
+        result.append(tr)
+    return result
+
+# number of traces waiting to be published
+def waiting():
+    return len(_traces)
+
+# Latency of each stage of handling messages in service svc
+class Stages:
+
+    def __init__(self, svc):
+        self.svc = svc
+        self._hist = {}
+
+    # record the end of stage for message data, a subscription queue list
+    def mark(self,stage,data):
+        if len(data) >= 5:
+            self.add(stage,data[3],data[4])
+
+    # record the end of stage for a message received at rcv_t
+    def add(self,stage,rcv_t,trace_id=None):
+        if rcv_t == None:
+            return
+        ms = (time.monotonic() - rcv_t) * 1000
+
+        h = self._hist.get(stage)
+        if h == None:
+            h = self._hist[stage] = Histogram()
+        h.add(ms)
+
+        if trace_id != None:
+            add_hop(trace_id,self.svc,stage,ms)
+
+    # return summary of each stage's histogram
+    def summary(self):
+        return dict((stage,h.summary()) for (stage,h) in self._hist.items())
@@ -61,6 +61,49 @@ def to_bytes(t):
     
     return json.dumps(t).encode("utf-8")
 
+# second and its date time string last returned by dt_str
+_dt_last = [None,""]
+
+# return the local date time as a string, for example "4/9/2023 9:12:15".
+# The string is only formatted once a second since it is usually
+# needed for every message saved.
+def dt_str():
+    s = int(time.time())
+    if s != _dt_last[0]:
+        _dt_last[0] = s
+        _dt_last[1] = "{1}/{2}/{0} {3}:{4:02d}:{5:02d}".format(*time.localtime(s))
+    return _dt_last[1]
+
+# date: (seconds since the epoch for midnight, (year, month, day))
+# of dates already converted by dt_secs. Midnight is None for dates
+# on which the UTC offset changes, such as daylight saving time changes.
+_day_secs = {}
+
+# convert a date time string as written by dt_str,
+# for example "4/9/2023 9:12:15", to seconds since the epoch.
+# Since rows are usually converted in bulk, time.mktime is only called
+# once per date, and the time of day added to midnight, except on dates
+# the UTC offset changes, when it is called with the date and time.
+def dt_secs(dt):
+    (d,t) = dt.split(' ')
+
+    day = _day_secs.get(d)
+    if day == None:
+        (m,dd,y) = d.split('/')
+        ymd = (int(y),int(m),int(dd))
+        midnight = time.mktime(ymd + (0,0,0,0,0,-1))
+        if time.mktime(ymd + (23,59,59,0,0,-1)) - midnight != 86399:
+            midnight = None
+        day = (midnight,ymd)
+        if len(_day_secs) > 1000:
+            _day_secs.clear()
+        _day_secs[d] = day
+
+    (h,mi,s) = t.split(':')
+    if day[0] == None:
+        return time.mktime(day[1] + (int(h),int(mi),int(s),0,0,-1))
+    return day[0] + int(h)*3600 + int(mi)*60 + int(s)
+
 # perform a one time formatting of
 # fields in the defaults
 # using the config dictionary
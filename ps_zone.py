@@ -0,0 +1,151 @@
+'''
+    Zone Map - summary of each block of data store rows.
+
+    For each complete block of rows the zone map keeps:
+        - t0, t1 : first and last row date time, seconds since the epoch
+        - topics : list of topics in the block, or if there are more
+                   than max_topics, a bloom filter of the topics
+        - rng    : {field:[min,max]} for configured numeric payload fields,
+                   null if no row in the block has a numeric value for the field
+
+    may_match() uses the summary to decide if a block could contain a row
+    matching a query so scans can skip blocks which can not.
+
+    Summaries of complete blocks are appended to a file as json lines.
+'''
+
+import json
+import os
+import zlib
+
+import ps_pred
+
+_bloom_bits = 1024
+_bloom_k    = 3
+
+def _bloom_pos(topic):
+    b = topic.encode("utf-8")
+    return [zlib.crc32(b,i) % _bloom_bits for i in range(_bloom_k)]
+
+# True if filter has no wildcards and so matches only one topic
+def _exact(filter):
+    return not ('+' in filter or '#' in filter)
+
+class ZoneMap:
+
+    def __init__(self, fn, blk_rows, fields=[], max_topics=32):
+        self.fn = fn
+        self.blk_rows = blk_rows
+        self.fields = fields
+        self.max_topics = max_topics
+
+        self.zones = []     # summary for each complete block
+        self._cur = None    # summary of the block being added to
+        self._cur_rows = 0
+
+    # number of rows summarized, including incomplete block
+    def rows(self):
+        return len(self.zones) * self.blk_rows + self._cur_rows
+
+    def load(self):
+        if not os.path.exists(self.fn):
+            return
+
+        with open(self.fn) as f:
+            for ln in f:
+                z = json.loads(ln)
+                if "bloom" in z:
+                    z["bloom"] = int(z["bloom"],16)
+                self.zones.append(z)
+
+    # add a row with date time secs, topic and payload string
+    def add(self,secs,topic,payload):
+        z = self._cur
+        if z == None:
+            z = {"t0":secs, "t1":secs, "topics":[],
+                 "rng":dict((f,None) for f in self.fields)}
+            self._cur = z
+            self._cur_rows = 0
+
+        if secs < z["t0"]:
+            z["t0"] = secs
+        if secs > z["t1"]:
+            z["t1"] = secs
+
+        if "bloom" in z:
+            for i in _bloom_pos(topic):
+                z["bloom"] |= 1 << i
+        elif not topic in z["topics"]:
+            z["topics"].append(topic)
+            if len(z["topics"]) > self.max_topics:
+                bloom = 0
+                for t in z["topics"]:
+                    for i in _bloom_pos(t):
+                        bloom |= 1 << i
+                del z["topics"]
+                z["bloom"] = bloom
+
+        if len(self.fields) > 0 and payload.startswith('{'):
+            try:
+                p = json.loads(payload)
+            except ValueError:
+                p = None
+            for f in self.fields:
+                v = ps_pred.num_value(ps_pred.field_value(p,f))
+                if v == None:
+                    continue
+                r = z["rng"][f]
+                if r == None:
+                    z["rng"][f] = [v,v]
+                elif v < r[0]:
+                    r[0] = v
+                elif v > r[1]:
+                    r[1] = v
+
+        self._cur_rows += 1
+        if self._cur_rows >= self.blk_rows:
+            self._complete()
+
+    def _complete(self):
+        z = self._cur
+        self.zones.append(z)
+        self._cur = None
+        self._cur_rows = 0
+
+        if "bloom" in z:
+            z = dict(z)
+            z["bloom"] = "{:x}".format(z["bloom"])
+        with open(self.fn,"a") as f:
+            f.write(json.dumps(z))
+            f.write("\n")
+
+    # Return False if block blk_no can not contain a row
+    # with a topic matching subscr, matching pred and with a
+    # date time from t_from up to but not including t_to.
+    # Returns True if it might, or if there is no summary for the block.
+    def may_match(self,blk_no,subscr=None,pred=None,t_from=None,t_to=None):
+        if blk_no >= len(self.zones):
+            return True
+
+        z = self.zones[blk_no]
+        if t_from != None and z["t1"] < t_from:
+            return False
+        if t_to != None and z["t0"] >= t_to:
+            return False
+
+        if subscr != None and subscr._filter != "#":
+            if "topics" in z:
+                for t in z["topics"]:
+                    if subscr.filter_match(t.split('/')):
+                        break
+                else:
+                    return False
+            elif _exact(subscr._filter):
+                for i in _bloom_pos(subscr._filter):
+                    if not z["bloom"] & (1 << i):
+                        return False
+
+        if pred != None and not pred.may_match(z["rng"]):
+            return False
+
+        return True
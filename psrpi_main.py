@@ -2,6 +2,31 @@
     1. create new instance of each service modules
     2. start each of the services,
     3. enter loop but currently do nothing
+
+    Service modules are imported at the same time, in threads.
+    Services are then created and started in dependency order.
+    A service depends on:
+      - services listed in its "deps" parm
+      - services named by the parms in its ModuleService.DEP_PARMS {parm:default},
+        for example mod_ds_get depends on the service named by its "ds" parm.
+        A default service which does not exist is not a dependency, for
+        example a mod_timer without a scheduler.
+      - the "mqtt" service, if there is one
+    A service is not started until the services it depends on are ready.
+    Most services are ready as soon as they are started,
+    see PsrpiModule.ready_on_start. If a service fails to become ready the
+    failure is printed and kept as "error" in the startup statistics of the
+    services waiting for it, which start once it is ready after a restart.
+
+    The time to import, create and get each service ready is printed
+    once all services are ready and kept in defaults["startup"].
+
+    Services with a "proc" parm are run in worker processes, see ps_proc.
+    Worker processes are started once the mqtt service is ready and
+    kept in defaults["proc_workers"].
+
+    If the "reload" parms say so, the parms files are watched and services
+    are started, stopped and restarted as they are changed, see ps_reload.
         
     Services are defined in config["fn_parms"]
     
@@ -17,24 +42,266 @@
 """
 
 import asyncio
+import copy
 import os
 import gc
+import importlib
+import time
 import ps_util
-from ps_parms import PsosParms
+from ps_parms import PsosParms, PsosDefaults
+from ps_super import Supervisor
+from ps_gc import GcPolicy
+from ps_reload import Reloader, diff_services
+import ps_proc
+from ps_mod import ServiceFailed
+
+
+
+# return the names of the services each service depends on
+def get_deps(svc,services,modules):
+    deps = {}
+    for svc_parms in svc:
+        name = svc_parms["name"]
+        d = list(svc_parms.get("deps",[]))
+
+        parms = services[name]
+        dep_parms = getattr(modules[name].ModuleService,"DEP_PARMS",{})
+        for p in dep_parms:
+            n = parms.get_parm(p,None)
+            if n != None:
+                d.append(n)
+            elif dep_parms[p] in services:
+                d.append(dep_parms[p])
+
+        if name != "mqtt" and "mqtt" in services:
+            d.append("mqtt")
+
+        for n in d:
+            if not n in services:
+                print("main: {} depends on unknown service {}".format(name,n))
+        deps[name] = [n for n in d if n in services and n != name]
+
+    return deps
+
+# return service names ordered so each service
+# comes after the services it depends on
+def dep_order(svc,deps):
+    order = []
+    done = set()
+    todo = [p["name"] for p in svc]
+    while len(todo) > 0:
+        ready = [n for n in todo if all(d in done for d in deps[n])]
+        if len(ready) == 0:
+            raise ValueError("main: service dependency cycle in {}".format(todo))
+        for n in ready:
+            order.append(n)
+            done.add(n)
+        todo = [n for n in todo if not n in done]
+
+    return order
+
+# import a module, returning the module and time taken in ms
+def import_timed(module_name):
+    t = time.perf_counter()
+    module = importlib.import_module(module_name)
+    return (module,(time.perf_counter()-t)*1000)
+
+# return the list of service parms in parms
+# and the name of the file they were read from, if any
+def load_services(parms,defaults,config):
+    # if services is a string
+    # read the file by that name
+    svc = parms["services"]
+    fn  = None
+
+    if type(svc) == str:
+        if '{' in svc:
+            svc = svc.format(**defaults)
+        fn  = ps_util.filepath(config["parms"],svc)
+        svc = ps_util.load_parms(config,svc)
+
+    return (svc,fn)
+
+# start a service once the services it depends on are ready
+async def start_when_ready(name,deps,defaults,t_start):
+    services = defaults["services"]
+    for d in deps[name]:
+        await wait_ready(name,services[d],defaults)
+
+    defaults["gc"].startup()
+    svc = services[name]
+    defaults["supervisor"].start(name,svc)
+    if svc.ready_on_start:
+        svc.set_ready()
+
+    await wait_ready(name,svc,defaults)
+    defaults["startup"][name]["ready_ms"] = round((time.perf_counter()-t_start)*1000,1)
+
+# Wait for svc to be ready for service name. Each time svc fails to
+# become ready the failure is recorded in name's startup statistics
+# and it waits again, for svc to be ready once it is restarted.
+async def wait_ready(name,svc,defaults):
+    while True:
+        try:
+            await svc.wait_ready()
+            return
+        except ServiceFailed as e:
+            print("main: {} waiting, {}".format(name,e))
+            defaults["startup"][name]["error"] = str(e)
+
+# start_when_ready tasks of services still waiting after a reload
+_starting = set()
+
+# return the list of parms of the services running
+def running_services(defaults):
+    return [svc._parms._parms for svc in defaults["services"].values()]
+
+# stop a service, removing its subscriptions
+async def stop_service(name,defaults):
+    services = defaults["services"]
+    svc  = services.get(name)
+    if svc == None:
+        return
+    mqtt = svc.get_mqtt()
+
+    st = defaults["supervisor"].stop(name)
+    if st != None:
+        await asyncio.gather(st.task,return_exceptions=True)
+        if mqtt != None and hasattr(mqtt,"unsubscribe_task"):
+            mqtt.unsubscribe_task(st.task)
+
+    await svc.stop()
+    del services[name]
+
+# Start, stop and restart services so the services running match new_svc,
+# a list of service parms, where old_svc is the list they were started with.
+# Services whose parms changed, and services which depend on a service
+# stopped, are restarted. Returns dictionary of names of services
+# added, removed and restarted, and those not ready after ready_secs.
+# If a new service can not be created, the services stopped are started
+# again with their old parms and the error is raised.
+async def reload_services(old_svc,new_svc,defaults,config,ready_secs=30):
+    t_start  = time.perf_counter()
+    services = defaults["services"]
+
+    old = dict((p["name"],p) for p in old_svc)
+    new = dict((p["name"],p) for p in new_svc)
+    (added,removed,changed) = diff_services(old,new)
+
+    # import modules of new and changed services at the same time
+    module_names = list(set(new[n]["module"] for n in added + changed))
+    imported = await asyncio.gather(*[asyncio.to_thread(import_timed,m) for m in module_names])
+    imported = dict(zip(module_names,imported))
+
+    # services not changed keep their parms objects
+    modules = {}
+    svc_parms_objs = {}
+    for svc_parms in new_svc:
+        name = svc_parms["name"]
+        modules[name] = importlib.import_module(svc_parms["module"])
+        if name in added or name in changed:
+            svc_parms_objs[name] = PsosParms(svc_parms,defaults,config)
+        else:
+            svc_parms_objs[name] = services[name]._parms
+
+    deps  = get_deps(new_svc,svc_parms_objs,modules)
+    order = dep_order(new_svc,deps)
+
+    # to start services with their old parms if the reload fails
+    old_parms_objs = dict((n,services[n]._parms) for n in old)
+    old_modules    = dict((n,importlib.import_module(old[n]["module"])) for n in old)
+    old_deps  = get_deps(old_svc,old_parms_objs,old_modules)
+    old_order = dep_order(old_svc,old_deps)
 
+    # restart services which depend on a service stopped
+    restart = set(changed)
+    for name in order:
+        if not name in added and any(d in restart or d in removed for d in deps[name]):
+            restart.add(name)
 
+    if "mqtt" in restart and len(defaults.get("proc_workers",{})) > 0:
+        raise ValueError("can not restart mqtt while there are worker processes, restart to apply")
+
+    # stop services before the services they depend on
+    for name in reversed(order):
+        if name in restart:
+            await stop_service(name,defaults)
+    for name in reversed(removed):
+        await stop_service(name,defaults)
+
+    startup = defaults["startup"]
+    for name in removed:
+        startup.pop(name,None)
+
+    # create every new service before any is started
+    created = {}
+    init_ms = {}
+    try:
+        for name in order:
+            if name in added or name in restart:
+                defaults["gc"].startup()
+                t = time.perf_counter()
+                created[name] = modules[name].ModuleService(svc_parms_objs[name])
+                init_ms[name] = round((time.perf_counter()-t)*1000,1)
+    except Exception:
+        # start the services stopped again as they were
+        starting = []
+        for name in old_order:
+            if name in restart or name in removed:
+                services[name] = old_modules[name].ModuleService(old_parms_objs[name])
+                startup[name] = {"import_ms":0, "init_ms":0}
+                starting.append(start_when_ready(name,old_deps,defaults,t_start))
+        await wait_started(starting,ready_secs)
+        raise
+
+    for name in order:
+        if name in created:
+            services[name] = created[name]
+            import_ms = 0
+            if modules[name].__name__ in imported:
+                import_ms = imported[modules[name].__name__][1]
+            startup[name] = {"import_ms":round(import_ms,1), "init_ms":init_ms[name]}
+    starting = [start_when_ready(name,deps,defaults,t_start) for name in order if name in created]
+    await wait_started(starting,ready_secs)
+
+    return {"added":added, "removed":removed,
+            "restarted":[n for n in order if n in restart],
+            "not_ready":[n for n in order if n in created and not services[n].is_ready()]}
+
+# Wait up to secs for start_when_ready coroutines in starting to finish.
+# Those still waiting are left to finish, returns the number of them.
+async def wait_started(starting,secs):
+    if len(starting) == 0:
+        return 0
+    tasks = [asyncio.create_task(s) for s in starting]
+    (done,pending) = await asyncio.wait(tasks,timeout=secs)
+    for task in pending:
+        _starting.add(task)
+        task.add_done_callback(_starting.discard)
+    return len(pending)
 
 async def main(parms,config):
+    t_start = time.perf_counter()
+
+    # when to run the garbage collector
+    gc_policy = GcPolicy(parms.get("gc",{}))
         
     # globally accessible default parameters
     defaults = {}
     if "defaults" in parms:
         defaults = parms["defaults"]
+
+    # worker processes get the defaults before formatting
+    raw_defaults = copy.deepcopy(defaults)
     
     # perform a one time conversion of any {...} in
     # defaults using config valus
     ps_util.format_defaults(defaults,config)
-    gc.collect()
+
+    # count changes to defaults so service parms
+    # know when to re-resolve their values
+    defaults = PsosDefaults(defaults)
+    gc_policy.startup()
     
     # globally accessible service instances
     services = {}
@@ -43,58 +310,118 @@ async def main(parms,config):
     defaults["started"]  = False
     
     defaults["sysname"]  = os.name
+    defaults["gc"]       = gc_policy
     
     print("main: init services")
-    gc.collect()
-    
-    # if services is a string
-    # read the file by that name
-    svc = parms["services"]
+    gc_policy.startup()
     
-    if type(svc) == str:
-        if '{' in svc:
-            svc = svc.format(**defaults)
-        svc = ps_util.load_parms(config,svc)
+    (svc,svc_fn) = load_services(parms,defaults,config)
+
+    # services to run in other processes
+    (svc,worker_parms) = ps_proc.split_services(parms,raw_defaults,svc)
     
+    # import modules at the same time
+    gc_policy.startup()
+    module_names = list(set(p["module"] for p in svc))
+    imported = await asyncio.gather(*[asyncio.to_thread(import_timed,m) for m in module_names])
+    imported = dict(zip(module_names,imported))
+
+    # create module specific parms objects
+    # and work out the order to create services in
+    modules = {}
+    svc_parms_objs = {}
     for svc_parms in svc:
-        
-        gc.collect()
+        name = svc_parms["name"]
+        modules[name] = imported[svc_parms["module"]][0]
+        svc_parms_objs[name] = PsosParms(svc_parms,defaults,config)
+
+    deps  = get_deps(svc,svc_parms_objs,modules)
+    order = dep_order(svc,deps)
 
-        # create module specific parms object
-        psos_parms = PsosParms(svc_parms,defaults,config)
+    startup = {}
+    defaults["startup"] = startup
+
+    for name in order:
+        
+        gc_policy.startup()
         
         # create a new instance of a service
         # and store as a service under specified name
-        name = svc_parms["name"]
-        module_name = svc_parms["module"]
-        
         print("... ",name)
-        module = __import__(module_name)
-        services[name] =  module.ModuleService(psos_parms)
+        t = time.perf_counter()
+        services[name] = modules[name].ModuleService(svc_parms_objs[name])
+        startup[name] = {"import_ms":round(imported[modules[name].__name__][1],1),
+                         "init_ms":round((time.perf_counter()-t)*1000,1)}
           
         
     print("main: run services")
-        
-    for svc_parms in parms["services"]:
-        gc.collect()
-        name = svc_parms["name"]
-        svc  = services[name]
-        # print("... " + name)
-        asyncio.create_task(svc.run())
 
-        
+    # supervisor owns the service tasks,
+    # restarting them if they fail
+    supervisor = Supervisor(parms.get("supervisor",{}))
+    defaults["supervisor"] = supervisor
+
+    starting = [asyncio.create_task(start_when_ready(name,deps,defaults,t_start)) for name in order]
+    # keep a reference so the task is not garbage collected
+    report_task = asyncio.create_task(startup_report(starting,order,startup))
+
+    # start worker processes once mqtt is ready
+    workers = {}
+    defaults["proc_workers"] = workers
+    if len(worker_parms) > 0:
+        if not "mqtt" in services:
+            raise ValueError("main: services with a proc parm need an mqtt service")
+        await services["mqtt"].wait_ready()
+        for (n,wp) in worker_parms:
+            print("main: starting proc",n,[p["name"] for p in wp["services"][1:]])
+            workers[n] = ps_proc.ProcWorker(n,wp,config,services["mqtt"])
+            workers[n].start()
+
     defaults["started"] = True
-    
-    while True:
-        # nothing to do here, but can't return?
-        
-        # could create a queue that no one writes to and wait?
-        # or use that queue as an optional print queue?
-        # or restart subscription? or stats subscription? or ?
-                    
-        # allow co-routines to execute
-        # print("main: free space "+str(gc.mem_free()))
-        gc.collect()
-        await asyncio.sleep(5)
+    gc_policy.after_init()
+
+    # reload services when the parms files change
+    reloader = Reloader(parms.get("reload",{}),config)
+    defaults["reload"] = reloader
+    if reloader.secs > 0 and reloader.fn != None:
+        reloader.watch([reloader.fn,svc_fn])
+
+        async def reload():
+            nonlocal svc
+            new_parms = ps_util.load_json(reloader.fn)
+            (new_svc,new_fn) = load_services(new_parms,defaults,config)
+            reloader.watch([reloader.fn,new_fn])
+
+            # only services in this process are reloaded
+            (new_svc,new_workers) = ps_proc.split_services(new_parms,raw_defaults,new_svc)
+            ignored = [k for k in ("defaults","gc","supervisor","reload")
+                       if new_parms.get(k,{}) != (raw_defaults if k == "defaults" else parms.get(k,{}))]
+            if ([(n,wp["services"]) for (n,wp) in new_workers] !=
+                [(n,wp["services"]) for (n,wp) in worker_parms]):
+                ignored.append("proc services")
+            if len(ignored) > 0:
+                print("main: reload does not apply changes to {}, restart to apply".format(", ".join(ignored)))
+
+            try:
+                changes = await reload_services(svc,new_svc,defaults,config,reloader.ready_secs)
+            finally:
+                svc = running_services(defaults)
+            changes["ignored"] = ignored
+            return changes
+
+        reloader._task = asyncio.create_task(reloader.run(reload))
+
+    # nothing else to do here, but can't return
+    # so run garbage collection as the policy says
+    await gc_policy.run(services)
         
         
+
+
+# print the startup times once all services are ready
+async def startup_report(starting,order,startup):
+    await asyncio.gather(*starting)
+    print("main: startup  {:>10} {:>10} {:>10}".format("import ms","init ms","ready ms"))
+    for name in order:
+        st = startup[name]
+        print("main: {:8} {:10} {:10} {:10}".format(name,st["import_ms"],st["init_ms"],st["ready_ms"]))